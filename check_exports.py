@@ -0,0 +1,80 @@
+"""
+Script to check that the exported models did not get slower than their previous exports,
+using the benchmarks stored next to the exports by Model.save
+"""
+
+import json
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import List
+
+from openmapflow.config import PROJECT_ROOT, DataPaths
+
+# An export is refused if it runs this much slower (relatively) than the previous export
+MAX_SLOWDOWN = 0.1
+# Only the throughput at these batch sizes (or larger) is gated: the passes of smaller batches
+# take well under a millisecond, so their timings are too noisy to refuse an export on. They
+# are still printed
+MIN_GATED_BATCH_SIZE = 64
+
+
+def check_export(
+    model_path: Path,
+    max_slowdown: float = MAX_SLOWDOWN,
+    min_gated_batch_size: int = MIN_GATED_BATCH_SIZE,
+) -> List[str]:
+    """
+    Returns the gated batch sizes (of at least min_gated_batch_size) at which the export got
+    slower than the previous export
+    """
+    benchmark_path = model_path.with_suffix(".benchmark.json")
+    if not benchmark_path.exists():
+        print(f"{model_path.stem}: no benchmark found, skipping.")
+        return []
+
+    with benchmark_path.open() as f:
+        benchmark = json.load(f)
+    previous = benchmark["previous_pixels_per_second"]
+    if previous is None:
+        print(f"{model_path.stem}: first export, nothing to compare to.")
+        return []
+
+    slower = []
+    for batch_size, pixels_per_second in benchmark["pixels_per_second"].items():
+        if batch_size not in previous:
+            continue
+        mark = "\u2714"
+        if int(batch_size) < min_gated_batch_size:
+            mark = "-"
+        elif pixels_per_second < previous[batch_size] * (1 - max_slowdown):
+            slower.append(batch_size)
+            mark = "\u2716"
+        print(
+            f"{mark} {model_path.stem} batch size {batch_size}: "
+            f"{pixels_per_second} pixels/s (previous export: {previous[batch_size]} pixels/s)"
+        )
+    return slower
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--models", nargs="*", default=[], help="Models to check (all exported models if empty)"
+    )
+    parser.add_argument("--max_slowdown", type=float, default=MAX_SLOWDOWN)
+    parser.add_argument("--min_gated_batch_size", type=int, default=MIN_GATED_BATCH_SIZE)
+    args = parser.parse_args()
+
+    model_dir = PROJECT_ROOT / DataPaths.MODELS
+    model_paths = (
+        [model_dir / f"{model_name}.pt" for model_name in args.models]
+        if args.models
+        else sorted(model_dir.glob("*.pt"))
+    )
+    slower_models = [
+        p.stem for p in model_paths if check_export(p, args.max_slowdown, args.min_gated_batch_size)
+    ]
+    if slower_models:
+        print(f"Exports got slower than their previous exports: {slower_models}")
+        sys.exit(1)
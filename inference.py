@@ -1,16 +1,42 @@
 from argparse import ArgumentParser
+from pathlib import Path
 
 from openmapflow.config import PROJECT_ROOT, DataPaths
 from openmapflow.inference import Inference
 
-from src.models.model import Model
-
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("--model_name", type=str)
     parser.add_argument("--tif_path", type=str)
     parser.add_argument("--dest_path", type=str)
+    # torch runs the Lightning checkpoint, onnx runs the ONNX export (see Model.save_onnx)
+    # under onnxruntime, without loading pytorch-lightning or the datasets
+    parser.add_argument("--backend", type=str, default="torch", choices=["torch", "onnx"])
+    # In-season inference: the tif contains only the new month(s) of the tile, the LSTM
+    # states of the previous months are read from (and then written to) this npz file
+    parser.add_argument("--in_season_state", type=str, default=None)
 
     args = parser.parse_args()
-    model = Model.load_from_checkpoint(PROJECT_ROOT / DataPaths.MODELS / f"{args.model_name}.ckpt")
-    Inference(model).run(local_path=args.tif_path, dest_path=args.dest_path)
+    if args.in_season_state is not None and args.backend != "torch":
+        raise ValueError("In-season inference is only supported by the torch backend")
+
+    model_dir = PROJECT_ROOT / DataPaths.MODELS
+    if args.backend == "onnx":
+        from src.onnx_inference import OnnxInference
+
+        inference: Inference = OnnxInference(model_dir / f"{args.model_name}.onnx")
+        inference.run(local_path=args.tif_path, dest_path=args.dest_path)
+    else:
+        from src.models.in_season import InSeasonModel
+        from src.models.model import Model
+
+        model = Model.load_from_checkpoint(model_dir / f"{args.model_name}.ckpt").eval()
+        if args.in_season_state is not None:
+            InSeasonModel(model).run(
+                local_path=Path(args.tif_path),
+                state_path=Path(args.in_season_state),
+                dest_path=args.dest_path,
+            )
+        else:
+            inference = Inference(model, normalizing_dict=model.normalizing_dict)
+            inference.run(local_path=args.tif_path, dest_path=args.dest_path)
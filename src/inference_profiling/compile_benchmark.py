@@ -0,0 +1,114 @@
+# This script benchmarks the --compile mode of the Model (see src/models/compilation.py) on
+# CPU: the training steps per second (forward and backward pass of the forecaster and the
+# classifier, and the optimizer step) and the inference pixels per second, with eager and
+# with compiled modules. The modules are built with the default hparams of the Model (which
+# can be overridden, e.g. --forecasting_vector_size 128), so no datasets are needed.
+#
+# Usage (from the root of the repository):
+#   python -m src.inference_profiling.compile_benchmark --input_months 12 --available_timesteps 9
+import json
+import time
+from argparse import ArgumentParser, Namespace
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from src.models import Model
+from src.models.classifier import Classifier
+from src.models.compilation import CompiledModule, compile_available, log_graph_breaks
+from src.models.export import benchmark
+from src.models.forecaster import Forecaster
+
+NUM_BANDS = 14
+TRAINING_STEPS = 20
+
+
+class ForecastingClassifier(nn.Module):
+    """The forward pass of a forecasting Model, as in Model.forward"""
+
+    def __init__(self, hparams: Namespace, input_months: int, available_timesteps: int) -> None:
+        super().__init__()
+        self.available_timesteps = available_timesteps
+        self.forecaster = Forecaster(
+            num_bands=NUM_BANDS,
+            output_timesteps=input_months - available_timesteps,
+            hparams=hparams,
+        )
+        self.classifier = Classifier(input_size=NUM_BANDS, hparams=hparams)
+        self.compiled_forecaster: Optional[CompiledModule] = None
+        self.compiled_classifier: Optional[CompiledModule] = None
+
+    def use_compiled_modules(self) -> None:
+        self.compiled_forecaster = CompiledModule(self.forecaster, "forecaster")
+        self.compiled_classifier = CompiledModule(self.classifier, "classifier")
+
+    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        forecaster: Callable = self.compiled_forecaster or self.forecaster
+        classifier: Callable = self.compiled_classifier or self.classifier
+
+        x_input = x[:, : self.available_timesteps]
+        forecast = forecaster(x_input)
+        x = torch.cat((x_input, forecast[:, self.available_timesteps - 1 :]), dim=1)
+        return forecast, classifier(x)[1]
+
+
+def training_steps_per_second(model: ForecastingClassifier, x: torch.Tensor) -> float:
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters())
+    labels = torch.randint(0, 2, (x.shape[0],)).float()
+
+    def step() -> None:
+        optimizer.zero_grad()
+        forecast, preds = model(x)
+        loss = F.smooth_l1_loss(forecast, x[:, 1:]) + F.binary_cross_entropy(
+            preds.squeeze(-1), labels
+        )
+        loss.backward()
+        optimizer.step()
+
+    # Warm up, the compiled modules are compiled on the first steps
+    step()
+    step()
+    durations: List[float] = []
+    for _ in range(TRAINING_STEPS):
+        start = time.perf_counter()
+        step()
+        durations.append(time.perf_counter() - start)
+    return round(1 / sorted(durations)[len(durations) // 2], 2)
+
+
+def pixels_per_second(model: ForecastingClassifier, input_months: int) -> Dict[str, float]:
+    model.eval()
+    return benchmark(lambda x: model(x)[1], (input_months, NUM_BANDS))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--input_months", type=int, default=12)
+    parser.add_argument("--available_timesteps", type=int, default=9)
+    hparams = Model.add_model_specific_args(parser).parse_args()
+
+    torch.manual_seed(42)
+    model = ForecastingClassifier(hparams, hparams.input_months, hparams.available_timesteps)
+    x = torch.randn(hparams.batch_size, hparams.input_months, NUM_BANDS)
+
+    results = {
+        "torch_version": torch.__version__,
+        "num_threads": torch.get_num_threads(),
+        "eager": {
+            "training_steps_per_second": training_steps_per_second(model, x),
+            "pixels_per_second": pixels_per_second(model, hparams.input_months),
+        },
+    }
+    if compile_available():
+        log_graph_breaks()
+        model.use_compiled_modules()
+        results["compiled"] = {
+            "training_steps_per_second": training_steps_per_second(model, x),
+            "pixels_per_second": pixels_per_second(model, hparams.input_months),
+        }
+    else:
+        print(f"torch {torch.__version__} has no torch.compile, only the eager modules are run")
+    print(json.dumps(results, indent=4))
@@ -0,0 +1,107 @@
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import torch
+
+
+def snapshot(obj: Any) -> Any:
+    """
+    Copies the tensors of a checkpoint (e.g. the state dict and the optimizer states) to the
+    CPU, so the checkpoint can be written while training keeps updating the original tensors
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        copied = obj.__class__((key, snapshot(value)) for key, value in obj.items())
+        if hasattr(obj, "_metadata"):
+            # The versions of the modules of a state dict, used by load_state_dict
+            copied._metadata = obj._metadata  # type: ignore
+        return copied
+    if isinstance(obj, list):
+        return [snapshot(value) for value in obj]
+    if isinstance(obj, tuple):
+        return tuple(snapshot(value) for value in obj)
+    return obj
+
+
+def atomic_save(checkpoint: Dict[str, Any], path: Path) -> None:
+    """Writes the checkpoint to a temporary file which then replaces path"""
+    tmp_path = path.with_name(f"{path.name}.part")
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def save_checkpoint(checkpoint: Dict[str, Any], path: Path) -> None:
+    """
+    Writes the checkpoint atomically, as trainer.save_checkpoint: if the hparams cannot be
+    pickled, the checkpoint is written without them
+    """
+    try:
+        atomic_save(checkpoint, path)
+    except AttributeError:
+        if "hparams" not in checkpoint:
+            raise
+        checkpoint = {key: value for key, value in checkpoint.items() if key != "hparams"}
+        atomic_save(checkpoint, path)
+
+
+class AsyncCheckpointWriter:
+    r"""
+    Writes checkpoints in a background thread, so training is not stalled by slow (e.g.
+    network mounted) storage. Checkpoints are snapshotted when they are saved and written
+    atomically (see save_checkpoint), so path always holds a complete checkpoint. If a
+    checkpoint is saved to a path which still has a pending (not yet started) write, the
+    pending checkpoint is dropped in favour of the newer one.
+
+    wait blocks until every saved checkpoint is written, and raises the error of the first
+    failed write since the previous wait, so failed writes are not dropped silently.
+    """
+
+    def __init__(self) -> None:
+        self._condition = threading.Condition()
+        self._pending: Dict[Path, Dict[str, Any]] = {}
+        self._writing: Optional[Path] = None
+        self._error: Optional[BaseException] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def save(self, checkpoint: Dict[str, Any], path: Path) -> None:
+        checkpoint = snapshot(checkpoint)
+        with self._condition:
+            self._pending[path] = checkpoint
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._write_checkpoints, daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    def is_pending(self, path: Path) -> bool:
+        """Whether a checkpoint saved to path is not written yet"""
+        with self._condition:
+            return path in self._pending or self._writing == path
+
+    def wait(self) -> None:
+        with self._condition:
+            while self._pending or self._writing is not None:
+                self._condition.wait()
+            error, self._error = self._error, None
+        if error is not None:
+            raise RuntimeError("Writing a checkpoint failed") from error
+
+    def _write_checkpoints(self) -> None:
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                path = next(iter(self._pending))
+                checkpoint = self._pending.pop(path)
+                self._writing = path
+            try:
+                save_checkpoint(checkpoint, path)
+            except Exception as e:
+                with self._condition:
+                    if self._error is None:
+                        self._error = e
+            with self._condition:
+                self._writing = None
+                self._condition.notify_all()
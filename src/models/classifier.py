@@ -1,5 +1,5 @@
 from argparse import ArgumentParser, Namespace
-from typing import Any, Dict, List, Tuple, Type
+from typing import Any, Dict, List, Optional, Tuple, Type, Union
 
 import pytorch_lightning as pl
 import torch
@@ -8,6 +8,41 @@ from torch import nn
 from .lstm import UnrolledLSTM
 
 
+def masked_batchnorm(
+    batchnorm: nn.BatchNorm1d, x: torch.Tensor, mask: torch.Tensor
+) -> torch.Tensor:
+    r"""
+    Applies a BatchNorm1d in training mode to x ([batch_size, features]) as if the batch only
+    contained the rows where mask ([batch_size]) is nonzero: all rows are normalized with
+    the batch statistics of these rows, and the running statistics are updated with them.
+    """
+    mask = mask.to(x.dtype)[:, None]
+    count = mask.sum()
+    mean = (x * mask).sum(dim=0) / count.clamp(min=1)
+    var = ((x - mean) ** 2 * mask).sum(dim=0) / count.clamp(min=1)
+
+    if batchnorm.track_running_stats:
+        assert batchnorm.running_mean is not None and batchnorm.running_var is not None
+        assert batchnorm.num_batches_tracked is not None
+        with torch.no_grad():
+            batchnorm.num_batches_tracked.add_(1)
+            momentum: Union[float, torch.Tensor]
+            if batchnorm.momentum is None:
+                # A cumulative moving average, as in BatchNorm1d
+                momentum = 1 / batchnorm.num_batches_tracked.to(x.dtype)
+            else:
+                momentum = batchnorm.momentum
+            # The running variance is unbiased, as in BatchNorm1d
+            unbiased_var = var * count / (count - 1).clamp(min=1)
+            batchnorm.running_mean.mul_(1 - momentum).add_(momentum * mean)
+            batchnorm.running_var.mul_(1 - momentum).add_(momentum * unbiased_var)
+
+    x = (x - mean) / torch.sqrt(var + batchnorm.eps)
+    if batchnorm.affine:
+        x = x * batchnorm.weight + batchnorm.bias
+    return x
+
+
 class Classifier(pl.LightningModule):
     r"""
     An LSTM based model to predict the presence of cropland in a pixel.
@@ -98,16 +133,42 @@ class Classifier(pl.LightningModule):
 
             self.local_classifier = nn.Sequential(*local_classification_layers)
 
-    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    def forward(
+        self, x: torch.Tensor, mask: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        :param mask: In training, a 0/1 mask of shape [batch_size] of the time series the batch
+            statistics of the BatchNorms are computed from (see masked_batchnorm), e.g. to
+            leave out padding. All time series are classified. If None all time series are used
+        """
         for _, lstm in enumerate(self.base):
             x, (hn, _) = lstm(x)
             x = x[:, 0, :, :]
 
+        if mask is not None and self.training:
+            return self._masked_forward(hn[-1, :, :], mask)
+
         base = self.batchnorm(hn[-1, :, :])
         x_global = torch.sigmoid(self.global_classifier(base))
         x_local = torch.sigmoid(self.local_classifier(base))
         return x_global, x_local
 
+    @torch.jit.unused
+    def _masked_forward(
+        self, hidden: torch.Tensor, mask: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # As forward, with the BatchNorms applied by masked_batchnorm
+        def classify(layers: nn.Sequential, x: torch.Tensor) -> torch.Tensor:
+            for layer in layers:
+                if isinstance(layer, nn.BatchNorm1d):
+                    x = masked_batchnorm(layer, x, mask)
+                else:
+                    x = layer(x)
+            return torch.sigmoid(x)
+
+        base = masked_batchnorm(self.batchnorm, hidden, mask)
+        return classify(self.global_classifier, base), classify(self.local_classifier, base)
+
     @staticmethod
     def add_model_specific_args(parent_parser: ArgumentParser) -> ArgumentParser:
         parser = ArgumentParser(parents=[parent_parser], add_help=False)
@@ -0,0 +1,65 @@
+import logging
+from typing import Any, Callable, Optional, Tuple, Type
+
+import torch
+from torch import nn
+
+logger = logging.getLogger(__name__)
+
+
+def compile_available() -> bool:
+    """torch.compile was added in torch 2.0"""
+    return hasattr(torch, "compile")
+
+
+def compilation_errors() -> Tuple[Type[Exception], ...]:
+    """The errors torch.compile raises if it cannot compile a module"""
+    try:
+        from torch._dynamo.exc import BackendCompilerFailed, Unsupported
+    except ImportError:
+        return ()
+    return (BackendCompilerFailed, Unsupported)
+
+
+def log_graph_breaks() -> None:
+    """
+    Makes torch log the reason of every graph break when it happens. Changes the logging of
+    torch for the whole process, so it is left to scripts (e.g. compile_benchmark.py).
+    """
+    if hasattr(torch, "_logging"):
+        torch._logging.set_logs(graph_breaks=True)
+
+
+class CompiledModule:
+    r"""
+    Calls a module through torch.compile, for the Python loop heavy modules (the
+    UnrolledLSTMs of the Classifier and Forecaster) whose loops are then traced into a single
+    graph. Parts of the module the compiler cannot trace (graph breaks) run eagerly, see
+    log_graph_breaks to log their reasons. If the module cannot be compiled at all (see
+    compilation_errors), or torch has no torch.compile, the reason is logged and the module
+    runs eagerly. Any other error is raised.
+
+    Not an nn.Module, so the parameters of the module are not registered twice.
+
+    :param module: The module to compile
+    :param name: The name of the module in the logged messages
+    """
+
+    def __init__(self, module: nn.Module, name: str) -> None:
+        self.module = module
+        self.name = name
+        self.compiled: Optional[Callable] = None
+        if compile_available():
+            self.compiled = torch.compile(module)
+        else:
+            logger.warning(f"torch {torch.__version__} has no torch.compile, {name} runs eagerly")
+
+    def __call__(self, *args: Any) -> Any:
+        if self.compiled is None:
+            return self.module(*args)
+        try:
+            return self.compiled(*args)
+        except compilation_errors() as e:
+            logger.warning(f"Compiling {self.name} failed, it runs eagerly: {e}")
+            self.compiled = None
+            return self.module(*args)
@@ -1,4 +1,4 @@
-from typing import Any, Dict, List, Optional, Tuple, Union, cast
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Union, cast
 
 import numpy as np
 import pandas as pd
@@ -6,9 +6,45 @@ import torch
 from dateutil.relativedelta import relativedelta
 from openmapflow.bbox import BBox
 from openmapflow.constants import CLASS_PROB, END, EO_DATA, LAT, LON, MONTHS, START
-from torch.utils.data import Dataset
+from torch.utils.data import (
+    BatchSampler,
+    DataLoader,
+    Dataset,
+    IterableDataset,
+    Sampler,
+    get_worker_info,
+)
 from tqdm import tqdm
 
+from .eo_store import TIMESTEPS, CompiledDataset
+from .features import DATASET_FEATURES, FeatureFunction
+
+# Number of rows tensorized at a time when caching the dataset
+CACHE_CHUNK_SIZE = 10000
+
+# Bits of the uint8 labels kept by a compact cache (cache_dtype other than float32)
+IS_CROP_BIT = 1
+IS_GLOBAL_BIT = 2
+
+
+def select_bands(array: np.ndarray, bands_to_use: Optional[Sequence[int]]) -> np.ndarray:
+    """Selects the bands_to_use (the last axis) of the array, all bands if None"""
+    if bands_to_use is None:
+        return array
+    return array[..., bands_to_use]
+
+
+def normalize(
+    array: np.ndarray, normalizing_dict: Optional[Dict], bands_to_use: Optional[Sequence[int]]
+) -> np.ndarray:
+    # expects an array which only contains the bands_to_use
+    if normalizing_dict is None:
+        return array
+    else:
+        return (array - select_bands(normalizing_dict["mean"], bands_to_use)) / select_bands(
+            normalizing_dict["std"], bands_to_use
+        )
+
 
 class CropDataset(Dataset):
     def __init__(
@@ -24,6 +60,9 @@ class CropDataset(Dataset):
         input_months: int = 12,
         normalizing_dict: Optional[Dict] = None,
         up_to_year: Optional[int] = None,
+        bands_to_use: Optional[List[int]] = None,
+        cached_tensors: Optional[Dict[str, torch.Tensor]] = None,
+        cache_dtype: torch.dtype = torch.float32,
     ) -> None:
         df = df.copy()
 
@@ -32,6 +71,8 @@ class CropDataset(Dataset):
 
         self.start_month_index = MONTHS.index(start_month)
         self.input_months = input_months
+        # If set, only these bands are served (the normalizing dict covers all bands)
+        self.bands_to_use = bands_to_use
 
         df["is_crop"] = df[CLASS_PROB] >= probability_threshold
         df["is_local"] = (
@@ -73,30 +114,28 @@ class CropDataset(Dataset):
 
             wandb_logger.experiment.config.update(to_log)
 
+        # Upsampling is done by BalancedSampler, which samples these rows a second time
+        self.upsampled_indices = np.array([], dtype=np.int64)
         if upsample:
             if local_crop == local_non_crop:
                 print(f"No upsampling: {local_crop} == {local_non_crop}")
             elif local_crop > local_non_crop:
-                df = df.append(
-                    df[df["is_local"] & ~df["is_crop"]].sample(
-                        n=local_difference, replace=True, random_state=42
-                    ),
-                    ignore_index=True,
+                self.upsampled_indices = self._sample_indices(
+                    df["is_local"] & ~df["is_crop"], n=local_difference
                 )
                 print(f"Upsamplng local non-crop to match crop {local_non_crop} -> {local_crop}")
             elif local_crop < local_non_crop:
-                df = df.append(
-                    df[df["is_local"] & df["is_crop"]].sample(
-                        n=local_difference, replace=True, random_state=42
-                    ),
-                    ignore_index=True,
+                self.upsampled_indices = self._sample_indices(
+                    df["is_local"] & df["is_crop"], n=local_difference
                 )
                 print(f"Upsampling: local crop to non-crop: {local_crop} -> {local_non_crop}")
 
         self.normalizing_dict: Dict = (
             normalizing_dict
             if normalizing_dict
-            else self._calculate_normalizing_dict(df[EO_DATA].to_list())
+            else self._calculate_normalizing_dict(
+                df[EO_DATA].to_list() + df[EO_DATA].iloc[self.upsampled_indices].to_list()
+            )
         )
 
         self.df = df
@@ -109,24 +148,66 @@ class CropDataset(Dataset):
         self.x: Optional[torch.Tensor] = None
         self.y: Optional[torch.Tensor] = None
         self.weights: Optional[torch.Tensor] = None
+        self.labels: Optional[torch.Tensor] = None
         self.cache = False
         if cache:
-            self.x, self.y, self.weights = self.to_array()
+            # cached_tensors (e.g. loaded from the shared tensor cache, see tensor_cache.py)
+            # must be the output of get_cached_tensors for this df and cache_dtype, in which
+            # case df needs no eo_data
+            if cached_tensors is not None:
+                x = cached_tensors["x"]
+                assert len(x) == len(df), "Cached tensors do not match the df"
+                if "labels" in cached_tensors:
+                    y, weights = self._unpack_labels(cached_tensors["labels"])
+                else:
+                    y, weights = cached_tensors["y"], cached_tensors["weights"]
+            else:
+                x, y, weights = self.to_array()
+
+            if cache_dtype == torch.float32:
+                self.x, self.y, self.weights = x, y, weights
+            else:
+                # Compact cache: x is kept in reduced precision and is_crop and is_global
+                # are packed into a single byte, both are upcast when they are served
+                is_crop, is_global = (y != 0).to(torch.uint8), (weights != 0).to(torch.uint8)
+                self.x = x.to(cache_dtype)
+                self.labels = is_crop * IS_CROP_BIT + is_global * IS_GLOBAL_BIT
             self.cache = cache
 
+    @staticmethod
+    def _sample_indices(condition: pd.Series, n: int) -> np.ndarray:
+        # Samples (with replacement) positions of the rows where condition is True
+        positions = pd.Series(np.flatnonzero(condition.to_numpy()))
+        return positions.sample(n=n, replace=True, random_state=42).to_numpy()
+
+    def sampler(self, seed: int = 42) -> "BalancedSampler":
+        """
+        Returns a sampler which shuffles the dataset every epoch, including the
+        upsampled rows if upsample is True.
+        """
+        return BalancedSampler(len(self), self.upsampled_indices, seed=seed)
+
     def _compute_num_timesteps(self, df) -> List[int]:
+        return self.compute_num_timesteps(df, self.start_month_index, self.input_months)
+
+    @staticmethod
+    def compute_num_timesteps(
+        df: pd.DataFrame, start_month_index: int, input_months: int
+    ) -> List[int]:
+        """
+        Computes the unique number of timesteps available per example, only the
+        start and end date columns of df are used.
+        """
         df_start_date = pd.to_datetime(df[START]).apply(
-            lambda dt: dt.replace(month=self.start_month_index + 1)
+            lambda dt: dt.replace(month=start_month_index + 1)
         )
         df_candidate_end_date = df_start_date.apply(
-            lambda dt: dt + relativedelta(months=+self.input_months)
+            lambda dt: dt + relativedelta(months=+input_months)
         )
         df_data_end_date = pd.to_datetime(df[END])
         df_end_date = pd.DataFrame({"1": df_data_end_date, "2": df_candidate_end_date}).min(axis=1)
-        df["timesteps"] = (
-            ((df_end_date - df_start_date) / np.timedelta64(1, "M")).round().astype(int)
-        )
-        timesteps = df["timesteps"].unique().tolist()
+        df_timesteps = ((df_end_date - df_start_date) / np.timedelta64(1, "M")).round().astype(int)
+        timesteps = df_timesteps.unique().tolist()
 
         # TEMPORARY FIX: dataset column not always available
         # if len(timesteps) > 1:
@@ -179,32 +260,66 @@ class CropDataset(Dataset):
         std = np.sqrt(variance)
         return {"mean": norm_dict_interim["mean"], "std": std}
 
+    def _select_bands(self, array: np.ndarray) -> np.ndarray:
+        return select_bands(array, self.bands_to_use)
+
     def _normalize(self, array: np.ndarray) -> np.ndarray:
-        if self.normalizing_dict is None:
-            return array
-        else:
-            return (array - self.normalizing_dict["mean"]) / self.normalizing_dict["std"]
+        return normalize(array, self.normalizing_dict, self.bands_to_use)
 
     def __len__(self) -> int:
         return len(self.df)
 
+    def _stack_eo_data(self, eo_data_list: List[np.ndarray]) -> np.ndarray:
+        """
+        Stacks the input months of every [timesteps, bands] array into a single normalized
+        float32 array of shape [N, input_months, bands], partial time series are padded
+        with nans. This is equivalent to calling __getitem__ on every row.
+        """
+        num_bands = eo_data_list[0].shape[1] if len(eo_data_list) > 0 else 0
+        if self.bands_to_use is not None:
+            num_bands = len(self.bands_to_use)
+        x = np.empty((len(eo_data_list), self.input_months, num_bands), dtype=np.float32)
+        for chunk_start in range(0, len(eo_data_list), CACHE_CHUNK_SIZE):
+            chunk = eo_data_list[chunk_start : chunk_start + CACHE_CHUNK_SIZE]
+            windows = [
+                array[self.start_month_index : self.start_month_index + self.input_months]
+                for array in chunk
+            ]
+            window_lengths = np.array([window.shape[0] for window in windows])
+            chunk_x = np.full((len(chunk), self.input_months, num_bands), np.nan)
+            for window_length in np.unique(window_lengths):
+                rows = np.flatnonzero(window_lengths == window_length)
+                chunk_x[rows, :window_length] = self._select_bands(
+                    np.stack([windows[i] for i in rows])
+                )
+            x[chunk_start : chunk_start + len(chunk)] = self._normalize(chunk_x)
+        return x
+
+    @staticmethod
+    def _unpack_labels(labels: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        return (labels & IS_CROP_BIT != 0).float(), (labels & IS_GLOBAL_BIT != 0).float()
+
+    def get_cached_tensors(self) -> Dict[str, torch.Tensor]:
+        """The cached tensors as they are kept, i.e. the compact x and labels of a compact cache"""
+        if self.x is not None and self.labels is not None:
+            return {"x": self.x, "labels": self.labels}
+        x, y, weights = self.to_array()
+        return {"x": x, "y": y, "weights": weights}
+
     def to_array(self) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
-        if self.x is not None:
+        if self.x is not None and self.labels is not None:
+            y, weights = self._unpack_labels(self.labels)
+            return self.x.float(), y, weights
+        elif self.x is not None:
             assert self.y is not None
             assert self.weights is not None
             return self.x, self.y, self.weights
         else:
-            x_list: List[torch.Tensor] = []
-            y_list: List[torch.Tensor] = []
-            weight_list: List[torch.Tensor] = []
             print("Loading data into memory")
-            for i in tqdm(range(len(self)), desc="Caching files"):
-                x, y, weight = self[i]
-                x_list.append(x)
-                y_list.append(y)
-                weight_list.append(weight)
-
-            return torch.stack(x_list), torch.stack(y_list), torch.stack(weight_list)
+            x = self._stack_eo_data(self.df[EO_DATA].to_list())
+            y = self.df["is_crop"].to_numpy(dtype=np.float32)
+            weights = (~self.df["is_local"]).to_numpy(dtype=np.float32)
+            return torch.from_numpy(x), torch.from_numpy(y), torch.from_numpy(weights)
 
     @property
     def num_input_features(self) -> int:
@@ -221,8 +336,41 @@ class CropDataset(Dataset):
     def num_output_classes(self) -> Tuple[int, int]:
         return 1, 1
 
-    def __getitem__(self, index: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    def get_batch(self, indices: Sequence[int]) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Returns the x [batch, input_months, bands], label and is_global tensors of a batch of
+        indices at once, equivalent to collating __getitem__ of every index.
+        """
         if (self.cache) & (self.x is not None):
+            index = torch.as_tensor(indices, dtype=torch.long)
+            x = cast(torch.Tensor, self.x)[index].float()
+            if self.labels is not None:
+                y, weights = self._unpack_labels(self.labels[index])
+            else:
+                y, weights = (
+                    cast(torch.Tensor, self.y)[index],
+                    cast(torch.Tensor, self.weights)[index],
+                )
+            return x, y, weights
+
+        rows = self.df.iloc[list(indices)]
+        return (
+            torch.from_numpy(self._stack_eo_data(rows[EO_DATA].to_list())),
+            torch.from_numpy(rows["is_crop"].to_numpy(dtype=np.float32)),
+            torch.from_numpy((~rows["is_local"]).to_numpy(dtype=np.float32)),
+        )
+
+    def __getitem__(
+        self, index: Union[int, Sequence[int]]
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        if not isinstance(index, (int, np.integer)):
+            # A batch of indices, e.g. from a BatchSampler (see batch_dataloader)
+            return self.get_batch(index)
+
+        if (self.cache) & (self.labels is not None):
+            y, weights = self._unpack_labels(cast(torch.Tensor, self.labels)[index])
+            return cast(torch.Tensor, self.x)[index].float(), y, weights
+        elif (self.cache) & (self.x is not None):
             # if we upsample, the caching might not have happened yet
             return (
                 cast(torch.Tensor, self.x)[index],
@@ -233,7 +381,7 @@ class CropDataset(Dataset):
         row = self.df.iloc[index]
 
         x = row[EO_DATA][self.start_month_index : self.start_month_index + self.input_months]
-        x = self._normalize(x)
+        x = self._normalize(self._select_bands(x))
 
         # If x is a partial time series, pad it to full length
         if x.shape[0] < self.input_months:
@@ -247,3 +395,164 @@ class CropDataset(Dataset):
             torch.tensor(crop_int).float(),
             torch.tensor(is_global).float(),
         )
+
+
+def batch_dataloader(
+    dataset: CropDataset,
+    sampler: Sampler,
+    batch_size: int,
+    drop_last: bool = False,
+    num_workers: int = 0,
+) -> DataLoader:
+    """
+    A DataLoader which passes batches of indices from the sampler to the dataset, so every
+    batch is assembled by a single CropDataset.get_batch call instead of collating
+    batch_size calls to __getitem__.
+    """
+    return DataLoader(
+        dataset,
+        sampler=BatchSampler(sampler, batch_size=batch_size, drop_last=drop_last),
+        batch_size=None,
+        num_workers=num_workers,
+    )
+
+
+class BalancedSampler(Sampler):
+    r"""
+    Samples every example of a dataset once, plus the upsampled examples a second time,
+    in a seeded random order that changes every epoch. This balances the classes without
+    duplicating the examples in the dataset.
+
+    :param num_examples: The number of examples in the dataset
+    :param upsampled_indices: The indices of the examples to sample an additional time
+    """
+
+    def __init__(self, num_examples: int, upsampled_indices: np.ndarray, seed: int = 42) -> None:
+        self.indices = torch.cat(
+            [torch.arange(num_examples), torch.as_tensor(upsampled_indices, dtype=torch.long)]
+        )
+        self.generator = torch.Generator()
+        self.generator.manual_seed(seed)
+
+    def __iter__(self) -> Iterator[int]:
+        order = torch.randperm(len(self.indices), generator=self.generator)
+        return iter(self.indices[order].tolist())
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+
+class StreamingCropDataset(IterableDataset):
+    r"""
+    Streams examples from compiled datasets (see eo_store.py) instead of keeping them in
+    memory. Every epoch the examples are split into chunks and the chunk order is shuffled
+    (seeded by seed + epoch), each DataLoader worker then reads a disjoint shard of the
+    chunks. Examples are shuffled within a buffer of shuffle_buffer_chunks chunks, so each
+    worker holds at most chunk_size * shuffle_buffer_chunks examples in memory.
+
+    The examples are identical to the ones served by CropDataset (without upsampling).
+
+    :param sources: Pairs of a compiled dataset and the row positions to use from it
+    """
+
+    def __init__(
+        self,
+        sources: List[Tuple[CompiledDataset, np.ndarray]],
+        target_bbox: BBox,
+        normalizing_dict: Optional[Dict],
+        start_month: str = "April",
+        probability_threshold: float = 0.5,
+        input_months: int = 12,
+        bands_to_use: Optional[List[int]] = None,
+        features: Optional[FeatureFunction] = DATASET_FEATURES,
+        chunk_size: int = 1024,
+        shuffle_buffer_chunks: int = 8,
+        seed: int = 42,
+    ) -> None:
+        self.sources = sources
+        self.target_bbox = target_bbox
+        self.normalizing_dict = normalizing_dict
+        self.start_month_index = MONTHS.index(start_month)
+        self.probability_threshold = probability_threshold
+        self.input_months = input_months
+        self.bands_to_use = bands_to_use
+        self.features = features
+        self.shuffle_buffer_chunks = shuffle_buffer_chunks
+        self.seed = seed
+        self.epoch = 0
+
+        self.chunks: List[Tuple[int, np.ndarray]] = [
+            (source_index, positions[i : i + chunk_size])
+            for source_index, (_, positions) in enumerate(sources)
+            for i in range(0, len(positions), chunk_size)
+        ]
+        self.num_examples = sum(len(positions) for _, positions in sources)
+
+    # Same band selection and normalization as the in memory dataset
+    def _select_bands(self, array: np.ndarray) -> np.ndarray:
+        return select_bands(array, self.bands_to_use)
+
+    def _normalize(self, array: np.ndarray) -> np.ndarray:
+        return normalize(array, self.normalizing_dict, self.bands_to_use)
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        return self.num_examples
+
+    def _load_chunk(
+        self, source_index: int, positions: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        compiled, _ = self.sources[source_index]
+        eo_data = np.asarray(compiled.eo_data[positions])
+        if self.features is not None:
+            eo_data = self.features(eo_data)
+
+        window = self._select_bands(
+            eo_data[:, self.start_month_index : self.start_month_index + self.input_months]
+        )
+        x = np.full((len(positions), self.input_months, window.shape[2]), np.nan)
+        x[:, : window.shape[1]] = window
+
+        # Partial time series are padded with nans
+        timesteps = compiled.metadata[TIMESTEPS].to_numpy()[positions]
+        x[np.arange(self.input_months) >= (timesteps - self.start_month_index)[:, None]] = np.nan
+
+        metadata = compiled.metadata.iloc[positions]
+        is_crop = metadata[CLASS_PROB] >= self.probability_threshold
+        is_local = (
+            (metadata[LAT] >= self.target_bbox.min_lat)
+            & (metadata[LAT] <= self.target_bbox.max_lat)
+            & (metadata[LON] >= self.target_bbox.min_lon)
+            & (metadata[LON] <= self.target_bbox.max_lon)
+        )
+        return (
+            self._normalize(x).astype(np.float32),
+            is_crop.to_numpy(dtype=np.float32),
+            (~is_local).to_numpy(dtype=np.float32),
+        )
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (
+            (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        )
+
+        # Every worker computes the same chunk order and takes its own shard of it
+        chunk_order = np.random.default_rng((self.seed, self.epoch)).permutation(len(self.chunks))
+        worker_chunks = [self.chunks[i] for i in chunk_order[worker_id::num_workers]]
+        rng = np.random.default_rng((self.seed, self.epoch, worker_id))
+
+        for buffer_start in range(0, len(worker_chunks), self.shuffle_buffer_chunks):
+            buffer = [
+                self._load_chunk(*chunk)
+                for chunk in worker_chunks[buffer_start : buffer_start + self.shuffle_buffer_chunks]
+            ]
+            x, y, weights = (np.concatenate(arrays) for arrays in zip(*buffer))
+            for i in rng.permutation(len(x)):
+                yield (
+                    torch.from_numpy(x[i]),
+                    torch.tensor(y[i]),
+                    torch.tensor(weights[i]),
+                )
@@ -0,0 +1,222 @@
+import hashlib
+import json
+import os
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from openmapflow.config import DATA_DIR, PROJECT_ROOT
+from openmapflow.constants import CLASS_PROB, END, EO_DATA, LAT, LON, START, SUBSET
+from openmapflow.labeled_dataset import LabeledDataset
+
+from .features import DATASET_FEATURES, FeatureFunction
+from .normalizing_stats import NormalizingStats
+
+COMPILED_DIR = PROJECT_ROOT / DATA_DIR / "compiled_datasets"
+
+# Columns kept alongside the compiled earth observation array
+METADATA_COLUMNS = [LAT, LON, START, END, CLASS_PROB, SUBSET]
+TIMESTEPS = "eo_timesteps"
+INDEX = "index"
+
+# Number of rows the features are applied to at a time (when a compiled dataset is loaded or
+# its normalizing statistics are calculated), so the compiled array is never read at once
+CHUNK_SIZE = 10000
+
+# (path, size, mtime) -> content hash, so a csv is only hashed once per process
+_file_hashes: Dict[Tuple[str, int, int], str] = {}
+
+
+def file_hash(path: Path) -> str:
+    """Returns the sha256 hash of the file contents"""
+    stat = path.stat()
+    key = (str(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        sha = hashlib.sha256()
+        with path.open("rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        _file_hashes[key] = sha.hexdigest()
+    return _file_hashes[key]
+
+
+@dataclass
+class CompiledDataset:
+    r"""
+    A labeled dataset compiled into a contiguous float32 earth observation array of
+    shape [N, timesteps, bands] and a columnar metadata table.
+
+    Rows with fewer timesteps than the longest row are padded with nans, the number of
+    valid timesteps per row is stored in the metadata table.
+    """
+
+    name: str
+    eo_data: np.ndarray
+    metadata: pd.DataFrame
+
+    def to_df(self, features: Optional[FeatureFunction] = None) -> pd.DataFrame:
+        """
+        Returns the metadata table with an eo_data column, each row of the eo_data
+        column is a view into the compiled array. If features is passed it is applied to
+        CHUNK_SIZE rows of the compiled array at a time and the rows are views into the
+        chunks, otherwise the views are memory-mapped.
+        """
+        df = self.metadata.drop(columns=[TIMESTEPS])
+        timesteps = self.metadata[TIMESTEPS].to_numpy()
+        rows: List[np.ndarray] = []
+        for start in range(0, len(df), CHUNK_SIZE):
+            eo_data = self.eo_data[start : start + CHUNK_SIZE]
+            if features is not None:
+                eo_data = features(np.asarray(eo_data))
+            rows.extend(row[:steps] for row, steps in zip(eo_data, timesteps[start:]))
+        df[EO_DATA] = rows
+        return df
+
+
+def _compiled_paths(name: str, csv_hash: str) -> Tuple[Path, Path]:
+    prefix = f"{name}.{csv_hash[:16]}"
+    return COMPILED_DIR / f"{prefix}.eo.npy", COMPILED_DIR / f"{prefix}.meta.npz"
+
+
+def _stats_path(name: str, csv_hash: str) -> Path:
+    return COMPILED_DIR / f"{name}.{csv_hash[:16]}.stats.json"
+
+
+def _tmp_path(path: Path) -> Path:
+    """A new, uniquely named, temporary file next to path with the same suffix"""
+    fd, tmp_path = tempfile.mkstemp(
+        dir=path.parent, prefix=f"{path.name}.", suffix=f".tmp{path.suffix}"
+    )
+    os.close(fd)
+    return Path(tmp_path)
+
+
+def _remove_stale_versions(name: str, csv_hash: str) -> None:
+    """
+    Removes the compiled files of other versions of the dataset csv. Temporary files are kept,
+    they may be written by a concurrent compile.
+    """
+    for path in COMPILED_DIR.glob(f"{name}.*"):
+        version = path.name[len(name) + 1 :].split(".")[0]
+        if ".tmp." not in path.name and version != csv_hash[:16]:
+            path.unlink(missing_ok=True)
+
+
+def compile_dataset(d: LabeledDataset) -> Tuple[Path, Path]:
+    """
+    Parses the dataset csv once and writes the compiled earth observation array and
+    metadata table, then removes the compiled files of other versions of the dataset csv.
+    """
+    csv_hash = file_hash(d.df_path)
+    eo_path, meta_path = _compiled_paths(d.name, csv_hash)
+
+    df = d.load_df(to_np=True, disable_tqdm=True)
+    timesteps = df[EO_DATA].apply(len).to_numpy()
+    num_bands = df[EO_DATA].iloc[0].shape[1] if len(df) > 0 else 0
+    eo_data = np.full((len(df), timesteps.max(initial=0), num_bands), np.nan, dtype=np.float32)
+    for i, array in enumerate(df[EO_DATA]):
+        eo_data[i, : len(array)] = array
+
+    COMPILED_DIR.mkdir(parents=True, exist_ok=True)
+
+    # Write to temporary files first so an interrupted compile is never picked up, the
+    # names are unique so concurrent compiles of the dataset do not write to the same files
+    tmp_eo_path = _tmp_path(eo_path)
+    tmp_meta_path = _tmp_path(meta_path)
+    np.save(tmp_eo_path, eo_data)
+    np.savez(
+        tmp_meta_path,
+        **{INDEX: df.index.to_numpy(), TIMESTEPS: timesteps},
+        **{
+            col: df[col].to_numpy(dtype=str if col in [START, END, SUBSET] else float)
+            for col in METADATA_COLUMNS
+        },
+    )
+    os.replace(tmp_eo_path, eo_path)
+    os.replace(tmp_meta_path, meta_path)
+
+    _remove_stale_versions(d.name, csv_hash)
+    return eo_path, meta_path
+
+
+def is_compiled(d: LabeledDataset) -> bool:
+    """Whether the current version of the dataset csv has been compiled"""
+    return all(path.exists() for path in _compiled_paths(d.name, file_hash(d.df_path)))
+
+
+def load_compiled_dataset(d: LabeledDataset) -> CompiledDataset:
+    """
+    Loads the compiled version of the dataset, the dataset is (re)compiled if the
+    content of its csv changed since it was last compiled.
+    """
+    eo_path, meta_path = _compiled_paths(d.name, file_hash(d.df_path))
+    if not is_compiled(d):
+        eo_path, meta_path = compile_dataset(d)
+
+    with np.load(meta_path) as meta:
+        metadata = pd.DataFrame(
+            {
+                col: meta[col].astype(object) if meta[col].dtype.kind == "U" else meta[col]
+                for col in METADATA_COLUMNS + [TIMESTEPS]
+            },
+            index=meta[INDEX],
+        )
+
+    return CompiledDataset(name=d.name, eo_data=np.load(eo_path, mmap_mode="r"), metadata=metadata)
+
+
+def calculate_normalizing_stats(
+    compiled: CompiledDataset,
+) -> Dict[Tuple[str, int], NormalizingStats]:
+    """
+    Calculates the normalizing statistics of a compiled dataset per (subset, start year).
+    As in Model.load_df, rows with a class_probability of 0.5 are excluded and the
+    DATASET_FEATURES are applied before the statistics are calculated.
+    """
+    metadata = compiled.metadata
+    timesteps = metadata[TIMESTEPS].to_numpy()
+    subsets = metadata[SUBSET].to_numpy()
+    years = pd.to_datetime(metadata[START]).dt.year.to_numpy()
+    keep = (metadata[CLASS_PROB] != 0.5).to_numpy()
+
+    stats: Dict[Tuple[str, int], NormalizingStats] = {}
+    for subset, year in sorted(set(zip(subsets[keep], years[keep]))):
+        rows = np.flatnonzero(keep & (subsets == subset) & (years == year))
+        group_stats = []
+        for i in range(0, len(rows), CHUNK_SIZE):
+            chunk = rows[i : i + CHUNK_SIZE]
+            eo_data = DATASET_FEATURES(np.asarray(compiled.eo_data[chunk]))
+            is_valid = np.arange(eo_data.shape[1]) < timesteps[chunk, None]
+            group_stats.append(NormalizingStats.from_array(eo_data[is_valid]))
+        stats[(str(subset), int(year))] = NormalizingStats.merge_all(group_stats)
+    return stats
+
+
+def has_normalizing_stats(d: LabeledDataset) -> bool:
+    """Whether the normalizing statistics of the current version of the dataset are stored"""
+    return _stats_path(d.name, file_hash(d.df_path)).exists()
+
+
+def load_normalizing_stats(d: LabeledDataset) -> Dict[Tuple[str, int], NormalizingStats]:
+    """
+    Loads the normalizing statistics of the dataset per (subset, start year), the
+    statistics are calculated once per version of the dataset csv.
+    """
+    stats_path = _stats_path(d.name, file_hash(d.df_path))
+    if not has_normalizing_stats(d):
+        stats = calculate_normalizing_stats(load_compiled_dataset(d))
+        tmp_stats_path = _tmp_path(stats_path)
+        with tmp_stats_path.open("w") as f:
+            json.dump({f"{k[0]}/{k[1]}": v.to_json() for k, v in stats.items()}, f)
+        os.replace(tmp_stats_path, stats_path)
+        return stats
+
+    with stats_path.open() as f:
+        stats_json = json.load(f)
+    return {
+        (k.split("/")[0], int(k.split("/")[1])): NormalizingStats.from_json(v)
+        for k, v in stats_json.items()
+    }
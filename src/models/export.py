@@ -0,0 +1,200 @@
+import inspect
+import json
+import time
+import warnings
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, TypeVar
+
+import numpy as np
+import torch
+from torch import nn
+
+from .lstm import replace_unrolled_lstms
+
+# Batch sizes (in pixels) the exported models are benchmarked at
+BENCHMARK_BATCH_SIZES = [1, 64, 1024]
+# Minimum number of timed forward passes per batch size, the median is recorded
+BENCHMARK_REPEATS = 20
+# The forward passes of a batch size are repeated for at least this many seconds, so the
+# median of the fast (small batch) passes is not dominated by timer and scheduling noise
+BENCHMARK_MIN_DURATION = 2.0
+
+# Maximum difference between the outputs of the optimized and the scripted model
+OPTIMIZED_TOLERANCE = 1e-5
+
+# The opset of the ONNX exports, the latest opset supported by torch 1.7
+ONNX_OPSET_VERSION = 12
+
+
+def benchmark_path(model_path: Path) -> Path:
+    """The benchmark of an exported model is stored next to it, e.g. {model_name}.benchmark.json"""
+    return model_path.with_suffix(".benchmark.json")
+
+
+def optimize_for_inference(
+    sm: torch.jit.ScriptModule, example: torch.Tensor, preserved_attrs: Sequence[str] = ()
+) -> Tuple[torch.jit.ScriptModule, bool]:
+    r"""
+    Freezes the scripted module (inlining its parameters and attributes, so the training
+    only branches are removed) and applies torch.jit.optimize_for_inference, where the
+    installed torch supports it. Returns the scripted module unchanged if the optimized
+    module cannot be built or its outputs differ from the scripted module on the example.
+
+    :param sm: The scripted module, in eval mode
+    :param example: An input used to check the optimized module
+    :param preserved_attrs: Attributes which are still needed on the exported module
+        (e.g. normalizing_dict_jit, which is read during inference)
+    :return: The (optimized) module, and whether it was optimized
+    """
+    if not hasattr(torch.jit, "freeze"):
+        print(f"torch {torch.__version__} cannot freeze modules, exporting the scripted model")
+        return sm, False
+
+    try:
+        optimized = torch.jit.freeze(sm, preserved_attrs=list(preserved_attrs))
+        if hasattr(torch.jit, "optimize_for_inference"):
+            optimized = torch.jit.optimize_for_inference(optimized)
+        with torch.no_grad():
+            matches = torch.allclose(
+                optimized(example), sm(example), atol=OPTIMIZED_TOLERANCE, rtol=0
+            )
+    except RuntimeError as e:
+        print(f"Optimizing the model failed, exporting the scripted model: {e}")
+        return sm, False
+
+    if not matches:
+        print("The optimized model differs from the scripted model, exporting the scripted model")
+        return sm, False
+    return optimized, True
+
+
+ModuleT = TypeVar("ModuleT", bound=nn.Module)
+
+
+def quantize_dynamic(model: ModuleT) -> ModuleT:
+    r"""
+    Quantizes the weights of the linear layers and LSTMs of the model to int8 (in place),
+    the activations are quantized on the fly during inference. The UnrolledLSTMs are
+    replaced by NativeLSTMs, since torch.nn.LSTM has a dynamically quantized version.
+    The quantized model only runs on CPU and is meant for inference only.
+    """
+    model.eval()
+    replace_unrolled_lstms(model)
+    torch.quantization.quantize_dynamic(
+        model, {nn.Linear, nn.LSTM}, dtype=torch.qint8, inplace=True
+    )
+    return model
+
+
+class InferenceModel(nn.Module):
+    r"""
+    Wraps a model to run on raw earth observation data, as returned by
+    openmapflow.engineer.process_test_file (all BANDS, not normalized). The bands_to_use
+    are selected and normalized (as in CropDataset) before the model is run, so exports of
+    this module need neither the bands nor the normalizing dict to be known at inference.
+    """
+
+    bands: torch.Tensor
+    mean: torch.Tensor
+    std: torch.Tensor
+
+    def __init__(
+        self,
+        model: nn.Module,
+        bands_to_use: Sequence[int],
+        normalizing_dict: Optional[Dict[str, np.ndarray]],
+    ) -> None:
+        super().__init__()
+        self.model = model
+
+        bands = list(bands_to_use)
+        mean, std = np.zeros(len(bands)), np.ones(len(bands))
+        if normalizing_dict is not None:
+            mean, std = normalizing_dict["mean"][bands], normalizing_dict["std"][bands]
+        self.register_buffer("bands", torch.tensor(bands, dtype=torch.long))
+        self.register_buffer("mean", torch.tensor(mean, dtype=torch.float32))
+        self.register_buffer("std", torch.tensor(std, dtype=torch.float32))
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x = torch.index_select(x, 2, self.bands)
+        return self.model((x - self.mean) / self.std)
+
+
+def export_onnx(model: nn.Module, onnx_path: Path, input_shape: Tuple[int, int]) -> None:
+    """
+    Exports the model (in eval mode) to ONNX, with a single input "x" of shape
+    [batch_size, timesteps, bands] and a single output "probability". The batch_size and
+    timesteps of the input are dynamic.
+
+    :param input_shape: The (timesteps, bands) of the example input the model is traced with
+    """
+    export_kwargs: Dict[str, Any] = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # Newer versions of torch default to the dynamo exporter, the models are exported
+        # with the TorchScript exporter (the only exporter of torch 1.7)
+        export_kwargs["dynamo"] = False
+    torch.onnx.export(
+        model,
+        (torch.randn(2, *input_shape),),
+        str(onnx_path),
+        input_names=["x"],
+        output_names=["probability"],
+        dynamic_axes={"x": {0: "batch_size", 1: "timesteps"}, "probability": {0: "batch_size"}},
+        opset_version=ONNX_OPSET_VERSION,
+        **export_kwargs,
+    )
+
+
+def benchmark(
+    model: Callable[[torch.Tensor], Any],
+    input_shape: Tuple[int, int],
+    batch_sizes: Sequence[int] = BENCHMARK_BATCH_SIZES,
+    repeats: int = BENCHMARK_REPEATS,
+    min_duration: float = BENCHMARK_MIN_DURATION,
+) -> Dict[str, float]:
+    """
+    Returns the number of pixels per second the model runs inference on, per batch size.
+
+    :param model: The model, or any function of a batch of pixels
+
+    :param input_shape: The (timesteps, bands) of a single pixel
+    :param repeats: The minimum number of timed forward passes per batch size
+    :param min_duration: The minimum time (in seconds) of the timed forward passes of a
+        batch size, more than repeats passes are timed if needed
+    """
+    pixels_per_second: Dict[str, float] = {}
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            x = torch.randn(batch_size, *input_shape)
+            model(x)  # warm up, the first passes of a scripted model are profiling runs
+            model(x)
+            durations: List[float] = []
+            while len(durations) < repeats or sum(durations) < min_duration:
+                start = time.perf_counter()
+                model(x)
+                durations.append(time.perf_counter() - start)
+            pixels_per_second[str(batch_size)] = round(
+                batch_size / sorted(durations)[len(durations) // 2], 1
+            )
+    return pixels_per_second
+
+
+def benchmark_export(
+    model_path: Path, input_shape: Tuple[int, int], min_duration: float = BENCHMARK_MIN_DURATION
+) -> Optional[Dict[str, float]]:
+    """Benchmarks the model exported to model_path, returns None if it cannot be loaded"""
+    if not model_path.exists():
+        return None
+    try:
+        model = torch.jit.load(str(model_path)).eval()
+    except RuntimeError as e:
+        warnings.warn(f"Could not load {model_path} to benchmark it: {e}")
+        return None
+    return benchmark(model, input_shape, min_duration=min_duration)
+
+
+def save_benchmark(model_path: Path, benchmark_info: Dict[str, Any]) -> None:
+    benchmark_info = {"torch_version": torch.__version__, **benchmark_info}
+    with benchmark_path(model_path).open("w") as f:
+        json.dump(benchmark_info, f, indent=4, sort_keys=True)
+        f.write("\n")
@@ -0,0 +1,66 @@
+import warnings
+from typing import Callable, List, Sequence
+
+import numpy as np
+from openmapflow.engineer import BANDS
+
+# A feature function maps a stacked [N, timesteps, bands] array to a
+# [N, timesteps, new bands] array
+FeatureFunction = Callable[[np.ndarray], np.ndarray]
+
+
+def select_bands(band_indices: Sequence[int]) -> FeatureFunction:
+    """Keeps only the bands at band_indices"""
+    indices = list(band_indices)
+
+    def feature(x: np.ndarray) -> np.ndarray:
+        return x[..., indices]
+
+    return feature
+
+
+def normalized_difference(
+    band_1: str, band_2: str, bands: Sequence[str] = BANDS
+) -> FeatureFunction:
+    r"""
+    Appends the normalized difference (band_1 - band_2) / (band_1 + band_2) as a new
+    band, where band_1 + band_2 <= 0 the index is 0 (as in openmapflow.engineer.calculate_ndvi).
+    E.g. NDVI is normalized_difference("B8", "B4")
+    """
+    index_1, index_2 = bands.index(band_1), bands.index(band_2)
+
+    def feature(x: np.ndarray) -> np.ndarray:
+        band_1_np, band_2_np = x[..., index_1], x[..., index_2]
+        with warnings.catch_warnings():
+            # where band_1 + band_2 == 0 the division is masked by np.where
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            index = np.where(
+                (band_1_np + band_2_np) > 0,
+                (band_1_np - band_2_np) / (band_1_np + band_2_np),
+                0,
+            )
+        return np.append(x, np.expand_dims(index, -1), axis=-1)
+
+    return feature
+
+
+class FeaturePipeline:
+    r"""
+    A sequence of feature functions applied as whole-array operations to the stacked
+    earth observation data of a dataset, instead of to every row individually.
+    """
+
+    def __init__(self, features: List[FeatureFunction]) -> None:
+        self.features = features
+
+    def __call__(self, x: np.ndarray) -> np.ndarray:
+        for feature in self.features:
+            x = feature(x)
+        return x
+
+
+# Applied to every labeled dataset when it is loaded: NDVI (the last band) is recomputed
+# from the raw bands. The normalizing statistics are calculated on the output of this pipeline.
+DATASET_FEATURES = FeaturePipeline(
+    [select_bands(range(len(BANDS) - 1)), normalized_difference("B8", "B4")]
+)
@@ -1,5 +1,5 @@
 from argparse import ArgumentParser, Namespace
-from typing import Any, Dict, List, Optional, Tuple, Type
+from typing import Any, Dict, List, Tuple, Type
 
 import pytorch_lightning as pl
 import torch
@@ -34,11 +34,14 @@ class Forecaster(pl.LightningModule):
     ) -> None:
         super().__init__()
         self.output_timesteps = output_timesteps
+        # The dropout mask is resampled every timestep, as it was when every timestep
+        # was passed through the lstm separately
         self.lstm = UnrolledLSTM(
             input_size=num_bands,
             hidden_size=hparams.forecasting_vector_size,
             dropout=hparams.forecasting_dropout,
             batch_first=True,
+            per_step_dropout=True,
         )
 
         self.to_bands = nn.Linear(
@@ -46,23 +49,20 @@ class Forecaster(pl.LightningModule):
         )
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        hidden_tuple: Optional[Tuple[torch.Tensor, torch.Tensor]] = None
-
         input_timesteps = x.shape[1]
         assert input_timesteps >= 1
 
-        output = torch.empty((1, 1, 1, 1))
-        predicted_output: List[torch.Tensor] = []
-        for i in range(input_timesteps):
-            # fmt: off
-            input = x[:, i: i + 1, :]
-            # fmt: on
-            output, hidden_tuple = self.lstm(input, hidden_tuple)
-            output = self.to_bands(torch.transpose(output[0, :, :, :], 0, 1))
-            predicted_output.append(output)
+        # The input timesteps are passed through the lstm in a single pass
+        output, hidden_tuple = self.lstm(x)
+        predicted_output: List[torch.Tensor] = [
+            torch.transpose(self.to_bands(output[:, 0, :, :]), 0, 1)
+        ]
 
         # we have already predicted the first output timestep (the last
-        # output of the loop above)
+        # output of the pass above), the remaining ones are predicted one at a time
+        # fmt: off
+        output = predicted_output[0][:, input_timesteps - 1:, :]
+        # fmt: on
         for i in range(self.output_timesteps - 1):
             output, hidden_tuple = self.lstm(output, hidden_tuple)
             output = self.to_bands(torch.transpose(output[0, :, :, :], 0, 1))
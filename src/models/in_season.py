@@ -0,0 +1,178 @@
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import torch
+from openmapflow.engineer import process_test_file
+
+from .export import InferenceModel
+from .forecaster import Forecaster
+from .model import Model
+
+# The LSTM states are persisted in half precision, which halves the size of the state of
+# a tile; the hidden states are in (-1, 1) and the cell states grow by at most 1 per month
+STATE_DTYPE = np.float16
+
+State = Tuple[torch.Tensor, torch.Tensor]
+
+
+@dataclass
+class InSeasonState:
+    r"""
+    The state of in-season inference on a tile after the first months_seen months of the
+    season: the hidden and cell states (of shape [num_pixels, hidden_size]) of the Forecaster
+    and Classifier LSTMs, and the coordinates of the pixels they belong to.
+    """
+
+    months_seen: int
+    forecaster_hidden: np.ndarray
+    forecaster_cell: np.ndarray
+    classifier_hidden: np.ndarray
+    classifier_cell: np.ndarray
+    lat: np.ndarray
+    lon: np.ndarray
+
+    def save(self, path: Path) -> None:
+        """Saves the state (LSTM states in STATE_DTYPE) to an npz file"""
+        tmp_path = path.with_suffix(".tmp.npz")
+        np.savez(
+            tmp_path,
+            months_seen=self.months_seen,
+            forecaster_hidden=self.forecaster_hidden.astype(STATE_DTYPE),
+            forecaster_cell=self.forecaster_cell.astype(STATE_DTYPE),
+            classifier_hidden=self.classifier_hidden.astype(STATE_DTYPE),
+            classifier_cell=self.classifier_cell.astype(STATE_DTYPE),
+            lat=self.lat,
+            lon=self.lon,
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "InSeasonState":
+        with np.load(path) as saved:
+            return cls(
+                months_seen=int(saved["months_seen"]),
+                forecaster_hidden=saved["forecaster_hidden"],
+                forecaster_cell=saved["forecaster_cell"],
+                classifier_hidden=saved["classifier_hidden"],
+                classifier_cell=saved["classifier_cell"],
+                lat=saved["lat"],
+                lon=saved["lon"],
+            )
+
+
+def _to_torch(hidden: np.ndarray, cell: np.ndarray) -> State:
+    # [num_pixels, hidden_size] -> [1, num_pixels, hidden_size], as used by UnrolledLSTM
+    return (
+        torch.from_numpy(hidden.astype(np.float32)).unsqueeze(0),
+        torch.from_numpy(cell.astype(np.float32)).unsqueeze(0),
+    )
+
+
+class InSeasonModel:
+    r"""
+    Runs a forecasting Model during the season, one month at a time. The Forecaster and
+    Classifier LSTM states after the months seen so far are kept (see InSeasonState), so
+    when the imagery of the next month arrives only that month is passed through the LSTMs;
+    the Forecaster then rolls out the rest of the season (up to input_months) and the
+    Classifier classifies the observed and forecasted months.
+
+    Once the first available_timesteps months are seen the predictions are those of
+    Model.forward on these months. As InferenceModel, takes raw earth observation data.
+    """
+
+    def __init__(self, model: Model) -> None:
+        if not isinstance(model.forecaster, Forecaster):
+            raise ValueError(f"{model.hparams.model_name} has no Forecaster to roll out the season")
+        if len(model.classifier.base) != 1:
+            raise ValueError("In-season inference needs a Classifier with a single base layer")
+
+        self.model = model.eval()
+        self.input_months = model.input_months
+        self.preprocess = InferenceModel(
+            torch.nn.Identity(), model.bands_to_use, model.normalizing_dict
+        )
+
+    def _rollout(
+        self, forecaster_state: State, classifier_state: State, remaining_months: int
+    ) -> torch.Tensor:
+        """Forecasts the rest of the season and returns the classifier's final hidden state"""
+        forecaster = self.model.forecaster
+        classifier_lstm = self.model.classifier.base[0]
+        for month in range(remaining_months):
+            # The forecast of the next month, as in Forecaster.forward
+            forecast = forecaster.to_bands(forecaster_state[0][0]).unsqueeze(1)
+            _, classifier_state = classifier_lstm(forecast, classifier_state)
+            if month < remaining_months - 1:
+                _, forecaster_state = forecaster.lstm(forecast, forecaster_state)
+        return classifier_state[0][0]
+
+    def update(
+        self, x: torch.Tensor, state: Optional[InSeasonState], lat: np.ndarray, lon: np.ndarray
+    ) -> Tuple[torch.Tensor, InSeasonState]:
+        r"""
+        Passes the new months of imagery through the LSTMs, continuing from the state of the
+        previous months (or from the start of the season if state is None).
+
+        :param x: The new months, of shape [num_pixels, new months, bands]
+        :param state: The state after the previous months
+        :param lat: The latitudes of the pixels, which have to match those of the state
+        :param lon: The longitudes of the pixels, which have to match those of the state
+        :return: The crop probabilities of the pixels ([num_pixels]) and the updated state
+        """
+        forecaster_state: Optional[State] = None
+        classifier_state: Optional[State] = None
+        months_seen = x.shape[1]
+        if state is not None:
+            if not (np.array_equal(state.lat, lat) and np.array_equal(state.lon, lon)):
+                raise ValueError("The pixels do not match the pixels of the in-season state")
+            forecaster_state = _to_torch(state.forecaster_hidden, state.forecaster_cell)
+            classifier_state = _to_torch(state.classifier_hidden, state.classifier_cell)
+            months_seen += state.months_seen
+        if months_seen > self.input_months:
+            raise ValueError(f"{months_seen} months seen, the season has {self.input_months}")
+
+        with torch.no_grad():
+            x = self.preprocess(x)
+            _, forecaster_state = self.model.forecaster.lstm(x, forecaster_state)
+            _, classifier_state = self.model.classifier.base[0](x, classifier_state)
+            hidden = self._rollout(
+                forecaster_state, classifier_state, self.input_months - months_seen
+            )
+
+            classifier = self.model.classifier
+            probabilities = torch.sigmoid(classifier.local_classifier(classifier.batchnorm(hidden)))
+
+        new_state = InSeasonState(
+            months_seen=months_seen,
+            forecaster_hidden=forecaster_state[0][0].numpy(),
+            forecaster_cell=forecaster_state[1][0].numpy(),
+            classifier_hidden=classifier_state[0][0].numpy(),
+            classifier_cell=classifier_state[1][0].numpy(),
+            lat=lat,
+            lon=lon,
+        )
+        return probabilities[:, 0], new_state
+
+    def run(self, local_path: Path, state_path: Path, dest_path: Optional[Path] = None):
+        """
+        Runs in-season inference on a tif file of the new month(s) of a tile, continuing
+        from (and then replacing) the state saved at state_path, if it exists.
+        Returns the predictions in the format of openmapflow.inference.Inference.run
+        """
+        x_np, flat_lat, flat_lon = process_test_file(local_path)
+        state = InSeasonState.load(state_path) if state_path.exists() else None
+        probabilities, new_state = self.update(
+            torch.from_numpy(x_np).float(), state, lat=flat_lat, lon=flat_lon
+        )
+        new_state.save(state_path)
+
+        predictions = pd.DataFrame(
+            data={"lat": flat_lat, "lon": flat_lon, "prediction_0": probabilities.numpy()}
+        ).set_index(["lat", "lon"])
+        if dest_path is not None:
+            predictions.to_xarray().to_netcdf(dest_path)
+        return predictions
@@ -1,5 +1,6 @@
 import math
-from typing import List, Optional, Tuple
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
 
 import torch
 from torch import nn
@@ -7,12 +8,20 @@ from torch import nn
 
 class UnrolledLSTM(nn.Module):
     def __init__(
-        self, input_size: int, hidden_size: int, dropout: float, batch_first: bool
+        self,
+        input_size: int,
+        hidden_size: int,
+        dropout: float,
+        batch_first: bool,
+        per_step_dropout: bool = False,
     ) -> None:
         super().__init__()
 
         self.batch_first = batch_first
         self.hidden_size = hidden_size
+        # By default the same dropout mask is used for every timestep of a sequence, if
+        # per_step_dropout is True a new mask is sampled for every timestep instead
+        self.per_step_dropout = per_step_dropout
 
         self.rnn = UnrolledLSTMCell(
             input_size=input_size, hidden_size=hidden_size, batch_first=batch_first
@@ -25,37 +34,121 @@ class UnrolledLSTM(nn.Module):
         sequence_length = x.shape[1] if self.batch_first else x.shape[0]
         batch_size = x.shape[0] if self.batch_first else x.shape[1]
 
+        # The states are [1, batch_size, hidden_size] outside of this function,
+        # inside of the loop they are kept as [batch_size, hidden_size]
         if state is None:
             # initialize to zeros
-            hidden, cell = (
-                torch.zeros(1, batch_size, self.hidden_size),
-                torch.zeros(1, batch_size, self.hidden_size),
-            )
-
-            if x.is_cuda:
-                hidden, cell = hidden.cuda(), cell.cuda()
+            hidden = torch.zeros(batch_size, self.hidden_size, dtype=x.dtype, device=x.device)
+            cell = torch.zeros(batch_size, self.hidden_size, dtype=x.dtype, device=x.device)
         else:
-            hidden, cell = state
+            hidden, cell = state[0][0], state[1][0]
+
+        # The input part of the gates does not depend on the previous timestep, so it
+        # is computed for the whole sequence at once; only the recurrence is sequential.
+        # It is computed time major, so the gates of every timestep are contiguous (and
+        # unbound, so the backward pass stacks their gradients once instead of per timestep)
+        if self.batch_first:
+            x = torch.transpose(x, 0, 1)
+        input_gates = self.rnn.input_to_gates(x.contiguous()).unbind(0)
 
         outputs = []
         for i in range(sequence_length):
-            input_x = x[:, i, :].unsqueeze(1)
-            _, (hidden, cell) = self.rnn(input_x, (hidden, cell))
-            outputs.append(hidden)
+            hidden, cell = self.rnn.step(input_gates[i], hidden, cell)
+            outputs.append(hidden.unsqueeze(0))
 
-            if self.training and (i == 0):
+            if self.training and (i == 0 or self.per_step_dropout):
                 self.dropout.update_mask(hidden.shape, hidden.is_cuda)
 
             hidden = self.dropout(hidden)
 
-        return torch.stack(outputs, dim=0), (hidden, cell)
+        return torch.stack(outputs, dim=0), (hidden.unsqueeze(0), cell.unsqueeze(0))
+
+
+class NativeLSTM(nn.Module):
+    """
+    An UnrolledLSTM in eval mode (where the variational dropout does nothing) is a
+    standard LSTM. This runs it with torch.nn.LSTM's kernels instead of a Python loop,
+    with the same inputs and outputs as UnrolledLSTM. Used for inference, see native_lstms.
+    """
+
+    def __init__(self, input_size: int, hidden_size: int, batch_first: bool) -> None:
+        super().__init__()
+
+        self.batch_first = batch_first
+        self.hidden_size = hidden_size
+
+        self.lstm = nn.LSTM(input_size=input_size, hidden_size=hidden_size, batch_first=batch_first)
+
+    @classmethod
+    def from_unrolled(cls, unrolled: "UnrolledLSTM") -> "NativeLSTM":
+        native = cls(
+            input_size=unrolled.rnn.input_size,
+            hidden_size=unrolled.hidden_size,
+            batch_first=unrolled.batch_first,
+        )
+        # The gates of UnrolledLSTMCell are already in torch.nn.LSTM order, its single
+        # bias is the input bias
+        with torch.no_grad():
+            native.lstm.weight_ih_l0.copy_(unrolled.rnn.input_to_gates.weight)
+            native.lstm.weight_hh_l0.copy_(unrolled.rnn.hidden_to_gates.weight)
+            native.lstm.bias_ih_l0.copy_(unrolled.rnn.input_to_gates.bias)
+            native.lstm.bias_hh_l0.zero_()
+        return native
+
+    def forward(
+        self, x: torch.Tensor, state: Optional[Tuple[torch.Tensor, torch.Tensor]] = None
+    ) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        outputs, (hidden, cell) = self.lstm(x, state)
+        if self.batch_first:
+            outputs = torch.transpose(outputs, 0, 1)
+        # [timesteps, 1, batch_size, hidden_size], as returned by UnrolledLSTM
+        return outputs.unsqueeze(1), (hidden, cell)
+
+
+def replace_unrolled_lstms(model: nn.Module) -> List[Tuple[nn.Module, str, "UnrolledLSTM"]]:
+    """
+    Replaces every UnrolledLSTM in the model with an equivalent NativeLSTM, returns
+    the replaced UnrolledLSTMs as (parent module, attribute name, UnrolledLSTM).
+    """
+    replaced = [
+        (parent, name, child)
+        for parent in model.modules()
+        for name, child in parent.named_children()
+        if isinstance(child, UnrolledLSTM)
+    ]
+    for parent, name, child in replaced:
+        setattr(parent, name, NativeLSTM.from_unrolled(child))
+    return replaced
+
+
+@contextmanager
+def native_lstms(model: nn.Module) -> Iterator[nn.Module]:
+    """
+    Temporarily replaces every UnrolledLSTM in the model with an equivalent NativeLSTM,
+    e.g. to export the model for inference. The UnrolledLSTMs are restored on exit.
+    """
+    replaced = replace_unrolled_lstms(model)
+    try:
+        yield model
+    finally:
+        for parent, name, child in replaced:
+            setattr(parent, name, child)
 
 
 class UnrolledLSTMCell(nn.Module):
     """An unrolled LSTM, so that dropout can be applied between
     timesteps instead of between layers
+
+    The gates are the sum of an input projection (input_to_gates) and a hidden
+    state projection (hidden_to_gates), whose output is split into the update
+    (input), forget, candidate and output gates, in that (torch.nn.LSTM) order.
     """
 
+    # Gates of the gate projections, in order, and the layers they were computed by
+    # before they were fused (used to load and initialize the projections as before)
+    GATES = ["update_gate", "forget_gate", "update_candidates", "output_gate"]
+    LEGACY_GATE_ORDER = ["forget_gate", "update_gate", "update_candidates", "output_gate"]
+
     def __init__(self, input_size: int, hidden_size: int, batch_first: bool) -> None:
         super().__init__()
 
@@ -63,59 +156,72 @@ class UnrolledLSTMCell(nn.Module):
         self.hidden_size = hidden_size
         self.batch_first = batch_first
 
-        self.forget_gate = nn.Sequential(
-            *[
-                nn.Linear(
-                    in_features=input_size + hidden_size,
-                    out_features=hidden_size,
-                    bias=True,
-                ),
-                nn.Sigmoid(),
-            ]
-        )
-
-        self.update_gate = nn.Sequential(
-            *[
-                nn.Linear(
-                    in_features=input_size + hidden_size,
-                    out_features=hidden_size,
-                    bias=True,
-                ),
-                nn.Sigmoid(),
-            ]
+        self.input_to_gates = nn.Linear(
+            in_features=input_size, out_features=4 * hidden_size, bias=True
         )
-
-        self.update_candidates = nn.Sequential(
-            *[
-                nn.Linear(
-                    in_features=input_size + hidden_size,
-                    out_features=hidden_size,
-                    bias=True,
-                ),
-                nn.Tanh(),
-            ]
-        )
-
-        self.output_gate = nn.Sequential(
-            *[
-                nn.Linear(
-                    in_features=input_size + hidden_size,
-                    out_features=hidden_size,
-                    bias=True,
-                ),
-                nn.Sigmoid(),
-            ]
+        self.hidden_to_gates = nn.Linear(
+            in_features=hidden_size, out_features=4 * hidden_size, bias=False
         )
 
-        self.cell_state_activation = nn.Tanh()
-
         self.initialize_weights()
 
+    def _gate_rows(self, gate: str) -> slice:
+        start = self.GATES.index(gate) * self.hidden_size
+        return slice(start, start + self.hidden_size)
+
     def initialize_weights(self):
         sqrt_k = math.sqrt(1 / self.hidden_size)
-        for parameters in self.parameters():
-            for pam in parameters:
-                nn.init.uniform_(pam.data, -sqrt_k, sqrt_k)
+        # Gate by gate in the order of the legacy layers (whose weight rows spanned the
+        # input and the hidden state), so a seeded cell is initialized as before
+        for gate in self.LEGACY_GATE_ORDER:
+            rows = self._gate_rows(gate)
+            for input_row, hidden_row in zip(
+                self.input_to_gates.weight.data[rows], self.hidden_to_gates.weight.data[rows]
+            ):
+                row = nn.init.uniform_(
+                    torch.empty(self.input_size + self.hidden_size), -sqrt_k, sqrt_k
+                )
+                input_row.copy_(row[: self.input_size])
+                hidden_row.copy_(row[self.input_size :])
+            for pam in self.input_to_gates.bias.data[rows]:
+                nn.init.uniform_(pam, -sqrt_k, sqrt_k)
+
+    def _load_from_state_dict(
+        self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs
+    ):
+        # Models saved before the gates were fused have one linear layer per gate
+        # ({gate}.0.weight and {gate}.0.bias), these are concatenated in the fused order
+        if f"{prefix}forget_gate.0.weight" in state_dict:
+            for param in ["weight", "bias"]:
+                state_dict[f"{prefix}gates.{param}"] = torch.cat(
+                    [state_dict.pop(f"{prefix}{gate}.0.{param}") for gate in self.GATES]
+                )
+        # Models saved before the projections were split have a single gates layer
+        # applied to the concatenated input and hidden state
+        if f"{prefix}gates.weight" in state_dict:
+            weight = state_dict.pop(f"{prefix}gates.weight")
+            state_dict[f"{prefix}input_to_gates.weight"] = weight[:, : self.input_size]
+            state_dict[f"{prefix}hidden_to_gates.weight"] = weight[:, self.input_size :]
+            state_dict[f"{prefix}input_to_gates.bias"] = state_dict.pop(f"{prefix}gates.bias")
+        super()._load_from_state_dict(
+            state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs
+        )
+
+    def step(
+        self, input_gates: torch.Tensor, hidden: torch.Tensor, cell: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        A single timestep given the input projection of the timestep (input_to_gates)
+        and the [batch_size, hidden_size] states, returns the updated states
+        """
+        gates = torch.addmm(input_gates, hidden, self.hidden_to_gates.weight.t())
+        update_state, forget_state, cell_candidates, output_state = gates.chunk(4, dim=-1)
+
+        updated_cell = (torch.sigmoid(forget_state) * cell) + (
+            torch.sigmoid(update_state) * torch.tanh(cell_candidates)
+        )
+        updated_hidden = torch.sigmoid(output_state) * torch.tanh(updated_cell)
+        return updated_hidden, updated_cell
 
     def forward(
         self, x: torch.Tensor, state: Tuple[torch.Tensor, torch.Tensor]
@@ -125,14 +231,7 @@ class UnrolledLSTMCell(nn.Module):
         if self.batch_first:
             hidden, cell = torch.transpose(hidden, 0, 1), torch.transpose(cell, 0, 1)
 
-        forget_state = self.forget_gate(torch.cat((x, hidden), dim=-1))
-        update_state = self.update_gate(torch.cat((x, hidden), dim=-1))
-        cell_candidates = self.update_candidates(torch.cat((x, hidden), dim=-1))
-
-        updated_cell = (forget_state * cell) + (update_state * cell_candidates)
-
-        output_state = self.output_gate(torch.cat((x, hidden), dim=-1))
-        updated_hidden = output_state * self.cell_state_activation(updated_cell)
+        updated_hidden, updated_cell = self.step(self.input_to_gates(x), hidden, cell)
 
         if self.batch_first:
             updated_hidden = torch.transpose(updated_hidden, 0, 1)
@@ -0,0 +1,94 @@
+from typing import Dict, Optional
+
+import torch
+
+# Number of equal width bins of the predicted probabilities used to compute the ROC AUC, pairs
+# of a crop and non crop prediction in the same bin are counted as ties
+ROC_AUC_BINS = 10000
+
+
+class StreamingMetrics:
+    r"""
+    Accumulates the metrics of the predictions over the batches of an evaluation, so its
+    memory does not grow with the size of the evaluation set: the confusion counts at the
+    probability threshold, and a histogram of the predicted probabilities of each class from
+    which the ROC AUC is computed.
+
+    The counts are kept on the device of the predictions and are only moved to the host by
+    compute, so updating does not synchronize the device.
+
+    :param num_bins: The number of bins of the histograms used for the ROC AUC
+    """
+
+    def __init__(self, num_bins: int = ROC_AUC_BINS) -> None:
+        self.num_bins = num_bins
+        # [label, predicted label] and [label, bin], as float64 so they can be weighted
+        self.confusion: Optional[torch.Tensor] = None
+        self.histogram: Optional[torch.Tensor] = None
+
+    def reset(self) -> None:
+        self.confusion = None
+        self.histogram = None
+
+    def update(
+        self,
+        preds: torch.Tensor,
+        labels: torch.Tensor,
+        threshold: float,
+        weights: Optional[torch.Tensor] = None,
+    ) -> None:
+        """
+        :param preds: The predicted probabilities, of shape [batch_size]
+        :param labels: The binary labels, of shape [batch_size]
+        :param threshold: Probabilities above the threshold are predicted as crop
+        :param weights: Weights of the predictions of shape [batch_size], e.g. a 0/1 mask of
+            the predictions to use. If None all predictions are used
+        """
+        preds = preds.detach().reshape(-1)
+        labels = (labels.detach().reshape(-1) > 0.5).long()
+        if weights is None:
+            weights = torch.ones_like(preds)
+        weights = weights.detach().reshape(-1).double()
+
+        if self.confusion is None or self.histogram is None:
+            self.confusion = torch.zeros(4, dtype=torch.float64, device=preds.device)
+            self.histogram = torch.zeros(
+                2 * self.num_bins, dtype=torch.float64, device=preds.device
+            )
+
+        predicted = (preds > threshold).long()
+        self.confusion += torch.bincount(2 * labels + predicted, weights=weights, minlength=4)
+
+        bins = (preds * self.num_bins).long().clamp(0, self.num_bins - 1)
+        self.histogram += torch.bincount(
+            labels * self.num_bins + bins, weights=weights, minlength=2 * self.num_bins
+        )
+
+    def compute(self) -> Dict[str, float]:
+        """The metrics of the predictions so far, the same metrics as sklearn would give"""
+        if self.confusion is None or self.histogram is None:
+            return {}
+        tn, fp, fn, tp = self.confusion.cpu().tolist()
+        total = tn + fp + fn + tp
+        if total == 0:
+            # sometimes this happens in the warmup
+            return {}
+
+        output_dict: Dict[str, float] = {}
+        negatives, positives = self.histogram.cpu().reshape(2, self.num_bins)
+        num_negatives, num_positives = float(negatives.sum()), float(positives.sum())
+        # Only one class may be seen when lightning does its warm up on a subset of the
+        # validation data
+        if num_negatives > 0 and num_positives > 0:
+            # The probability that a crop prediction is ranked above a non crop
+            # prediction, counting the pairs in the same bin as ties
+            negatives_below = torch.cumsum(negatives, dim=0) - negatives
+            auc = (positives * (negatives_below + negatives / 2)).sum()
+            output_dict["roc_auc_score"] = float(auc) / (num_negatives * num_positives)
+
+        # As sklearn with zero_division=0
+        output_dict["precision_score"] = tp / (tp + fp) if tp + fp > 0 else 0.0
+        output_dict["recall_score"] = tp / (tp + fn) if tp + fn > 0 else 0.0
+        output_dict["f1_score"] = 2 * tp / (2 * tp + fp + fn) if tp > 0 else 0.0
+        output_dict["accuracy"] = (tp + tn) / total
+        return output_dict
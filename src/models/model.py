@@ -1,6 +1,11 @@
 import json
 import random
 from argparse import ArgumentParser, Namespace
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from itertools import repeat
+from pathlib import Path
 from typing import Any, Callable, Dict, List, Optional, Tuple, Type, Union
 
 import numpy as np
@@ -10,24 +15,45 @@ import torch
 from openmapflow.bands import ERA5_BANDS, S1_BANDS
 from openmapflow.bbox import BBox
 from openmapflow.config import DATA_DIR, PROJECT_ROOT, DataPaths
-from openmapflow.constants import CLASS_PROB, EO_DATA, SUBSET
-from openmapflow.engineer import BANDS, calculate_ndvi
-from sklearn.metrics import (
-    accuracy_score,
-    f1_score,
-    precision_score,
-    recall_score,
-    roc_auc_score,
-)
+from openmapflow.constants import CLASS_PROB, MONTHS, START, SUBSET
+from openmapflow.engineer import BANDS
+from openmapflow.labeled_dataset import LabeledDataset
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, SequentialSampler
 
 from datasets import datasets
 from src.bboxes import bboxes
 
+from .checkpoint_writer import AsyncCheckpointWriter
 from .classifier import Classifier
-from .data import CropDataset
+from .compilation import CompiledModule
+from .data import CropDataset, StreamingCropDataset, batch_dataloader
+from .eo_store import (
+    CompiledDataset,
+    file_hash,
+    has_normalizing_stats,
+    is_compiled,
+    load_compiled_dataset,
+    load_normalizing_stats,
+)
+from .export import (
+    InferenceModel,
+    benchmark_export,
+    export_onnx,
+    optimize_for_inference,
+    save_benchmark,
+)
+from .features import DATASET_FEATURES
 from .forecaster import Forecaster
+from .lstm import native_lstms
+from .metrics import StreamingMetrics
+from .normalizing_stats import NormalizingStats
+from .tensor_cache import load_tensors, save_tensors, tensor_cache_key
+
+# Maximum number of dataset frames kept in memory by _load_dataset_df
+DATASET_CACHE_SIZE = 32
+
+datasets_by_name = {d.name: d for d in datasets}
 
 
 def set_seed(seed: int = 42):
@@ -36,6 +62,26 @@ def set_seed(seed: int = 42):
     random.seed(seed)
 
 
+@lru_cache(maxsize=DATASET_CACHE_SIZE)
+def _load_dataset_df(name: str, csv_hash: str) -> pd.DataFrame:
+    """
+    Loads a single dataset with the DATASET_FEATURES (recomputed NDVI) applied. The result
+    is memoized by dataset name and csv hash, so each dataset is only loaded once per
+    process (e.g. across the Model.load_df calls made by a training run, or across
+    evaluated checkpoints). The returned frame is shared, callers must not modify it in place.
+    """
+    return load_compiled_dataset(datasets_by_name[name]).to_df(features=DATASET_FEATURES)
+
+
+def _prepare_dataset(name: str, normalizing_stats: bool) -> None:
+    # Run in a worker process by Model.prepare_datasets, datasets are passed by name
+    # since LabeledDatasets are not necessarily picklable
+    d = datasets_by_name[name]
+    load_compiled_dataset(d)
+    if normalizing_stats:
+        load_normalizing_stats(d)
+
+
 class Model(pl.LightningModule):
     r"""
     An model for annual and in-season crop mapping. This model consists of a
@@ -63,6 +109,24 @@ class Model(pl.LightningModule):
     :param hparams.cache: Whether to load all the data into memory during training. Default = True
     :param hparams.upsample: Whether to oversample the under-represented class so that each class
         is equally represented in the training and validation dataset. Default = True
+    :param hparams.cache_dtype: The dtype of the cached inputs, "float16" or "bfloat16" halve
+        the memory used by the cache, the labels are then packed into a single byte. The cached
+        tensors are upcast to float32 when they are served. Default = "float32"
+    :param hparams.stream: Whether to stream the training data from the compiled datasets
+        instead of loading it into memory. Default = False
+    :param hparams.num_workers: The number of DataLoader workers for the training data.
+        Default = 0
+    :param hparams.num_load_workers: The number of processes used to compile (parse) the
+        datasets which have not been compiled yet, 1 compiles them serially. Default = 1
+    :param hparams.shared_cache: Whether to share the cached training and evaluation tensors
+        between runs on the same machine, e.g. the trials of a sweep, through memory-mapped files
+        in /dev/shm (see tensor_cache.py). Only used if hparams.cache is True. Default = False
+    :param hparams.val_check_interval: How often to validate the model during training, as a
+        fraction of the training epoch (<= 1) or a number of training batches (> 1). The validation
+        metrics are accumulated over the batches (see metrics.py), so validating often is
+        cheap. Default = 1.0
+    :param hparams.compile: Whether to run the forecaster and classifier through torch.compile
+        during training and (non exported) inference, see compilation.py. Default = False
     :param hparams.target_bbox_key: The key to the bbox in bounding_box.py which determines which
         data is local and which is global
     :param hparams.train_datasets: A list of the datasets to use for training.
@@ -109,6 +173,7 @@ class Model(pl.LightningModule):
                 all_dataset_params = json.load(f)
 
         self.input_months = self.hparams.input_months
+        self.num_load_workers = hparams.num_load_workers if "num_load_workers" in hparams else 1
         self.up_to_year = hparams.up_to_year if "up_to_year" in hparams else None
         self.start_month = hparams.start_month if "start_month" in hparams else "April"
 
@@ -118,28 +183,50 @@ class Model(pl.LightningModule):
         if self.up_to_year:
             normalizing_dict_key += f"_{self.up_to_year}"
 
+        self.normalizing_dict_key = normalizing_dict_key
         if normalizing_dict_key not in all_dataset_params:
-            train_dataset = self.get_dataset(subset="training", cache=False, upsample=False)
-            val_dataset = self.get_dataset(
-                subset="validation",
-                cache=False,
-                upsample=False,
-                normalizing_dict=train_dataset.normalizing_dict,
+            # The normalizing dict is merged from statistics stored once per dataset,
+            # so a new combination of datasets does not require rescanning the
+            # earth observation data
+            normalizing_dict = self.merge_normalizing_stats(
+                hparams.train_datasets,
+                hparams.eval_datasets,
+                self.up_to_year,
+                num_workers=self.num_load_workers,
+            ).to_normalizing_dict()
+
+            # Only the start and end dates are needed to compute the number of timesteps
+            train_df = self.load_df(
+                "training",
+                hparams.train_datasets,
+                hparams.eval_datasets,
+                eo_data=False,
+                num_workers=self.num_load_workers,
             )
+            if self.up_to_year is not None:
+                train_df = train_df[pd.to_datetime(train_df[START]).dt.year <= self.up_to_year]
+            val_df = self.load_df(
+                "validation",
+                hparams.train_datasets,
+                hparams.eval_datasets,
+                eo_data=False,
+                num_workers=self.num_load_workers,
+            )
+            start_month_index = MONTHS.index(self.start_month)
+
             # we save the normalizing dict because we calculate weighted
             # normalization values based on the datasets we combine.
             # The number of instances per dataset (and therefore the weights) can
             # vary between the train / test / val sets - this ensures the normalizing
             # dict stays constant between them
-            if train_dataset.normalizing_dict is None:
-                raise ValueError("Normalizing dict must be calculated using dataset.")
-
             all_dataset_params[normalizing_dict_key] = {
-                "train_num_timesteps": train_dataset.num_timesteps,
-                "val_num_timesteps": val_dataset.num_timesteps,
-                "normalizing_dict": {
-                    k: v.tolist() for k, v in train_dataset.normalizing_dict.items()
-                },
+                "train_num_timesteps": CropDataset.compute_num_timesteps(
+                    train_df, start_month_index, self.input_months
+                ),
+                "val_num_timesteps": CropDataset.compute_num_timesteps(
+                    val_df, start_month_index, self.input_months
+                ),
+                "normalizing_dict": {k: v.tolist() for k, v in normalizing_dict.items()},
             }
 
             with all_dataset_params_path.open("w") as f:
@@ -180,44 +267,174 @@ class Model(pl.LightningModule):
         self.global_loss_function: Callable = F.binary_cross_entropy
         self.local_loss_function: Callable = F.binary_cross_entropy
 
+        # Set with --compile, used in place of the forecaster and classifier unless scripted
+        self.compiled_forecaster: Optional[CompiledModule] = None
+        self.compiled_classifier: Optional[CompiledModule] = None
+        if "compile" in hparams and hparams.compile:
+            if isinstance(self.forecaster, Forecaster):
+                self.compiled_forecaster = CompiledModule(self.forecaster, "forecaster")
+            self.compiled_classifier = CompiledModule(self.classifier, "classifier")
+
+        # The metrics of the local predictions, accumulated over the batches of an evaluation
+        self.val_metrics = StreamingMetrics()
+        self.test_metrics = StreamingMetrics()
+
+        # Writes the checkpoints of the lowest val loss in the background, see
+        # validation_epoch_end. train_model waits for it once training is done
+        self.checkpoint_writer = AsyncCheckpointWriter()
+
         # Used during training to track lowest val loss
         self.val_losses: List[float] = []
 
+        # Set by train_dataloader if the training data is streamed
+        self.streaming_train_dataset: Optional[StreamingCropDataset] = None
+
+    def _select_bands(self, x: torch.Tensor) -> torch.Tensor:
+        # Datasets built by get_dataset only contain the bands_to_use already,
+        # raw inputs (e.g. during inference) contain all bands
+        if x.shape[2] != len(self.bands_to_use):
+            x = x[:, :, self.bands_to_use]
+        return x
+
+    @torch.jit.unused
+    def _compiled_forecast(self, x: torch.Tensor) -> torch.Tensor:
+        # Exports trace the eager modules
+        if self.compiled_forecaster is None or torch.jit.is_tracing():
+            return self.forecaster(x)
+        return self.compiled_forecaster(x)
+
+    @torch.jit.unused
+    def _compiled_classify(
+        self, x: torch.Tensor, mask: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self.compiled_classifier is None or torch.jit.is_tracing():
+            return self.classifier(x, mask)
+        return self.compiled_classifier(x, mask)
+
+    def _forecast(self, x: torch.Tensor) -> torch.Tensor:
+        if not torch.jit.is_scripting():
+            return self._compiled_forecast(x)
+        return self.forecaster(x)
+
+    def _classify(
+        self, x: torch.Tensor, mask: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if not torch.jit.is_scripting():
+            return self._compiled_classify(x, mask)
+        return self.classifier(x, mask)
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        x = x[:, :, self.bands_to_use]
+        x = self._select_bands(x)
         if self.forecast_eval_data:
             x_input = x[:, : self.available_timesteps, :]
-            x_forecasted = self.forecaster(x_input)[:, self.available_timesteps - 1 :, :]
+            x_forecasted = self._forecast(x_input)[:, self.available_timesteps - 1 :, :]
             x = torch.cat((x_input, x_forecasted), dim=1)
-        _, local_preds = self.classifier(x)
+        _, local_preds = self._classify(x)
         return local_preds
 
     def configure_optimizers(self):
         return torch.optim.Adam(self.parameters(), lr=self.hparams.learning_rate)
 
     @staticmethod
-    def load_df(subset: str, train_datasets: str, eval_datasets: str) -> pd.DataFrame:
+    def datasets_to_load(
+        subset: str, train_datasets: str, eval_datasets: str
+    ) -> List[Tuple[LabeledDataset, bool]]:
         """
-        Loads the datasets specified in the input_dataset_names list.
+        Returns the datasets to load for the subset, together with whether only the rows
+        of that subset should be taken out of the dataset.
         """
-        dfs = []
+        to_load: List[Tuple[LabeledDataset, bool]] = []
         for d in datasets:
             # If dataset is used for evaluation, take only the right subset out of the dataframe
             if d.name in eval_datasets.split(","):
-                df = d.load_df(to_np=True, disable_tqdm=True)
-                dfs.append(df[(df[SUBSET] == subset) & (df[CLASS_PROB] != 0.5)])
+                to_load.append((d, True))
 
             # If dataset is only used for training, take the whole dataframe
             elif subset == "training" and d.name in train_datasets.split(","):
-                df = d.load_df(to_np=True, disable_tqdm=True)
+                to_load.append((d, False))
+        return to_load
+
+    @staticmethod
+    def prepare_datasets(
+        to_prepare: List[LabeledDataset], num_workers: int, normalizing_stats: bool = False
+    ) -> None:
+        """
+        Compiles the datasets (parsing their csvs) and, if normalizing_stats is True,
+        calculates their normalizing statistics in num_workers processes. Datasets which
+        are already prepared are skipped. If num_workers <= 1, or the process pool cannot
+        be used, nothing is done here and the datasets are prepared serially on loading.
+        """
+        names = [
+            d.name
+            for d in to_prepare
+            if not is_compiled(d) or (normalizing_stats and not has_normalizing_stats(d))
+        ]
+        if num_workers <= 1 or len(names) <= 1:
+            return
+
+        try:
+            with ProcessPoolExecutor(max_workers=min(num_workers, len(names))) as executor:
+                list(executor.map(_prepare_dataset, names, repeat(normalizing_stats)))
+        except (OSError, NotImplementedError, BrokenProcessPool) as e:
+            print(f"Preparing datasets in parallel failed, falling back to serial: {e}")
+
+    @staticmethod
+    def load_df(
+        subset: str,
+        train_datasets: str,
+        eval_datasets: str,
+        eo_data: bool = True,
+        num_workers: int = 1,
+    ) -> pd.DataFrame:
+        """
+        Loads the datasets specified in the input_dataset_names list.
+        The earth observation data is read from the compiled (memory-mapped) version
+        of each dataset, see eo_store.py, and memoized per process. If eo_data is False
+        only the metadata columns are loaded. Datasets which are not compiled yet are
+        compiled by num_workers processes, the datasets are always concatenated in the
+        order of the datasets list.
+        """
+        to_load = Model.datasets_to_load(subset, train_datasets, eval_datasets)
+        Model.prepare_datasets([d for d, _ in to_load], num_workers)
+
+        dfs = []
+        for d, subset_only in to_load:
+            if eo_data:
+                df = _load_dataset_df(d.name, file_hash(d.df_path))
+            else:
+                df = load_compiled_dataset(d).metadata
+
+            if subset_only:
+                dfs.append(df[(df[SUBSET] == subset) & (df[CLASS_PROB] != 0.5)])
+            else:
                 dfs.append(df[df[CLASS_PROB] != 0.5])
 
-        big_df = pd.concat(dfs)
+        return pd.concat(dfs)
+
+    @staticmethod
+    def merge_normalizing_stats(
+        train_datasets: str,
+        eval_datasets: str,
+        up_to_year: Optional[int] = None,
+        num_workers: int = 1,
+    ) -> NormalizingStats:
+        """
+        Merges the per dataset normalizing statistics of the training data that
+        Model.load_df would load for the given datasets.
+        """
+        to_load = Model.datasets_to_load("training", train_datasets, eval_datasets)
+        Model.prepare_datasets([d for d, _ in to_load], num_workers, normalizing_stats=True)
 
-        # Recompute NDVI
-        big_df[EO_DATA] = big_df[EO_DATA].apply(lambda x: calculate_ndvi(x[:, : len(BANDS) - 1]))
+        stats: List[NormalizingStats] = []
+        for d, subset_only in to_load:
+            for (subset, year), dataset_stats in load_normalizing_stats(d).items():
+                if subset_only and subset != "training":
+                    continue
+                if up_to_year is not None and year > up_to_year:
+                    continue
+                stats.append(dataset_stats)
 
-        return big_df
+        return NormalizingStats.merge_all(stats)
 
     def get_dataset(
         self,
@@ -226,71 +443,149 @@ class Model(pl.LightningModule):
         cache: Optional[bool] = None,
         upsample: Optional[bool] = None,
     ) -> CropDataset:
-        df = self.load_df(subset, self.hparams.train_datasets, self.hparams.eval_datasets)
+        cache = self.hparams.cache if cache is None else cache
+        cache_dtype = self.hparams.cache_dtype if "cache_dtype" in self.hparams else "float32"
+        cache_key: Optional[str] = None
+        cached_tensors = None
+        shared_cache = "shared_cache" in self.hparams and self.hparams.shared_cache
+        if cache and shared_cache and normalizing_dict is not None:
+            cache_key = self.tensor_cache_key(subset, normalizing_dict, cache_dtype)
+            cached_tensors = load_tensors(cache_key)
+
+        # If the tensors are cached only the metadata is needed to build the dataset
+        df = self.load_df(
+            subset,
+            self.hparams.train_datasets,
+            self.hparams.eval_datasets,
+            eo_data=cached_tensors is None,
+            num_workers=self.num_load_workers,
+        )
 
-        return CropDataset(
+        dataset = CropDataset(
             subset=subset,
             df=df,
             normalizing_dict=normalizing_dict,
-            cache=self.hparams.cache if cache is None else cache,
+            cache=cache,
             upsample=upsample if upsample is not None else self.hparams.upsample,
             target_bbox=self.target_bbox,
             up_to_year=self.up_to_year,
             wandb_logger=self.logger,
             start_month=self.start_month,
             input_months=self.input_months,
+            bands_to_use=self.bands_to_use,
+            cached_tensors=cached_tensors,
+            cache_dtype=getattr(torch, cache_dtype),
+        )
+        if cache_key is not None and cached_tensors is None:
+            save_tensors(cache_key, dataset.get_cached_tensors())
+        return dataset
+
+    def tensor_cache_key(self, subset: str, normalizing_dict: Dict, cache_dtype: str) -> str:
+        """
+        The key of the subset's tensors in the shared tensor cache. The csv hash of every
+        loaded dataset is part of the key, so changed datasets are never served stale.
+        """
+        csv_hashes = {
+            d.name: file_hash(d.df_path)
+            for d, _ in self.datasets_to_load(
+                subset, self.hparams.train_datasets, self.hparams.eval_datasets
+            )
+        }
+        return tensor_cache_key(
+            subset=subset,
+            csv_hashes=csv_hashes,
+            normalizing_dict_key=self.normalizing_dict_key,
+            normalizing_dict={k: np.asarray(v).tolist() for k, v in normalizing_dict.items()},
+            start_month=self.start_month,
+            input_months=self.input_months,
+            up_to_year=self.up_to_year,
+            bands_to_use=self.bands_to_use,
+            target_bbox=self.target_bbox,
+            probability_threshold=self.hparams.probability_threshold,
+            # a compact dataset shares its upcast tensors, which differ from the float32 ones
+            cache_dtype=cache_dtype,
+        )
+
+    def get_streaming_dataset(self, subset: str, normalizing_dict: Dict) -> StreamingCropDataset:
+        """
+        Streams the subset from the compiled datasets instead of loading it into memory.
+        """
+        to_load = self.datasets_to_load(
+            subset, self.hparams.train_datasets, self.hparams.eval_datasets
+        )
+        self.prepare_datasets([d for d, _ in to_load], self.num_load_workers)
+
+        sources: List[Tuple[CompiledDataset, np.ndarray]] = []
+        for d, subset_only in to_load:
+            compiled = load_compiled_dataset(d)
+            metadata = compiled.metadata
+            condition = metadata[CLASS_PROB] != 0.5
+            if subset_only:
+                condition &= metadata[SUBSET] == subset
+            if subset == "training" and self.up_to_year is not None:
+                condition &= pd.to_datetime(metadata[START]).dt.year <= self.up_to_year
+            sources.append((compiled, np.flatnonzero(condition.to_numpy())))
+
+        return StreamingCropDataset(
+            sources=sources,
+            target_bbox=self.target_bbox,
+            normalizing_dict=normalizing_dict,
+            start_month=self.start_month,
+            input_months=self.input_months,
+            bands_to_use=self.bands_to_use,
+            seed=self.hparams.seed if "seed" in self.hparams else 42,
         )
 
     def train_dataloader(self):
-        return DataLoader(
-            self.get_dataset(
-                subset="training",
-                normalizing_dict=self.normalizing_dict,
-                upsample=self.hparams.upsample,
-            ),
-            shuffle=True,
+        num_workers = self.hparams.num_workers if "num_workers" in self.hparams else 0
+        if "stream" in self.hparams and self.hparams.stream:
+            self.streaming_train_dataset = self.get_streaming_dataset(
+                subset="training", normalizing_dict=self.normalizing_dict
+            )
+            return DataLoader(
+                self.streaming_train_dataset,
+                batch_size=self.hparams.batch_size,
+                drop_last=True,
+                num_workers=num_workers,
+            )
+
+        train_dataset = self.get_dataset(
+            subset="training",
+            normalizing_dict=self.normalizing_dict,
+            upsample=self.hparams.upsample,
+        )
+        return batch_dataloader(
+            train_dataset,
+            sampler=train_dataset.sampler(seed=self.hparams.seed if "seed" in self.hparams else 42),
             batch_size=self.hparams.batch_size,
             drop_last=True,
+            num_workers=num_workers,
         )
 
+    def on_epoch_start(self):
+        # Reshuffle the streamed training data differently every epoch
+        if self.streaming_train_dataset is not None:
+            self.streaming_train_dataset.set_epoch(self.current_epoch)
+
     def val_dataloader(self):
-        return DataLoader(
-            self.get_dataset(
-                subset="validation",
-                normalizing_dict=self.normalizing_dict,
-                upsample=False,
-            ),
-            batch_size=self.hparams.batch_size,
+        dataset = self.get_dataset(
+            subset="validation",
+            normalizing_dict=self.normalizing_dict,
+            upsample=False,
+        )
+        return batch_dataloader(
+            dataset, sampler=SequentialSampler(dataset), batch_size=self.hparams.batch_size
         )
 
     def test_dataloader(self):
-        return DataLoader(
-            self.get_dataset(
-                subset="testing",
-                normalizing_dict=self.normalizing_dict,
-                upsample=False,
-            ),
-            batch_size=self.hparams.batch_size,
+        dataset = self.get_dataset(
+            subset="testing",
+            normalizing_dict=self.normalizing_dict,
+            upsample=False,
+        )
+        return batch_dataloader(
+            dataset, sampler=SequentialSampler(dataset), batch_size=self.hparams.batch_size
         )
-
-    def _output_metrics(self, preds: np.ndarray, labels: np.ndarray) -> Dict[str, float]:
-        if len(preds) == 0:
-            # sometimes this happens in the warmup
-            return {}
-
-        output_dict: Dict[str, float] = {}
-        if not (labels == labels[0]).all():
-            # This can happen when lightning does its warm up on a subset of the
-            # validation data
-            output_dict["roc_auc_score"] = roc_auc_score(labels, preds)
-
-        preds = (preds > self.hparams.probability_threshold).astype(int)
-
-        output_dict["precision_score"] = precision_score(labels, preds, zero_division=0)
-        output_dict["recall_score"] = recall_score(labels, preds, zero_division=0)
-        output_dict["f1_score"] = f1_score(labels, preds, zero_division=0)
-        output_dict["accuracy"] = accuracy_score(labels, preds)
-        return output_dict
 
     def add_noise(self, x: torch.Tensor, training: bool) -> torch.Tensor:
         if (self.hparams.noise_factor == 0) or (not training):
@@ -307,77 +602,74 @@ class Model(pl.LightningModule):
         # noise_per_timesteps = noise.repeat(x.shape[0], 1)
         return x + noise
 
+    @staticmethod
+    def _masked_mean(values: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        """The mean of the values where mask is nonzero (0 if it is zero everywhere)"""
+        mask = mask.to(values.dtype)
+        return (values * mask).sum() / mask.sum().clamp(min=1)
+
     def _compute_forecaster_loss(
         self, y_true: torch.Tensor, y_forecast: torch.Tensor
     ) -> torch.Tensor:
         """
         Computes the loss for the forecaster
-        If y_true contains nans, then all values other then nans are used for the loss
+        If y_true contains nans, then all values other then nans are used for the loss:
+        the time series without nans contribute all their timesteps (the full loss) and the
+        time series with nans the timesteps which have no nans in any time series (the partial
+        loss). The mean over these values is the mean of the full and partial losses, weighted
+        by their number of timesteps (w_full and w_partial). This is computed with fixed shape
+        tensors, so it does not depend on which values are nans.
         """
-
         y_nans = torch.isnan(y_true)
+        nan_batch_index = y_nans.any(dim=2).any(dim=1)
+        nan_month_index = y_nans.any(dim=2).any(dim=0)
 
-        # If there is no nans in the batch compute forecaster loss as usual
-        if y_nans.any().item() is False:
-            return self.forecaster_loss(y_true, y_forecast)
-
-        nan_batch_index = y_nans.any(dim=1).any(dim=1)
-        nan_month_index = y_nans.any(dim=0).any(dim=1)
-
-        partial_shape = (-1, sum(~nan_month_index), y_true.shape[2])
-        y_true_partial = y_true[nan_batch_index][:, ~nan_month_index].reshape(partial_shape)
-        y_forecast_partial = y_forecast[nan_batch_index][:, ~nan_month_index].reshape(partial_shape)
-        assert bool(torch.all(torch.isnan(y_forecast_partial))) is False
-        loss_partial = self.forecaster_loss(y_forecast_partial, y_true_partial)
-
-        # If the batch contains time series with only nans, then return only the partial loss
-        if nan_batch_index.all():
-            assert y_forecast_partial.shape[0] == y_forecast.shape[0]
-            return loss_partial
-
-        # Otherwise the batch contains time series with at least one non nan value
-        # Compute combined loss
-        full_shape = (-1, y_true.shape[1], y_true.shape[2])
-        y_true_full = y_true[~nan_batch_index].reshape(full_shape)
-        y_forecast_full = y_forecast[~nan_batch_index].reshape(full_shape)
-        assert y_forecast_full.shape[0] + y_forecast_partial.shape[0] == y_forecast.shape[0]
-        assert y_forecast_full[0].shape == y_true_full[0].shape
-        assert bool(torch.all(torch.isnan(y_forecast_full))) is False
-
-        total_full_timesteps = y_forecast_full.shape[0] * y_forecast_full.shape[1]
-        total_partial_timesteps = y_forecast_partial.shape[0] * y_forecast_partial.shape[1]
-        w_full = total_full_timesteps / (total_full_timesteps + total_partial_timesteps)
-        w_partial = total_partial_timesteps / (total_full_timesteps + total_partial_timesteps)
-        loss_full = self.forecaster_loss(y_forecast_full, y_true_full)
-        return (w_full * loss_full) + (w_partial * loss_partial)
+        mask = ~nan_batch_index[:, None, None] | ~nan_month_index[None, :, None]
+        # The nans are replaced so they do not propagate through the (masked) gradient
+        y_true = torch.where(y_nans, torch.zeros_like(y_true), y_true)
+        loss = self.forecaster_loss(y_forecast, y_true, reduction="none")
+        return self._masked_mean(loss, mask.expand_as(loss))
 
     def _split_preds_and_get_loss(
-        self, batch, add_preds: bool, loss_label: str, log_loss: bool, training: bool
+        self,
+        batch,
+        loss_label: str,
+        log_loss: bool,
+        training: bool,
+        metrics: Optional[StreamingMetrics] = None,
     ) -> Dict:
         x, label, is_global = batch
 
-        # TODO: Reconcile below with forward()
-        x = x[:, :, self.bands_to_use]
+        x = self._select_bands(x)
 
-        loss: Union[float, torch.Tensor] = 0
+        loss = torch.zeros((), device=x.device)
         output_dict: Dict[str, Union[float, torch.Tensor, Dict]] = {}
 
+        # The time series used by the classifier losses, the batch is masked instead of indexed
+        # so the shape of the tensors does not depend on the values of the batch
+        sample_mask = torch.ones_like(label)
+        # The time series the batch statistics of the classifier's BatchNorms are computed
+        # from, if not all of them (see Classifier.forward)
+        batchnorm_mask: Optional[torch.Tensor] = None
+
         if self.forecast_eval_data or (training and self.forecast_training_data):
             # -------------------------------------------------------------------------------
             # Forecast
             # -------------------------------------------------------------------------------
+            # available_timesteps is the length of the shortest time series of the datasets,
+            # so the input to the forecaster contains no nans
             input_to_encode = x[:, : self.available_timesteps, :]
-            assert (
-                torch.isnan(input_to_encode).any().item() is False
-            ), "Forecast input contains nans"
-            encoder_output = self.forecaster(input_to_encode)
+            encoder_output = self._forecast(input_to_encode)
 
             # -------------------------------------------------------------------------------
-            # Compute loss
+            # Compute loss (only for batches without partial time series)
             # -------------------------------------------------------------------------------
-            x_has_nans = torch.isnan(x).any().item()
-            if not x_has_nans:
-                loss = self._compute_forecaster_loss(y_true=x[:, 1:, :], y_forecast=encoder_output)
+            x_nans = torch.isnan(x)
+            x_has_nans = x_nans.any()
+            forecaster_loss = self._compute_forecaster_loss(
+                y_true=x[:, 1:, :], y_forecast=encoder_output
+            )
+            loss = torch.where(x_has_nans, torch.zeros_like(forecaster_loss), forecaster_loss)
 
             # -------------------------------------------------------------------------------
             # Create a full time series by concatenating ground truth with the forecast
@@ -401,22 +693,21 @@ class Model(pl.LightningModule):
             # Set the input to the classifier (x) using the forecasted values
             # -------------------------------------------------------------------------------
             if training:
-                # Use the original AND forecasted time series to train
-                if x_has_nans:
-                    # Use forecasted time series and the original full time series if available
-                    nan_batch_index = torch.isnan(x).any(dim=1).any(dim=1)
-                    x_full_time_series_w_noise = self.add_noise(
-                        x[~nan_batch_index], training=training
-                    )
-                    assert bool(torch.any(torch.isnan(x_full_time_series_w_noise))) is False
-                    x = torch.cat((x_full_time_series_w_noise, final_encoded_input), dim=0)
-                    label = torch.cat((label[~nan_batch_index], label), dim=0)
-                    is_global = torch.cat((is_global[~nan_batch_index], is_global), dim=0)
-                else:
-                    # Use forecasted time series and original full time series for training
-                    x = torch.cat((x, final_encoded_input), dim=0)
-                    label = torch.cat((label, label), dim=0)
-                    is_global = torch.cat((is_global, is_global), dim=0)
+                # Use the original AND forecasted time series to train. The partial original
+                # time series are zero filled and masked out of the losses and of the batch
+                # statistics of the BatchNorms, so the batch is classified as if they were
+                # left out. The original time series are noised only if some of them are
+                # partial; the noise is drawn from a fork of the random number generator, so
+                # batches without partial time series draw the same random numbers either way
+                nan_batch_index = x_nans.any(dim=2).any(dim=1)
+                with torch.random.fork_rng(devices=[]):
+                    x = torch.where(x_has_nans, self.add_noise(x, training), x)
+                x = torch.where(x_nans, torch.zeros_like(x), x)
+                x = torch.cat((x, final_encoded_input), dim=0)
+                sample_mask = torch.cat(((~nan_batch_index).to(label.dtype), sample_mask), dim=0)
+                batchnorm_mask = sample_mask
+                label = torch.cat((label, label), dim=0)
+                is_global = torch.cat((is_global, is_global), dim=0)
 
             else:
                 # Use only the forecasted time series for evaluation
@@ -425,67 +716,66 @@ class Model(pl.LightningModule):
         else:
             x = self.add_noise(x, training=training)
 
-        org_global_preds, local_preds = self.classifier(x)
-        global_preds = org_global_preds[is_global != 0]
-        global_labels = label[is_global != 0]
-
-        local_preds = local_preds[is_global == 0]
-        local_labels = label[is_global == 0]
+        org_global_preds, org_local_preds = self._classify(x, batchnorm_mask)
+        local_mask = (is_global == 0).to(label.dtype) * sample_mask
+        global_mask = (is_global != 0).to(label.dtype) * sample_mask
 
-        if local_preds.shape[0] > 0:
-            local_loss = self.local_loss_function(
-                local_preds.squeeze(-1),
-                local_labels,
-            )
-            loss += local_loss
+        local_loss = self.local_loss_function(org_local_preds.squeeze(-1), label, reduction="none")
+        loss = loss + self._masked_mean(local_loss, local_mask)
 
-        if global_preds.shape[0] > 0:
-            global_loss = self.global_loss_function(
-                global_preds.squeeze(-1),
-                global_labels,
-            )
-
-            num_local_labels = local_preds.shape[0]
-            if num_local_labels == 0:
-                alpha = 1
-            else:
-                ratio = global_preds.shape[0] / num_local_labels
-                alpha = ratio / self.hparams.alpha
-            loss += alpha * global_loss
+        global_loss = self.global_loss_function(
+            org_global_preds.squeeze(-1), label, reduction="none"
+        )
+        # The global loss is weighted by the ratio of global to local labels, or 1 if the batch
+        # has no local labels
+        num_local_labels = local_mask.sum()
+        ratio = global_mask.sum() / num_local_labels.clamp(min=1)
+        alpha = torch.where(
+            num_local_labels > 0, ratio / self.hparams.alpha, torch.ones_like(ratio)
+        )
+        loss = loss + alpha * self._masked_mean(global_loss, global_mask)
 
         output_dict[loss_label] = loss
         if log_loss:
             output_dict["log"] = {loss_label: loss}
-        if add_preds:
-            output_dict.update(
-                {
-                    "global_pred": global_preds,
-                    "global_label": global_labels,
-                    "local_pred": local_preds,
-                    "local_label": local_labels,
-                }
+        if metrics is not None:
+            metrics.update(
+                org_local_preds,
+                label,
+                threshold=self.hparams.probability_threshold,
+                weights=local_mask,
             )
         return output_dict
 
     def training_step(self, batch, batch_idx):
         return self._split_preds_and_get_loss(
-            batch, add_preds=False, loss_label="loss", log_loss=True, training=True
+            batch, loss_label="loss", log_loss=True, training=True
         )
 
     def validation_step(self, batch, batch_idx):
         return self._split_preds_and_get_loss(
-            batch, add_preds=True, loss_label="val_loss", log_loss=True, training=False
+            batch,
+            loss_label="val_loss",
+            log_loss=True,
+            training=False,
+            metrics=self.val_metrics,
         )
 
     def test_step(self, batch, batch_idx):
         return self._split_preds_and_get_loss(
-            batch, add_preds=True, loss_label="test_loss", log_loss=True, training=False
+            batch,
+            loss_label="test_loss",
+            log_loss=True,
+            training=False,
+            metrics=self.test_metrics,
         )
 
-    def _interpretable_metrics(self, outputs, input_prefix: str) -> Dict:
-        preds = torch.cat([x[f"{input_prefix}pred"] for x in outputs]).detach().cpu().numpy()
-        labels = torch.cat([x[f"{input_prefix}label"] for x in outputs]).detach().cpu().numpy()
-        return self._output_metrics(preds, labels)
+    @staticmethod
+    def _interpretable_metrics(metrics: StreamingMetrics) -> Dict[str, float]:
+        # The metrics of the local predictions of the evaluation, which is then reset
+        output_dict = metrics.compute()
+        metrics.reset()
+        return output_dict
 
     def validation_epoch_end(self, outputs):
         avg_loss = torch.stack([x["val_loss"] for x in outputs]).mean()
@@ -495,24 +785,28 @@ class Model(pl.LightningModule):
             "epoch": self.current_epoch,
             "val_loss_min": min(self.val_losses),
         }
-        metrics = self._interpretable_metrics(outputs, "local_")
+        metrics = self._interpretable_metrics(self.val_metrics)
         logs.update(metrics)
 
         # Save model with lowest validation loss
         model_ckpt_path = PROJECT_ROOT / DataPaths.MODELS / f"{self.hparams.model_name}.ckpt"
+        checkpoint_exists = model_ckpt_path.exists() or self.checkpoint_writer.is_pending(
+            model_ckpt_path
+        )
         save_model_condition = self.current_epoch > 0 and (
-            not model_ckpt_path.exists() or (self.val_losses[-1] == min(self.val_losses[1:]))
+            not checkpoint_exists or (self.val_losses[-1] == min(self.val_losses[1:]))
         )
         if save_model_condition:
             saved_metrics = {f"{k}_saved": v for k, v in metrics.items()}
             logs.update(saved_metrics)
-            self.trainer.save_checkpoint(model_ckpt_path)
+            # As trainer.save_checkpoint, written in the background
+            self.checkpoint_writer.save(self.trainer.dump_checkpoint(), model_ckpt_path)
         return {"log": logs}
 
     def test_epoch_end(self, outputs):
         avg_loss = torch.stack([x["test_loss"] for x in outputs]).mean().item()
         output_dict = {"test_loss": avg_loss}
-        output_dict.update(self._interpretable_metrics(outputs, "local_"))
+        output_dict.update(self._interpretable_metrics(self.test_metrics))
         return {"progress_bar": output_dict}
 
     @staticmethod
@@ -541,12 +835,96 @@ class Model(pl.LightningModule):
         parser.add_argument("--do_not_upsample", dest="upsample", action="store_false")
         parser.set_defaults(upsample=True)
 
+        # Streams the training data from disk instead of loading it into memory,
+        # cache and upsample are not used for the streamed training data
+        parser.add_argument("--stream", dest="stream", action="store_true")
+        parser.set_defaults(stream=False)
+        parser.add_argument("--num_workers", type=int, default=0)
+        # Number of processes used to compile datasets, 1 compiles them serially
+        parser.add_argument("--num_load_workers", type=int, default=1)
+
+        # Stores the cached x in reduced precision (and the labels in a single byte)
+        parser.add_argument(
+            "--cache_dtype", type=str, default="float32", choices=["float32", "float16", "bfloat16"]
+        )
+
+        # Shares the cached tensors between runs on the same machine (e.g. sweep trials)
+        parser.add_argument("--shared_cache", dest="shared_cache", action="store_true")
+        parser.set_defaults(shared_cache=False)
+
+        # Exports the model with int8 weights if its f1 score and accuracy (validation and
+        # test) drop at most by quantization_tolerance, see pipeline_funcs.run_quantized_evaluation
+        parser.add_argument("--quantize", dest="quantize", action="store_true")
+        parser.set_defaults(quantize=False)
+        parser.add_argument("--quantization_tolerance", type=float, default=0.01)
+
+        # How often to validate, as in pl.Trainer: a fraction of the training epoch (<= 1) or a
+        # number of training batches (> 1)
+        parser.add_argument("--val_check_interval", type=float, default=1.0)
+
+        # Runs the forecaster and classifier through torch.compile (torch >= 2.0), falling
+        # back to eager execution where they cannot be compiled
+        parser.add_argument("--compile", dest="compile", action="store_true")
+        parser.set_defaults(compile=False)
+
         classifier_parser = Classifier.add_model_specific_args(parser)
         return Forecaster.add_model_specific_args(classifier_parser)
 
-    def save(self):
-        sm = torch.jit.script(self)
+    def save(self, optimize: bool = True):
+        """
+        Exports the model for inference to {model_name}.pt. If optimize is True the
+        exported model is frozen and optimized for inference (see export.py).
+
+        The export is benchmarked (in pixels per second) together with the previous export
+        of the model, on the same machine, and the numbers are stored next to the export
+        in {model_name}.benchmark.json, so slower exports can be refused on deploy.
+        """
+        # The saved model is used for inference, where the LSTMs can run as torch.nn.LSTMs
+        with native_lstms(self):
+            sm: torch.jit.ScriptModule = torch.jit.script(self)
+        sm.eval()
+
+        input_shape = (self.input_months, len(BANDS))
+        optimized = False
+        if optimize:
+            sm, optimized = optimize_for_inference(
+                sm, example=torch.randn(2, *input_shape), preserved_attrs=["normalizing_dict_jit"]
+            )
+
         model_path = PROJECT_ROOT / DataPaths.MODELS / f"{self.hparams.model_name}.pt"
+        previous_pixels_per_second = benchmark_export(model_path, input_shape)
         if model_path.exists():
             model_path.unlink()
         sm.save(str(model_path))
+
+        save_benchmark(
+            model_path,
+            {
+                "optimized": optimized,
+                "pixels_per_second": benchmark_export(model_path, input_shape),
+                "previous_pixels_per_second": previous_pixels_per_second,
+            },
+        )
+
+    def save_onnx(self, onnx_path: Optional[Path] = None) -> Path:
+        """
+        Exports the model for inference to onnx_path ({model_name}.onnx by default), with
+        the bands_to_use selection and the normalization folded in: the exported model takes
+        the raw earth observation data (as returned by openmapflow.engineer.process_test_file),
+        see src/onnx_inference.py
+        """
+        if onnx_path is None:
+            onnx_path = PROJECT_ROOT / DataPaths.MODELS / f"{self.hparams.model_name}.onnx"
+        # torch.onnx.export restores the mode of the exported module recursively, so the
+        # mode of the model is restored after the export of the (eval mode) wrapper
+        training = self.training
+        try:
+            with native_lstms(self):
+                export_onnx(
+                    InferenceModel(self, self.bands_to_use, self.normalizing_dict).eval(),
+                    onnx_path,
+                    input_shape=(self.input_months, len(BANDS)),
+                )
+        finally:
+            self.train(training)
+        return onnx_path
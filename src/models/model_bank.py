@@ -0,0 +1,272 @@
+from typing import List, Optional, Sequence, Tuple, cast
+
+import numpy as np
+import torch
+from openmapflow.config import PROJECT_ROOT, DataPaths
+from torch import nn
+
+from .forecaster import Forecaster
+from .lstm import NativeLSTM, UnrolledLSTM
+from .model import Model
+
+# Maximum number of (model, pixel) rows a ModelBank processes at a time, larger batches are
+# split so the stacked activations of all models stay about the size of a single model's
+ROWS_PER_CHUNK = 1024
+
+# The hparams which have to be equal for models to be stacked in a ModelBank
+ARCHITECTURE_HPARAMS = [
+    "classifier_vector_size",
+    "classifier_base_layers",
+    "num_local_layers",
+    "multi_headed",
+    "forecasting_vector_size",
+]
+
+
+def _stack(tensors: Sequence[torch.Tensor]) -> torch.Tensor:
+    return torch.stack([t.detach().float() for t in tensors])
+
+
+class StackedLinear(nn.Module):
+    """N linear layers, applied to an input of shape [N, ..., in_features]"""
+
+    weight: torch.Tensor
+    bias: torch.Tensor
+
+    def __init__(self, layers: Sequence[nn.Linear]) -> None:
+        super().__init__()
+        # [N, in_features, out_features]
+        self.register_buffer("weight", _stack([layer.weight.t() for layer in layers]))
+        biases = [
+            layer.bias if layer.bias is not None else torch.zeros(layer.out_features)
+            for layer in layers
+        ]
+        self.register_buffer("bias", _stack(biases))
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        shape = x.shape
+        x = torch.baddbmm(self.bias.unsqueeze(1), x.reshape(shape[0], -1, shape[-1]), self.weight)
+        return x.reshape(*shape[:-1], -1)
+
+
+class StackedBatchNorm(nn.Module):
+    """N BatchNorm1d layers in eval mode, applied to an input of shape [N, batch_size, features]"""
+
+    scale: torch.Tensor
+    shift: torch.Tensor
+
+    def __init__(self, layers: Sequence[nn.BatchNorm1d]) -> None:
+        super().__init__()
+        scales, shifts = [], []
+        for layer in layers:
+            scale = 1 / torch.sqrt(layer.running_var + layer.eps)
+            if layer.affine:
+                scale = scale * layer.weight
+            shift = -layer.running_mean * scale
+            if layer.affine:
+                shift = shift + layer.bias
+            scales.append(scale)
+            shifts.append(shift)
+        self.register_buffer("scale", _stack(scales).unsqueeze(1))
+        self.register_buffer("shift", _stack(shifts).unsqueeze(1))
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return x * self.scale + self.shift
+
+
+class StackedLSTM(nn.Module):
+    r"""
+    N LSTMs (UnrolledLSTMs in eval mode or NativeLSTMs) of the same size, applied to an
+    input of shape [N, batch_size, timesteps, input_size]. Returns the hidden states of all
+    timesteps ([N, batch_size, timesteps, hidden_size]) and the final (hidden, cell) state
+    ([N, batch_size, hidden_size] each).
+    """
+
+    weight_ih: torch.Tensor
+    weight_hh: torch.Tensor
+    bias: torch.Tensor
+
+    def __init__(self, lstms: Sequence[nn.Module]) -> None:
+        super().__init__()
+        weights_ih: List[torch.Tensor] = []
+        weights_hh: List[torch.Tensor] = []
+        biases: List[torch.Tensor] = []
+        for lstm in lstms:
+            if isinstance(lstm, UnrolledLSTM):
+                weights_ih.append(lstm.rnn.input_to_gates.weight)
+                weights_hh.append(lstm.rnn.hidden_to_gates.weight)
+                biases.append(lstm.rnn.input_to_gates.bias)
+            elif isinstance(lstm, NativeLSTM):
+                weight_ih, weight_hh, bias_ih, bias_hh = lstm.lstm.all_weights[0]
+                weights_ih.append(weight_ih)
+                weights_hh.append(weight_hh)
+                biases.append(bias_ih + bias_hh)
+            else:
+                raise ValueError(f"Cannot stack {type(lstm).__name__}")
+        self.hidden_size = weights_hh[0].shape[1]
+        # [N, input_size, 4 * hidden_size] and [N, hidden_size, 4 * hidden_size]
+        self.register_buffer("weight_ih", _stack([w.t() for w in weights_ih]))
+        self.register_buffer("weight_hh", _stack([w.t() for w in weights_hh]))
+        self.register_buffer("bias", _stack(biases))
+
+    def forward(
+        self, x: torch.Tensor, state: Optional[Tuple[torch.Tensor, torch.Tensor]] = None
+    ) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        num_models, batch_size, timesteps, _ = x.shape
+        if state is None:
+            hidden = x.new_zeros(num_models, batch_size, self.hidden_size)
+            cell = x.new_zeros(num_models, batch_size, self.hidden_size)
+        else:
+            hidden, cell = state
+
+        # The input to hidden projection of all timesteps at once (as in UnrolledLSTM), time
+        # major so the projection of every timestep is contiguous
+        x = torch.transpose(x, 1, 2).reshape(num_models, timesteps * batch_size, -1)
+        input_gates = torch.baddbmm(self.bias.unsqueeze(1), x, self.weight_ih)
+
+        outputs: List[torch.Tensor] = []
+        for step_input_gates in input_gates.split(batch_size, dim=1):
+            gates = torch.baddbmm(step_input_gates, hidden, self.weight_hh)
+            update_gate, forget_gate, update_candidates, output_gate = gates.chunk(4, dim=-1)
+            cell = torch.sigmoid(forget_gate) * cell + torch.sigmoid(update_gate) * torch.tanh(
+                update_candidates
+            )
+            hidden = torch.sigmoid(output_gate) * torch.tanh(cell)
+            outputs.append(hidden)
+        return torch.stack(outputs, dim=2), (hidden, cell)
+
+
+def _stacked_layers(sequentials: Sequence[nn.Sequential]) -> nn.Sequential:
+    layers: List[nn.Module] = []
+    for stacked in zip(*sequentials):
+        if isinstance(stacked[0], nn.Linear):
+            layers.append(StackedLinear(stacked))
+        elif isinstance(stacked[0], nn.BatchNorm1d):
+            layers.append(StackedBatchNorm(stacked))
+        elif isinstance(stacked[0], nn.ReLU):
+            layers.append(nn.ReLU())
+        else:
+            raise ValueError(f"Cannot stack {type(stacked[0]).__name__}")
+    return nn.Sequential(*layers)
+
+
+class ModelBank(nn.Module):
+    r"""
+    Scores a batch of pixels with N models of the same architecture in a single pass: the
+    parameters of the models are stacked, so every layer runs as one batched matmul over
+    the models instead of N separate inference passes.
+
+    As InferenceModel (see export.py), the bank takes raw earth observation data (all BANDS,
+    as returned by openmapflow.engineer.process_test_file) of shape [batch_size, timesteps,
+    bands]; the bands_to_use of every model are selected and normalized by the bank. Returns
+    the crop probabilities of every model for every pixel, of shape [N, batch_size].
+
+    Models can be stacked if they share the ARCHITECTURE_HPARAMS, the number of bands they use
+    and (for models which forecast the evaluation data) the number of available and
+    forecasted timesteps. The models may be trained on different bands, datasets or regions.
+
+    :param models: The models to stack, in the order of the rows of the output
+    """
+
+    bands: torch.Tensor
+    mean: torch.Tensor
+    std: torch.Tensor
+
+    def __init__(self, models: Sequence[Model]) -> None:
+        super().__init__()
+        if len(models) == 0:
+            raise ValueError("A ModelBank needs at least one model")
+        incompatible = [m.hparams.model_name for m in models if not self._compatible(models[0], m)]
+        if incompatible:
+            raise ValueError(
+                f"Models {incompatible} cannot be stacked with {models[0].hparams.model_name}"
+            )
+
+        self.model_names = [m.hparams.model_name for m in models]
+
+        # Band selection and normalization, as in InferenceModel
+        bands, means, stds = [], [], []
+        for m in models:
+            num_bands = len(m.bands_to_use)
+            mean, std = np.zeros(num_bands), np.ones(num_bands)
+            if m.normalizing_dict is not None:
+                mean = m.normalizing_dict["mean"][m.bands_to_use]
+                std = m.normalizing_dict["std"][m.bands_to_use]
+            bands.append(torch.tensor(m.bands_to_use, dtype=torch.long))
+            means.append(torch.tensor(mean))
+            stds.append(torch.tensor(std))
+        self.register_buffer("bands", torch.stack(bands))
+        self.register_buffer("mean", _stack(means)[:, None, None, :])
+        self.register_buffer("std", _stack(stds)[:, None, None, :])
+
+        self.forecast_eval_data = models[0].forecast_eval_data
+        self.available_timesteps = models[0].available_timesteps
+        self.forecast_timesteps = models[0].forecast_timesteps
+        if self.forecast_eval_data:
+            # Models which forecast the evaluation data have a Forecaster
+            forecasters = [cast(Forecaster, m.forecaster) for m in models]
+            self.forecaster_lstm = StackedLSTM([f.lstm for f in forecasters])
+            self.forecaster_to_bands = StackedLinear([f.to_bands for f in forecasters])
+
+        self.base = nn.ModuleList(
+            [StackedLSTM(lstms) for lstms in zip(*[m.classifier.base for m in models])]
+        )
+        self.batchnorm = StackedBatchNorm([m.classifier.batchnorm for m in models])
+        self.local_classifier = _stacked_layers([m.classifier.local_classifier for m in models])
+
+    @classmethod
+    def from_checkpoints(cls, model_names: Sequence[str]) -> "ModelBank":
+        """Stacks the models saved in data/models/{model_name}.ckpt"""
+        model_dir = PROJECT_ROOT / DataPaths.MODELS
+        return cls(
+            [Model.load_from_checkpoint(model_dir / f"{name}.ckpt") for name in model_names]
+        ).eval()
+
+    @staticmethod
+    def _compatible(model: Model, other: Model) -> bool:
+        return (
+            all(
+                getattr(model.hparams, hparam, None) == getattr(other.hparams, hparam, None)
+                for hparam in ARCHITECTURE_HPARAMS
+            )
+            and len(model.bands_to_use) == len(other.bands_to_use)
+            and model.forecast_eval_data == other.forecast_eval_data
+            and (
+                not model.forecast_eval_data
+                or (model.available_timesteps, model.forecast_timesteps)
+                == (other.available_timesteps, other.forecast_timesteps)
+            )
+        )
+
+    def _forecast(self, x: torch.Tensor) -> torch.Tensor:
+        # As Forecaster.forward, for [N, batch_size, timesteps, bands] inputs
+        output, state = self.forecaster_lstm(x)
+        predicted_output = [self.forecaster_to_bands(output)]
+        output = predicted_output[0][:, :, -1:]
+        for _ in range(self.forecast_timesteps - 1):
+            output, state = self.forecaster_lstm(output, state)
+            output = self.forecaster_to_bands(output)
+            predicted_output.append(output)
+        return torch.cat(predicted_output, dim=2)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        chunk_size = max(1, ROWS_PER_CHUNK // len(self.model_names))
+        return torch.cat([self._forward_chunk(chunk) for chunk in x.split(chunk_size)], dim=1)
+
+    def _forward_chunk(self, x: torch.Tensor) -> torch.Tensor:
+        # [batch_size, timesteps, N, bands] -> [N, batch_size, timesteps, bands]
+        x = x[:, :, self.bands].permute(2, 0, 1, 3)
+        x = (x - self.mean) / self.std
+
+        # As Model.forward
+        if self.forecast_eval_data:
+            x_input = x[:, :, : self.available_timesteps]
+            x_forecasted = self._forecast(x_input)[:, :, self.available_timesteps - 1 :]
+            x = torch.cat((x_input, x_forecasted), dim=2)
+
+        # As Classifier.forward, which passes the time major outputs of an LSTM base
+        # layer to the next layer
+        for lstm in self.base:
+            x, (hidden, _) = lstm(x)
+            x = torch.transpose(x, 1, 2)
+        return self.local_classifier(self.batchnorm(hidden)).squeeze(-1).sigmoid()
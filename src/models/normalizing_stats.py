@@ -0,0 +1,63 @@
+from dataclasses import dataclass
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+
+@dataclass
+class NormalizingStats:
+    r"""
+    The sufficient statistics (count, mean, M2) of a set of [timestep, bands] arrays.
+    Statistics of disjoint sets can be merged without revisiting the arrays:
+    https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
+    """
+
+    n: int
+    mean: np.ndarray
+    M2: np.ndarray
+
+    @classmethod
+    def from_array(cls, array: np.ndarray) -> "NormalizingStats":
+        # given an input array of shape [samples, bands]
+        array = array.astype(np.float64)
+        if array.shape[0] == 0:
+            return cls.empty(array.shape[1])
+        mean = array.mean(axis=0)
+        return cls(n=array.shape[0], mean=mean, M2=((array - mean) ** 2).sum(axis=0))
+
+    @classmethod
+    def empty(cls, num_bands: int) -> "NormalizingStats":
+        return cls(n=0, mean=np.zeros(num_bands), M2=np.zeros(num_bands))
+
+    def merge(self, other: "NormalizingStats") -> "NormalizingStats":
+        n = self.n + other.n
+        if n == 0:
+            return self
+        delta = other.mean - self.mean
+        return NormalizingStats(
+            n=n,
+            mean=self.mean + delta * (other.n / n),
+            M2=self.M2 + other.M2 + (delta**2) * (self.n * other.n / n),
+        )
+
+    @classmethod
+    def merge_all(cls, stats: Sequence["NormalizingStats"]) -> "NormalizingStats":
+        if len(stats) == 0:
+            raise ValueError("No statistics to merge")
+        merged = stats[0]
+        for s in stats[1:]:
+            merged = merged.merge(s)
+        return merged
+
+    def to_normalizing_dict(self) -> Dict[str, np.ndarray]:
+        variance = self.M2 / (self.n - 1)
+        return {"mean": self.mean, "std": np.sqrt(variance)}
+
+    def to_json(self) -> Dict[str, object]:
+        return {"n": self.n, "mean": self.mean.tolist(), "M2": self.M2.tolist()}
+
+    @classmethod
+    def from_json(cls, values: Dict) -> "NormalizingStats":
+        mean: List[float] = values["mean"]
+        M2: List[float] = values["M2"]
+        return cls(n=int(values["n"]), mean=np.array(mean), M2=np.array(M2))
@@ -0,0 +1,176 @@
+import hashlib
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+from openmapflow.bbox import BBox
+from openmapflow.constants import CLASS_PROB, LAT, LON, SUBSET
+from openmapflow.labeled_dataset import LabeledDataset
+
+from . import eo_store
+
+# Size (in degrees) of the grid cells the labeled points are bucketed into
+CELL_SIZE = 1.0
+NUM_ROWS = int(np.ceil(180 / CELL_SIZE))
+NUM_COLS = int(np.ceil(360 / CELL_SIZE))
+
+POINT_COLUMNS = ["dataset", "position", LAT, LON, SUBSET, CLASS_PROB]
+
+
+def _cell_ids(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    rows = np.clip(np.floor((lat + 90) / CELL_SIZE), 0, NUM_ROWS - 1).astype(np.int64)
+    cols = np.clip(np.floor((lon + 180) / CELL_SIZE), 0, NUM_COLS - 1).astype(np.int64)
+    return rows * NUM_COLS + cols
+
+
+@dataclass
+class SpatialIndex:
+    r"""
+    A grid index over the labeled points of several datasets. The points are sorted by
+    grid cell, so the points of a bbox are found by scanning only the cells it overlaps.
+
+    Every point keeps the dataset it belongs to (an index into dataset_names), its
+    position in the compiled dataset (see eo_store.py) and its metadata, so locality
+    questions are answered without loading any earth observation data.
+    """
+
+    dataset_names: List[str]
+    points: Dict[str, np.ndarray]
+    cell_starts: np.ndarray
+
+    @classmethod
+    def from_points(cls, dataset_names: List[str], points: Dict[str, np.ndarray]) -> "SpatialIndex":
+        cell_ids = _cell_ids(points[LAT], points[LON])
+        order = np.argsort(cell_ids, kind="stable")
+        cell_starts = np.searchsorted(cell_ids[order], np.arange(NUM_ROWS * NUM_COLS + 1))
+        return cls(
+            dataset_names=dataset_names,
+            points={col: points[col][order] for col in POINT_COLUMNS},
+            cell_starts=cell_starts,
+        )
+
+    def __len__(self) -> int:
+        return len(self.points[LAT])
+
+    def query(self, bbox: BBox) -> np.ndarray:
+        """Returns the (sorted) indices of the points inside the bbox, borders included"""
+        min_cell, max_cell = _cell_ids(
+            np.array([bbox.min_lat, bbox.max_lat]), np.array([bbox.min_lon, bbox.max_lon])
+        )
+        min_col, max_col = min_cell % NUM_COLS, max_cell % NUM_COLS
+        # The cells of a grid row are contiguous, so every row overlapped is a single slice
+        candidates = np.concatenate(
+            [
+                np.arange(self.cell_starts[row + min_col], self.cell_starts[row + max_col + 1])
+                for row in range(min_cell - min_col, max_cell - max_col + 1, NUM_COLS)
+            ]
+        )
+        lat, lon = self.points[LAT][candidates], self.points[LON][candidates]
+        inside = (
+            (lat >= bbox.min_lat)
+            & (lat <= bbox.max_lat)
+            & (lon >= bbox.min_lon)
+            & (lon <= bbox.max_lon)
+        )
+        return candidates[inside]
+
+    def contains(self, bbox: BBox) -> np.ndarray:
+        """Returns a boolean mask of the points inside the bbox"""
+        mask = np.zeros(len(self), dtype=bool)
+        mask[self.query(bbox)] = True
+        return mask
+
+    def select(self, dataset_names: Sequence[str], subset: str) -> np.ndarray:
+        """
+        Returns a boolean mask of the points of the subset in the given datasets, excluding
+        points with a class probability of 0.5 (as Model.load_df does for evaluation sets).
+        """
+        dataset_ids = [i for i, name in enumerate(self.dataset_names) if name in dataset_names]
+        return (
+            np.isin(self.points["dataset"], dataset_ids)
+            & (self.points[SUBSET] == subset)
+            & (self.points[CLASS_PROB] != 0.5)
+        )
+
+
+def _index_path(ds: Sequence[LabeledDataset]) -> Path:
+    sha = hashlib.sha256()
+    for d in ds:
+        sha.update(f"{d.name}:{eo_store.file_hash(d.df_path)};".encode())
+    sha.update(str(CELL_SIZE).encode())
+    return eo_store.COMPILED_DIR / f"spatial_index.{sha.hexdigest()[:16]}.npz"
+
+
+def build_spatial_index(ds: Sequence[LabeledDataset]) -> SpatialIndex:
+    """Builds the index from the metadata of the compiled datasets"""
+    points: Dict[str, List[np.ndarray]] = {col: [] for col in POINT_COLUMNS}
+    for i, d in enumerate(ds):
+        metadata = eo_store.load_compiled_dataset(d).metadata
+        points["dataset"].append(np.full(len(metadata), i, dtype=np.int32))
+        points["position"].append(np.arange(len(metadata), dtype=np.int64))
+        points[LAT].append(metadata[LAT].to_numpy(dtype=np.float64))
+        points[LON].append(metadata[LON].to_numpy(dtype=np.float64))
+        points[SUBSET].append(metadata[SUBSET].to_numpy(dtype=str))
+        points[CLASS_PROB].append(metadata[CLASS_PROB].to_numpy(dtype=np.float64))
+
+    return SpatialIndex.from_points(
+        dataset_names=[d.name for d in ds],
+        points={col: np.concatenate(arrays) for col, arrays in points.items()},
+    )
+
+
+def _remove_stale_indexes(index_path: Path) -> None:
+    """
+    Removes the indexes of other versions of the datasets. Temporary files are kept, they
+    may be written by a concurrent build.
+    """
+    for path in eo_store.COMPILED_DIR.glob("spatial_index.*"):
+        if ".tmp." not in path.name and path != index_path:
+            path.unlink(missing_ok=True)
+
+
+def load_spatial_index(ds: Sequence[LabeledDataset]) -> SpatialIndex:
+    """
+    Loads the spatial index over the labeled points of the datasets (whose csvs exist).
+    The index is rebuilt if any of the dataset csvs changed since it was last built.
+    """
+    ds = [d for d in ds if d.df_path.exists()]
+    index_path = _index_path(ds)
+    if not index_path.exists():
+        index = build_spatial_index(ds)
+        eo_store.COMPILED_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_index_path = eo_store._tmp_path(index_path)
+        np.savez(
+            tmp_index_path,
+            dataset_names=np.array(index.dataset_names, dtype=str),
+            cell_starts=index.cell_starts,
+            **index.points,
+        )
+        os.replace(tmp_index_path, index_path)
+        _remove_stale_indexes(index_path)
+        return index
+
+    with np.load(index_path) as saved:
+        return SpatialIndex(
+            dataset_names=saved["dataset_names"].tolist(),
+            points={col: saved[col] for col in POINT_COLUMNS},
+            cell_starts=saved["cell_starts"],
+        )
+
+
+def non_local_eval_points(
+    index: SpatialIndex, eval_datasets: str, bbox: BBox, subset: str
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the indices of the evaluation points of the subset (as loaded by Model.load_df)
+    and of those which are outside of the bbox.
+    """
+    eval_names = eval_datasets.split(",")
+    missing = [name for name in eval_names if name not in index.dataset_names]
+    if missing:
+        raise ValueError(f"Datasets not available: {missing}")
+
+    eval_mask = index.select(eval_names, subset)
+    return np.flatnonzero(eval_mask), np.flatnonzero(eval_mask & ~index.contains(bbox))
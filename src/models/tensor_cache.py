@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import warnings
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+# Files under /dev/shm live in memory, so mapping them is as fast as a tensor in the
+# process and they outlive the process (e.g. the trials of a sweep), until reboot
+SHM_DIR = Path("/dev/shm")
+TENSOR_CACHE_DIR = (
+    SHM_DIR / "crop-mask" if SHM_DIR.is_dir() else Path(tempfile.gettempdir()) / "crop-mask"
+)
+
+# The cache may use at most this fraction of the file system it is stored in (/dev/shm is
+# usually half of the RAM), the least recently used tensors are evicted to stay below it
+MAX_CACHE_FRACTION = 0.5
+
+# numpy has no bfloat16, bfloat16 tensors are stored as the upper 16 bits of their float32
+# values (which is what a bfloat16 is) in files with this suffix
+BFLOAT16_SUFFIX = ".bfloat16.npy"
+
+# Marks the temporary files of unfinished writes, which are never part of a cached key
+TMP_INFIX = ".tmp."
+
+Tensors = Dict[str, torch.Tensor]
+
+
+def tensor_cache_key(**params: Any) -> str:
+    """
+    Returns a key for the tensors built from the given parameters, any change in
+    the parameters (or in the csv hashes of the datasets) results in a different key.
+    """
+    params_json = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(params_json.encode()).hexdigest()[:32]
+
+
+def _manifest_path(key: str) -> Path:
+    # Lists the names of the cached tensors, written once all of them are
+    return TENSOR_CACHE_DIR / f"{key}.json"
+
+
+def _tensor_path(key: str, name: str, bfloat16: bool) -> Path:
+    return TENSOR_CACHE_DIR / f"{key}.{name}{BFLOAT16_SUFFIX if bfloat16 else '.npy'}"
+
+
+def _tmp_path(path: Path) -> Path:
+    # Unique to the process, so concurrent trials never write to the same temporary file
+    return path.with_name(f"{path.name}{TMP_INFIX}{os.getpid()}")
+
+
+def _key_paths() -> Dict[str, List[Path]]:
+    """The files of every cached key, without the temporary files of unfinished writes"""
+    key_paths: Dict[str, List[Path]] = {}
+    for path in TENSOR_CACHE_DIR.glob("*"):
+        if TMP_INFIX not in path.name:
+            key_paths.setdefault(path.name.split(".")[0], []).append(path)
+    return key_paths
+
+
+def _save_atomic(path: Path, write) -> None:
+    # Written to a temporary path first, so a concurrent trial never reads a partial file
+    tmp_path = _tmp_path(path)
+    with tmp_path.open("wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def load_tensors(key: str) -> Optional[Tensors]:
+    """
+    Maps the cached tensors read-only (bfloat16 tensors are read into memory), returns None
+    if they have not been cached yet.
+    """
+    manifest_path = _manifest_path(key)
+    try:
+        names = json.loads(manifest_path.read_text())
+        tensors: Tensors = {}
+        with warnings.catch_warnings():
+            # The mapped arrays are read-only, the tensors are never modified in place
+            warnings.filterwarnings("ignore", message="The given NumPy array is not writ")
+            for name, bfloat16 in names.items():
+                array = np.load(_tensor_path(key, name, bfloat16), mmap_mode="r")
+                if bfloat16:
+                    array = (array.astype(np.uint32) << 16).view(np.float32)
+                    tensors[name] = torch.from_numpy(array).to(torch.bfloat16)
+                else:
+                    tensors[name] = torch.from_numpy(array)
+    except FileNotFoundError:
+        # Not cached yet, or evicted (e.g. by a concurrent trial)
+        return None
+
+    # Marks the tensors as recently used
+    for path in _key_paths().get(key, []):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by a concurrent trial, the mapped tensors are still valid
+            pass
+    return tensors
+
+
+def save_tensors(key: str, tensors: Tensors) -> None:
+    """
+    Saves the tensors to the cache, after evicting the least recently used tensors if the
+    cache would exceed MAX_CACHE_FRACTION of its file system.
+    """
+    TENSOR_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    arrays: Dict[str, Tuple[np.ndarray, bool]] = {}
+    for name, tensor in tensors.items():
+        if tensor.dtype == torch.bfloat16:
+            bits = (tensor.float().numpy().view(np.uint32) >> 16).astype(np.uint16)
+            arrays[name] = (bits, True)
+        else:
+            arrays[name] = (tensor.numpy(), False)
+
+    max_bytes = int(shutil.disk_usage(TENSOR_CACHE_DIR).total * MAX_CACHE_FRACTION)
+    evict_tensors(max_bytes - sum(array.nbytes for array, _ in arrays.values()))
+
+    for name, (array, bfloat16) in arrays.items():
+        _save_atomic(_tensor_path(key, name, bfloat16), lambda f: np.save(f, array))
+    manifest = json.dumps({name: bfloat16 for name, (_, bfloat16) in arrays.items()})
+    _save_atomic(_manifest_path(key), lambda f: f.write(manifest.encode()))
+
+
+def evict_tensors(max_bytes: int) -> None:
+    """
+    Removes the least recently used (saved or loaded) tensors until the cache uses at most
+    max_bytes. Trials which mapped removed tensors keep using them, they are freed once
+    they are unmapped.
+    """
+    sizes: Dict[str, int] = {}
+    last_used: Dict[str, float] = {}
+    key_paths = _key_paths()
+    for key, paths in key_paths.items():
+        sizes[key], last_used[key] = 0, 0.0
+        for path in paths:
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # Removed by a concurrent trial
+                continue
+            sizes[key] += stat.st_size
+            last_used[key] = max(last_used[key], stat.st_mtime)
+    total_bytes = sum(sizes.values())
+    for key in sorted(key_paths, key=lambda k: last_used[k]):
+        if total_bytes <= max_bytes:
+            break
+        # The manifest first, so the key is never loaded with missing tensors
+        for path in sorted(key_paths[key], key=lambda p: p.suffix != ".json"):
+            path.unlink(missing_ok=True)
+        total_bytes -= sizes[key]
+
+
+def clear_tensor_cache() -> None:
+    """Removes all cached tensors"""
+    evict_tensors(0)
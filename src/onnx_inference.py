@@ -0,0 +1,32 @@
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+from openmapflow.inference import Inference
+
+try:
+    import onnxruntime
+
+    ONNXRUNTIME_INSTALLED = True
+except ImportError:
+    ONNXRUNTIME_INSTALLED = False
+
+
+class OnnxInference(Inference):
+    r"""
+    Runs inference on a single tif file using a model exported by Model.save_onnx under
+    onnxruntime (on CPU). The exported model selects and normalizes the bands itself, so
+    neither the Lightning checkpoint nor the normalizing dict is needed.
+    """
+
+    def __init__(self, onnx_path: Union[str, Path], batch_size: int = 64):
+        if not ONNXRUNTIME_INSTALLED:
+            raise ModuleNotFoundError(
+                "Using ONNX model but onnxruntime is not installed. Please pip install onnxruntime"
+            )
+        session = onnxruntime.InferenceSession(str(onnx_path), providers=["CPUExecutionProvider"])
+        super().__init__(model=session, normalizing_dict=None, batch_size=batch_size)
+        self.model_type = "onnx"
+
+    def _on_single_batch(self, batch_x_np: np.ndarray) -> np.ndarray:
+        return self.model.run(None, {"x": batch_x_np.astype(np.float32)})[0]
@@ -11,9 +11,13 @@ from tqdm import tqdm
 
 from datasets import datasets
 from src.models import Model
+from src.models.export import quantize_dynamic
 
 all_dataset_names = [d.name for d in datasets]
 
+# Metrics which may drop at most by the quantization tolerance for a quantized model
+QUANTIZATION_GATE_METRICS = ["f1_score", "accuracy"]
+
 
 def validate(hparams: Namespace) -> Namespace:
     # Check model name
@@ -65,14 +69,21 @@ def train_model(
             }
         )
 
+    val_check_interval = hparams.val_check_interval
+    if val_check_interval > 1:
+        val_check_interval = int(val_check_interval)
+
     trainer = pl.Trainer(
         max_epochs=hparams.epochs,
         checkpoint_callback=False,
         early_stop_callback=early_stop_callback,
         logger=wandb_logger if hparams.wandb else False,
+        val_check_interval=val_check_interval,
     )
 
     trainer.fit(model)
+    # The last checkpoint may still be being written
+    model.checkpoint_writer.wait()
 
     model_ckpt_path = PROJECT_ROOT / DataPaths.MODELS / f"{hparams.model_name}.ckpt"
     if not model_ckpt_path.exists():
@@ -80,7 +91,24 @@ def train_model(
 
     model, metrics = run_evaluation(model_ckpt_path=model_ckpt_path)
 
-    model.save()
+    export_model = model
+    if hparams.quantize:
+        quantized_model, metrics["quantized"] = run_quantized_evaluation(
+            model_ckpt_path=model_ckpt_path,
+            metrics=metrics,
+            tolerance=hparams.quantization_tolerance,
+        )
+        if metrics["quantized"]["accepted"]:
+            # The quantized model is exported in place of the full precision model
+            export_model = quantized_model
+    export_model.save()
+
+    # The ONNX export (see inference.py) is always of the full precision model. The model is
+    # already checkpointed and exported, so a failure of the ONNX exporter is not fatal
+    try:
+        model.save_onnx()
+    except RuntimeError as e:
+        print(f"Exporting the model to ONNX failed, only the TorchScript model is exported: {e}")
 
     return model, metrics
 
@@ -121,18 +149,72 @@ def run_evaluation(
         for k, v in alternative_metrics.items():
             val_metrics[f"thresh{alternative_threshold}_{k}"] = v
 
-    with (PROJECT_ROOT / DataPaths.METRICS).open() as f:
-        models_dict = json.load(f)
-
     all_info = {
         "params": model.hparams.wandb_url,
         "val_metrics": val_metrics,
         "test_metrics": test_metrics,
     }
-    models_dict[model.hparams.model_name] = all_info
+    update_models_dict(model.hparams.model_name, all_info)
+
+    return model, all_info
+
+
+def quantization_gate(
+    metrics: Dict[str, Any], quantized_metrics: Dict[str, Any], tolerance: float
+) -> bool:
+    """
+    Whether the metrics of the quantized model (of QUANTIZATION_GATE_METRICS, on both the
+    validation and test sets) are at most tolerance below the metrics of the model. The
+    quantized model is rejected if any of these metrics is missing, from either model.
+    """
+    for metrics_key in ["val_metrics", "test_metrics"]:
+        for metric in QUANTIZATION_GATE_METRICS:
+            value = metrics.get(metrics_key, {}).get(metric)
+            quantized_value = quantized_metrics.get(metrics_key, {}).get(metric)
+            if value is None or quantized_value is None:
+                print(f"{metric} is missing from the {metrics_key}, rejecting the quantized model")
+                return False
+            if value - quantized_value > tolerance:
+                return False
+    return True
+
+
+def run_quantized_evaluation(
+    model_ckpt_path: Path, metrics: Dict[str, Any], tolerance: float
+) -> Tuple[Any, Dict[str, Any]]:
+    """
+    Evaluates the model with its weights dynamically quantized to int8 (see
+    export.quantize_dynamic), as run_evaluation evaluates the full precision model. The
+    quantized model is accepted if it passes the quantization_gate against the metrics of
+    the full precision model (as returned by run_evaluation). The result is recorded
+    alongside those metrics in models.json, under "quantized".
+    """
+    if not model_ckpt_path.exists():
+        raise ValueError(f"Model {str(model_ckpt_path)} does not exist")
+    model = quantize_dynamic(Model.load_from_checkpoint(model_ckpt_path))
+    quantized_info: Dict[str, Any] = {
+        "val_metrics": run_evaluation_on_one_model(model, test=False),
+        "test_metrics": run_evaluation_on_one_model(model, test=True),
+        "tolerance": tolerance,
+    }
+    quantized_info["accepted"] = quantization_gate(metrics, quantized_info, tolerance)
+    print(
+        f"Quantized {model.hparams.model_name} "
+        f"{'accepted' if quantized_info['accepted'] else 'rejected'}: {quantized_info}"
+    )
+
+    update_models_dict(model.hparams.model_name, {**metrics, "quantized": quantized_info})
+
+    return model, quantized_info
+
+
+def update_models_dict(model_name: str, model_info: Dict[str, Any]) -> None:
+    """Records the info (e.g. metrics) of the model in models.json"""
+    with (PROJECT_ROOT / DataPaths.METRICS).open() as f:
+        models_dict = json.load(f)
+
+    models_dict[model_name] = model_info
 
     with (PROJECT_ROOT / DataPaths.METRICS).open("w") as f:
         json.dump(models_dict, f, ensure_ascii=False, indent=4, sort_keys=True)
         f.write("\n")
-
-    return model, all_info
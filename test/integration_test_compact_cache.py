@@ -0,0 +1,52 @@
+import json
+from typing import Any, Dict
+from unittest import TestCase
+
+from openmapflow.config import PROJECT_ROOT, DataPaths
+from tqdm import tqdm
+
+from src.models.model import Model
+from src.pipeline_funcs import run_evaluation_on_one_model
+
+# Maximum absolute difference to the recorded metrics when the cache is stored in float16
+METRICS_TOLERANCE = 0.01
+
+
+class IntegrationTestCompactCache(TestCase):
+    def test_compact_cache_metrics(self):
+        model_dir = PROJECT_ROOT / DataPaths.MODELS
+        with (PROJECT_ROOT / DataPaths.METRICS).open("rb") as f:
+            models_dict: Dict[str, Any] = json.load(f)
+
+        no_differences = True
+        for model_name, model_dict in tqdm(models_dict.items()):
+            if not (model_dir / f"{model_name}.ckpt").exists():
+                continue
+
+            model = Model.load_from_checkpoint(model_dir / f"{model_name}.ckpt")
+            model.hparams.cache = True
+            model.hparams.cache_dtype = "float16"
+            try:
+                compact_metrics = {
+                    "val_metrics": run_evaluation_on_one_model(model, test=False),
+                    "test_metrics": run_evaluation_on_one_model(model, test=True),
+                }
+            except ValueError as e:
+                print(f"Dataset not available for {model_name}, skipping.")
+                print(e)
+                continue
+
+            print("---------------------------------------------")
+            print(model_name)
+            for metrics_key, metrics in compact_metrics.items():
+                for metric, value in metrics.items():
+                    recorded = model_dict[metrics_key].get(metric)
+                    if recorded is None:
+                        continue
+                    if abs(recorded - value) <= METRICS_TOLERANCE:
+                        print(f"\u2714 {metrics_key} {metric}: {recorded} ~= {value}")
+                    else:
+                        no_differences = False
+                        print(f"\u2716 {metrics_key} {metric}: {recorded} != {value}")
+
+        self.assertTrue(no_differences, "Some compact cache metrics differ, check logs.")
@@ -1,11 +1,14 @@
 import json
 from unittest import TestCase
 
+import torch
+from openmapflow.bbox import BBox
 from openmapflow.config import PROJECT_ROOT, DataPaths
 from openmapflow.constants import LAT, LON
 
+from datasets import datasets
 from src.bboxes import bboxes
-from src.models.model import Model
+from src.models.spatial_index import load_spatial_index, non_local_eval_points
 
 
 class ModelBboxTest(TestCase):
@@ -14,41 +17,48 @@ class ModelBboxTest(TestCase):
         with (PROJECT_ROOT / DataPaths.METRICS).open("rb") as f:
             models_dict = json.load(f)
 
+        # The locality of every evaluation point is checked using the index alone,
+        # without loading the models or the earth observation data
+        index = load_spatial_index(datasets)
+
         non_local_examples_in_eval = False
         for model_name, _ in models_dict.items():
             print("--------------------------------------------------")
             print(model_name)
-            model = Model.load_from_checkpoint(
-                PROJECT_ROOT / DataPaths.MODELS / f"{model_name}.ckpt"
+            checkpoint = torch.load(
+                PROJECT_ROOT / DataPaths.MODELS / f"{model_name}.ckpt", map_location="cpu"
             )
+            hparams = checkpoint["hparams"]
+            if "bbox" in hparams:
+                bbox = bboxes[hparams["bbox"]]
+            else:
+                bbox = BBox(
+                    min_lat=hparams["min_lat"],
+                    max_lat=hparams["max_lat"],
+                    min_lon=hparams["min_lon"],
+                    max_lon=hparams["max_lon"],
+                )
+
             for subset in ["validation", "testing"]:
                 try:
-                    df = Model.load_df(
-                        subset, model.hparams.train_datasets, model.hparams.eval_datasets
-                    )
-                    if "bbox" in model.hparams:
-                        bbox = bboxes[model.hparams.bbox]
-                    else:
-                        bbox = model.hparams
-
-                    is_local = (
-                        (df[LAT] >= bbox.min_lat)
-                        & (df[LAT] <= bbox.max_lat)
-                        & (df[LON] >= bbox.min_lon)
-                        & (df[LON] <= bbox.max_lon)
+                    eval_points, non_local = non_local_eval_points(
+                        index, hparams["eval_datasets"], bbox, subset
                     )
-                    if is_local.all():
-                        print(f"\u2714 {subset}: all {len(df)} examples are local")
-                    else:
-                        print(f"\u2716 {subset}: {len(df[~is_local])} examples are not local")
-                        print(
-                            f"bbox should contain: "
-                            f"min_lat={df[LAT].min()}, max_lat={df[LAT].max()}, "
-                            f"min_lon={df[LON].min()}, max_lon={df[LON].max()}"
-                        )
-                        non_local_examples_in_eval = True
                 except ValueError as e:
                     print(f"{subset}: {e}")
+                    continue
+
+                if len(non_local) == 0:
+                    print(f"\u2714 {subset}: all {len(eval_points)} examples are local")
+                else:
+                    print(f"\u2716 {subset}: {len(non_local)} examples are not local")
+                    lat, lon = index.points[LAT][eval_points], index.points[LON][eval_points]
+                    print(
+                        f"bbox should contain: "
+                        f"min_lat={lat.min()}, max_lat={lat.max()}, "
+                        f"min_lon={lon.min()}, max_lon={lon.max()}"
+                    )
+                    non_local_examples_in_eval = True
         self.assertFalse(
             non_local_examples_in_eval,
             "Some evaluation sets contain non-local examples, check logs.",
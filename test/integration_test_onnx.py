@@ -0,0 +1,57 @@
+import json
+import tempfile
+from pathlib import Path
+from typing import Any, Dict
+from unittest import TestCase, skipIf
+
+import numpy as np
+from openmapflow.config import PROJECT_ROOT, DataPaths
+from openmapflow.inference import Inference
+from tqdm import tqdm
+
+from src.models.model import Model
+from src.onnx_inference import ONNXRUNTIME_INSTALLED, OnnxInference
+
+TIF_PATH = (
+    PROJECT_ROOT
+    / "data"
+    / (
+        "min_lat=14.9517_min_lon=-86.2507_max_lat=14.9531_max_lon=-86.2493"
+        "_dates=2017-01-01_2018-12-31_all.tif"
+    )
+)
+
+# Maximum absolute difference between the ONNX Runtime and PyTorch predictions
+PREDICTIONS_TOLERANCE = 1e-4
+
+
+@skipIf(not ONNXRUNTIME_INSTALLED, reason="No onnxruntime installed")
+class IntegrationTestOnnx(TestCase):
+    def test_onnx_matches_torch(self):
+        model_dir = PROJECT_ROOT / DataPaths.MODELS
+        with (PROJECT_ROOT / DataPaths.METRICS).open("rb") as f:
+            models_dict: Dict[str, Any] = json.load(f)
+
+        no_differences = True
+        for model_name in tqdm(models_dict.keys()):
+            if not (model_dir / f"{model_name}.ckpt").exists():
+                continue
+
+            model = Model.load_from_checkpoint(model_dir / f"{model_name}.ckpt").eval()
+            torch_preds = Inference(model, normalizing_dict=model.normalizing_dict).run(TIF_PATH)
+            with tempfile.TemporaryDirectory() as tmpdir:
+                onnx_path = model.save_onnx(Path(tmpdir) / f"{model_name}.onnx")
+                onnx_preds = OnnxInference(onnx_path).run(TIF_PATH)
+
+            print("---------------------------------------------")
+            print(model_name)
+            max_difference = np.abs(torch_preds.values - onnx_preds.values).max()
+            if (torch_preds.index == onnx_preds.index).all() and (
+                max_difference <= PREDICTIONS_TOLERANCE
+            ):
+                print(f"\u2714 ONNX predictions == PyTorch predictions (+-{max_difference})")
+            else:
+                no_differences = False
+                print(f"\u2716 ONNX predictions != PyTorch predictions (+-{max_difference})")
+
+        self.assertTrue(no_differences, "Some ONNX predictions differ, check logs.")
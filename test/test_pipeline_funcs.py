@@ -0,0 +1,35 @@
+from unittest import TestCase, skipIf
+
+try:
+    import pytorch_lightning  # noqa
+
+    from src.pipeline_funcs import quantization_gate
+
+    TORCH_LIGHTNING_INSTALLED = True
+except ImportError:
+    TORCH_LIGHTNING_INSTALLED = False
+
+
+def evaluation(f1_score: float, accuracy: float):
+    metrics = {"f1_score": f1_score, "accuracy": accuracy}
+    return {"val_metrics": dict(metrics), "test_metrics": dict(metrics)}
+
+
+@skipIf(not TORCH_LIGHTNING_INSTALLED, reason="No pytorch-lightning installed")
+class TestQuantizationGate(TestCase):
+    def test_accepts_metrics_within_tolerance(self):
+        self.assertTrue(quantization_gate(evaluation(0.8, 0.9), evaluation(0.79, 0.9), 0.02))
+        self.assertTrue(quantization_gate(evaluation(0.8, 0.9), evaluation(0.85, 0.95), 0.0))
+
+    def test_rejects_metrics_below_tolerance(self):
+        self.assertFalse(quantization_gate(evaluation(0.8, 0.9), evaluation(0.8, 0.85), 0.02))
+
+    def test_rejects_missing_metrics(self):
+        quantized_metrics = evaluation(0.8, 0.9)
+        del quantized_metrics["test_metrics"]["f1_score"]
+        self.assertFalse(quantization_gate(evaluation(0.8, 0.9), quantized_metrics, 0.02))
+
+        metrics = evaluation(0.8, 0.9)
+        metrics["val_metrics"] = {}
+        self.assertFalse(quantization_gate(metrics, evaluation(0.8, 0.9), 0.02))
+        self.assertFalse(quantization_gate(evaluation(0.8, 0.9), {}, 0.02))
@@ -0,0 +1,70 @@
+import json
+import tempfile
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+from typing import Any
+from unittest.mock import patch
+
+import numpy as np
+import torch
+from openmapflow.config import DATA_DIR
+from openmapflow.engineer import BANDS
+
+from src.models import Model
+from src.models import model as model_module
+
+TRAIN_DATASETS = "test_dataset"
+
+# Small LSTMs, so tests with several models run fast
+SMALL_HPARAMS = {"classifier_vector_size": 16, "forecasting_vector_size": 8}
+
+
+def model_hparams(**kwargs: Any) -> Namespace:
+    """The default hparams of a Model (see Model.add_model_specific_args), with kwargs set"""
+    parser = ArgumentParser()
+    parser.add_argument("--model_name", type=str, default="test_model")
+    parser.add_argument("--train_datasets", type=str, default=TRAIN_DATASETS)
+    parser.add_argument("--eval_datasets", type=str, default=TRAIN_DATASETS)
+    parser.add_argument("--bbox", type=str, default="Kenya")
+    parser.add_argument("--start_month", type=str, default="February")
+    parser.add_argument("--input_months", type=int, default=12)
+    parser.add_argument("--seed", type=int, default=42)
+    hparams = Model.add_model_specific_args(parser).parse_args([])
+    for key, value in kwargs.items():
+        setattr(hparams, key, value)
+    return hparams
+
+
+def build_model(available_timesteps: int = 12, **kwargs: Any) -> Model:
+    r"""
+    Builds a real Model without any datasets: the dataset params (the timesteps of the
+    datasets and a random normalizing dict) are written to a temporary all_dataset_params.json.
+    If available_timesteps is below input_months the Model forecasts the timesteps after it
+    (of both the training and the evaluation data).
+    The running statistics of the BatchNorms are randomized, so they matter in eval mode.
+
+    :param kwargs: hparams of the Model, see model_hparams
+    """
+    hparams = model_hparams(**kwargs)
+    rng = np.random.default_rng(hparams.seed)
+    dataset_params = {
+        "train_num_timesteps": [available_timesteps, hparams.input_months],
+        "val_num_timesteps": [available_timesteps, hparams.input_months],
+        "normalizing_dict": {
+            "mean": rng.normal(size=len(BANDS)).tolist(),
+            "std": rng.uniform(0.5, 2, size=len(BANDS)).tolist(),
+        },
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        params_path = Path(tmp_dir) / DATA_DIR / "all_dataset_params.json"
+        params_path.parent.mkdir(parents=True)
+        key = f"{hparams.train_datasets}_{hparams.start_month}"
+        params_path.write_text(json.dumps({key: dataset_params}))
+        with patch.object(model_module, "PROJECT_ROOT", Path(tmp_dir)):
+            model = Model(hparams)
+
+    for batchnorm in model.modules():
+        if isinstance(batchnorm, torch.nn.BatchNorm1d):
+            batchnorm.running_mean.normal_()
+            batchnorm.running_var.uniform_(0.5, 2)
+    return model
@@ -0,0 +1,84 @@
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+
+import torch
+
+from src.models import checkpoint_writer
+from src.models.checkpoint_writer import AsyncCheckpointWriter
+
+
+class Unpicklable:
+    def __reduce__(self):
+        raise AttributeError("Can't pickle Unpicklable")
+
+
+class TestAsyncCheckpointWriter(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpdir.name) / "model.ckpt"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_writes_snapshot(self):
+        weight = torch.ones(3)
+        state_dict = OrderedDict(weight=weight)
+        state_dict._metadata = {"": {"version": 1}}  # type: ignore
+
+        writer = AsyncCheckpointWriter()
+        writer.save({"state_dict": state_dict, "epoch": 2}, self.path)
+        # Training keeps updating the tensors while the checkpoint is written
+        weight.add_(1)
+        writer.wait()
+
+        self.assertFalse(writer.is_pending(self.path))
+        self.assertEqual(list(Path(self.tmpdir.name).iterdir()), [self.path])
+        checkpoint = torch.load(self.path)
+        self.assertEqual(checkpoint["epoch"], 2)
+        self.assertTrue(torch.equal(checkpoint["state_dict"]["weight"], torch.ones(3)))
+        self.assertEqual(checkpoint["state_dict"]._metadata, {"": {"version": 1}})
+
+    def test_newer_checkpoint_replaces_pending(self):
+        other_path = Path(self.tmpdir.name) / "other.ckpt"
+        writing = threading.Event()
+        release = threading.Event()
+        written = []
+
+        def blocking_save(checkpoint, path):
+            written.append((checkpoint["epoch"], path))
+            writing.set()
+            release.wait()
+
+        writer = AsyncCheckpointWriter()
+        with patch.object(checkpoint_writer, "atomic_save", blocking_save):
+            writer.save({"epoch": 1}, other_path)
+            writing.wait()
+            # The first checkpoint is being written, the second one is dropped
+            writer.save({"epoch": 2}, self.path)
+            writer.save({"epoch": 3}, self.path)
+            self.assertTrue(writer.is_pending(self.path))
+            release.set()
+            writer.wait()
+        self.assertEqual(written, [(1, other_path), (3, self.path)])
+
+    def test_writes_without_unpicklable_hparams(self):
+        writer = AsyncCheckpointWriter()
+        writer.save({"epoch": 1, "hparams": {"unpicklable": Unpicklable()}}, self.path)
+        writer.wait()
+        self.assertEqual(torch.load(self.path), {"epoch": 1})
+
+    def test_wait_raises_failed_write(self):
+        writer = AsyncCheckpointWriter()
+        writer.save({"epoch": 1}, Path(self.tmpdir.name) / "missing" / "model.ckpt")
+        # A later successful write does not hide the failed one
+        writer.save({"epoch": 2}, self.path)
+        with self.assertRaises(RuntimeError) as context:
+            writer.wait()
+        self.assertIsNotNone(context.exception.__cause__)
+        self.assertEqual(torch.load(self.path)["epoch"], 2)
+        # The error is raised once
+        writer.wait()
@@ -0,0 +1,42 @@
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+
+import torch
+
+from src.models.compilation import CompiledModule, compilation_errors
+
+
+def failing_compiled_module(*args):
+    raise torch._dynamo.exc.Unsupported("Unsupported operation")
+
+
+def raising_compiled_module(*args):
+    raise ValueError("Wrong input")
+
+
+class TestCompiledModule(TestCase):
+    def setUp(self):
+        self.module = torch.nn.Linear(4, 2)
+        self.x = torch.randn(3, 4)
+
+    def test_eager_without_torch_compile(self):
+        with patch("src.models.compilation.compile_available", return_value=False):
+            compiled = CompiledModule(self.module, "linear")
+        self.assertIsNone(compiled.compiled)
+        self.assertTrue(torch.equal(compiled(self.x), self.module(self.x)))
+
+    @skipIf(not compilation_errors(), reason="torch has no torch.compile")
+    def test_eager_if_compiling_fails(self):
+        compiled = CompiledModule(self.module, "linear")
+        compiled.compiled = failing_compiled_module
+        with self.assertLogs("src.models.compilation", level="WARNING"):
+            self.assertTrue(torch.equal(compiled(self.x), self.module(self.x)))
+        # The module is not compiled again
+        self.assertIsNone(compiled.compiled)
+
+    def test_other_errors_are_raised(self):
+        compiled = CompiledModule(self.module, "linear")
+        compiled.compiled = raising_compiled_module
+        with self.assertRaises(ValueError):
+            compiled(self.x)
+        self.assertIs(compiled.compiled, raising_compiled_module)
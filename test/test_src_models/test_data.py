@@ -2,8 +2,12 @@ from dataclasses import dataclass
 from unittest import TestCase, skipIf
 
 import numpy as np
+import pandas as pd
+import torch
+from openmapflow.bbox import BBox
+from openmapflow.constants import CLASS_PROB, END, EO_DATA, LAT, LON, START
 
-from src.models.data import CropDataset
+from src.models.data import CropDataset, batch_dataloader
 
 try:
     import pytorch_lightning  # noqa
@@ -13,11 +17,47 @@ except ImportError:
     TORCH_LIGHTNING_INSTALLED = False
 
 
+TARGET_BBOX = BBox(min_lat=0, max_lat=1, min_lon=0, max_lon=1)
+PARTIAL_ENDS = ["2020-12-31", "2020-12-31", "2019-06-30", "2020-12-31"]
+
+
 @dataclass
 class TempInstance:
     labelled_array: np.ndarray
 
 
+def labeled_df(lats, lons, class_probs, eo_data, ends=None) -> pd.DataFrame:
+    """Labels starting in January 2019 and (unless ends are passed) ending in December 2020"""
+    return pd.DataFrame(
+        {
+            LAT: lats,
+            LON: lons,
+            START: ["2019-01-01"] * len(lats),
+            END: ends if ends is not None else ["2020-12-31"] * len(lats),
+            CLASS_PROB: class_probs,
+            EO_DATA: eo_data,
+        }
+    )
+
+
+def partial_df(lats, lons) -> pd.DataFrame:
+    """4 labels with random earth observation data, the third is a partial time series"""
+    rng = np.random.default_rng(42)
+    eo_data = [rng.normal(size=(t, 3)) for t in [24, 24, 6, 24]]
+    return labeled_df(lats, lons, [1.0, 0.0, 0.8, 0.3], eo_data, ends=PARTIAL_ENDS)
+
+
+def crop_dataset(df: pd.DataFrame, **kwargs) -> CropDataset:
+    defaults = dict(
+        subset="training",
+        cache=True,
+        upsample=False,
+        target_bbox=TARGET_BBOX,
+        wandb_logger=None,
+    )
+    return CropDataset(df=df, **{**defaults, **kwargs})
+
+
 class TestData(TestCase):
     @skipIf(not TORCH_LIGHTNING_INSTALLED, reason="No pytorch-lightning installed")
     def test_update_normalizing_values(self):
@@ -46,3 +86,82 @@ class TestData(TestCase):
         self.assertTrue(
             np.allclose(normalizing_dict["std"], np.array([1.04880885, 1.04880885, 1.04880885]))
         )
+
+    @skipIf(not TORCH_LIGHTNING_INSTALLED, reason="No pytorch-lightning installed")
+    def test_to_array_matches_getitem(self):
+        df = partial_df(lats=[0.5, 1.5, 0.2, 5.0], lons=[0.5, 0.2, 1.5, 5.0])
+        dataset = crop_dataset(df, cache=False, start_month="February", input_months=12)
+        x, y, weights = dataset.to_array()
+        self.assertEqual(x.shape, (4, 12, 3))
+        self.assertTrue(x.is_contiguous())
+        self.assertTrue(torch.isnan(x[2, 5:]).all())
+
+        items = [dataset[i] for i in range(len(dataset))]
+        self.assertTrue(torch.equal(y, torch.stack([item[1] for item in items])))
+        self.assertTrue(torch.equal(weights, torch.stack([item[2] for item in items])))
+        expected_x = torch.stack([item[0] for item in items])
+        self.assertTrue(torch.allclose(x, expected_x, equal_nan=True))
+
+    @skipIf(not TORCH_LIGHTNING_INSTALLED, reason="No pytorch-lightning installed")
+    def test_bands_to_use(self):
+        df = labeled_df(
+            lats=[0.5, 0.2],
+            lons=[0.5, 0.3],
+            class_probs=[1.0, 0.0],
+            eo_data=[np.arange(72).reshape(24, 3).astype(float)] * 2,
+        )
+        normalizing_dict = {"mean": np.array([1.0, 2.0, 3.0]), "std": np.array([2.0, 4.0, 8.0])}
+        all_bands = crop_dataset(df, normalizing_dict=normalizing_dict)
+        some_bands = crop_dataset(df, normalizing_dict=normalizing_dict, bands_to_use=[0, 2])
+        self.assertEqual(some_bands.num_input_features, 2)
+        self.assertTrue(torch.equal(some_bands.x, all_bands.x[:, :, [0, 2]]))
+
+    @skipIf(not TORCH_LIGHTNING_INSTALLED, reason="No pytorch-lightning installed")
+    def test_upsampling_sampler(self):
+        # 3 local crop points, 1 local non-crop point and 1 global point
+        df = labeled_df(
+            lats=[0.5, 0.6, 0.7, 0.8, 5.0],
+            lons=[0.5, 0.6, 0.7, 0.8, 5.0],
+            class_probs=[1.0, 1.0, 1.0, 0.0, 0.0],
+            eo_data=[np.full((24, 3), i, dtype=float) for i in range(5)],
+        )
+        dataset = crop_dataset(df, upsample=True)
+        self.assertEqual(len(dataset), 5)
+        self.assertListEqual(dataset.upsampled_indices.tolist(), [3, 3])
+
+        sampler = dataset.sampler(seed=42)
+        first_epoch, second_epoch = list(sampler), list(sampler)
+        self.assertEqual(len(sampler), 7)
+        self.assertListEqual(sorted(first_epoch), [0, 1, 2, 3, 3, 3, 4])
+        self.assertListEqual(sorted(second_epoch), sorted(first_epoch))
+        self.assertNotEqual(first_epoch, second_epoch)
+        self.assertListEqual(first_epoch, list(dataset.sampler(seed=42)))
+
+    @skipIf(not TORCH_LIGHTNING_INSTALLED, reason="No pytorch-lightning installed")
+    def test_compact_cache(self):
+        df = partial_df(lats=[0.5, 1.5, 0.2, 0.4], lons=[0.5, 0.2, 0.5, 0.6])
+        dataset = crop_dataset(df)
+        for cache_dtype in [torch.float16, torch.bfloat16]:
+            compact = crop_dataset(df, cache_dtype=cache_dtype)
+            self.assertEqual(compact.x.dtype, cache_dtype)
+            self.assertEqual(compact.labels.dtype, torch.uint8)
+            for (x, y, w), (compact_x, compact_y, compact_w) in zip(dataset, compact):
+                self.assertEqual(compact_x.dtype, torch.float32)
+                self.assertTrue(torch.allclose(x, compact_x, atol=0.05, equal_nan=True))
+                self.assertTrue(torch.equal(y, compact_y))
+                self.assertTrue(torch.equal(w, compact_w))
+            _, y, w = compact.to_array()
+            self.assertTrue(torch.equal(y, dataset.y) and torch.equal(w, dataset.weights))
+
+    @skipIf(not TORCH_LIGHTNING_INSTALLED, reason="No pytorch-lightning installed")
+    def test_get_batch_matches_getitem(self):
+        df = partial_df(lats=[0.5, 1.5, 0.2, 0.4], lons=[0.5, 0.2, 0.5, 0.6])
+        indices = [3, 0, 2, 2]
+        for cache in [True, False]:
+            dataset = crop_dataset(df, cache=cache)
+            items = [dataset[i] for i in indices]
+            batches = list(batch_dataloader(dataset, sampler=indices, batch_size=4))
+            self.assertEqual(len(batches), 1)
+            for expected, actual in zip(zip(*items), batches[0]):
+                self.assertTrue(torch.equal(torch.stack(expected).isnan(), actual.isnan()))
+                self.assertTrue(torch.allclose(torch.stack(expected), actual, equal_nan=True))
@@ -0,0 +1,112 @@
+import tempfile
+from pathlib import Path
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+from openmapflow.constants import CLASS_PROB, END, EO_DATA, LAT, LON, START, SUBSET
+
+try:
+    import pytorch_lightning  # noqa
+
+    from src.models import eo_store
+
+    TORCH_LIGHTNING_INSTALLED = True
+except ImportError:
+    TORCH_LIGHTNING_INSTALLED = False
+
+
+class TempDataset:
+    def __init__(self, df_path: Path, df: pd.DataFrame):
+        self.name = "temp"
+        self.df_path = df_path
+        self.df = df
+        self.load_count = 0
+
+    def load_df(self, to_np: bool = False, disable_tqdm: bool = False) -> pd.DataFrame:
+        self.load_count += 1
+        return self.df.copy()
+
+
+@skipIf(not TORCH_LIGHTNING_INSTALLED, reason="No pytorch-lightning installed")
+class TestEOStore(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_path = Path(self.tmp_dir.name)
+        self.df = pd.DataFrame(
+            {
+                LAT: [1.0, 2.0, 3.0],
+                LON: [4.0, 5.0, 6.0],
+                START: ["2019-01-01"] * 3,
+                END: ["2020-12-31", "2020-12-31", "2019-12-31"],
+                CLASS_PROB: [1.0, 0.0, 0.8],
+                SUBSET: ["training", "validation", "testing"],
+                EO_DATA: [np.ones((4, 2)), np.zeros((4, 2)), np.full((2, 2), 0.5)],
+            },
+            index=[0, 2, 5],
+        )
+        self.csv_path = self.tmp_path / "temp.csv"
+        self.csv_path.write_text("v1")
+        self.dataset = TempDataset(self.csv_path, self.df)
+        self.patcher = patch.object(eo_store, "COMPILED_DIR", self.tmp_path / "compiled")
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.tmp_dir.cleanup()
+
+    def test_round_trip(self):
+        compiled = eo_store.load_compiled_dataset(self.dataset)
+        self.assertEqual(compiled.eo_data.shape, (3, 4, 2))
+        self.assertEqual(compiled.eo_data.dtype, np.float32)
+        self.assertTrue(np.isnan(compiled.eo_data[2, 2:]).all())
+
+        df = compiled.to_df()
+        self.assertListEqual(list(df.index), [0, 2, 5])
+        self.assertListEqual(list(df[SUBSET]), ["training", "validation", "testing"])
+        for expected, actual in zip(self.df[EO_DATA], df[EO_DATA]):
+            self.assertTrue(np.allclose(expected, actual))
+
+    def test_features_are_applied_in_chunks(self):
+        compiled = eo_store.load_compiled_dataset(self.dataset)
+        chunk_sizes = []
+
+        def double(x: np.ndarray) -> np.ndarray:
+            chunk_sizes.append(len(x))
+            return x * 2
+
+        with patch.object(eo_store, "CHUNK_SIZE", 2):
+            df = compiled.to_df(features=double)
+        self.assertListEqual(chunk_sizes, [2, 1])
+        for expected, actual in zip(self.df[EO_DATA], df[EO_DATA]):
+            self.assertTrue(np.allclose(expected * 2, actual))
+
+    def test_recompiled_only_when_csv_changes(self):
+        self.assertFalse(eo_store.is_compiled(self.dataset))
+        eo_store.load_compiled_dataset(self.dataset)
+        self.assertTrue(eo_store.is_compiled(self.dataset))
+        eo_store.load_compiled_dataset(self.dataset)
+        self.assertEqual(self.dataset.load_count, 1)
+
+        self.csv_path.write_text("v2 changed")
+        self.assertFalse(eo_store.is_compiled(self.dataset))
+        eo_store.load_compiled_dataset(self.dataset)
+        self.assertEqual(self.dataset.load_count, 2)
+        self.assertEqual(len(list((self.tmp_path / "compiled").glob("temp.*"))), 2)
+
+    def test_concurrent_temporary_files_are_kept(self):
+        eo_store.load_compiled_dataset(self.dataset)
+        compiled_dir = self.tmp_path / "compiled"
+        # A compile of the same csv in another process, which is still writing
+        eo_path, _ = eo_store._compiled_paths("temp", eo_store.file_hash(self.csv_path))
+        concurrent_tmp_path = eo_store._tmp_path(eo_path)
+
+        self.csv_path.write_text("v2 changed")
+        eo_store.load_compiled_dataset(self.dataset)
+        self.assertTrue(concurrent_tmp_path.exists())
+        # Only the compiled files of the current csv (and the temporary file) are left
+        compiled_files = set(compiled_dir.glob("temp.*")) - {concurrent_tmp_path}
+        self.assertEqual(
+            compiled_files, set(eo_store._compiled_paths("temp", eo_store.file_hash(self.csv_path)))
+        )
@@ -0,0 +1,141 @@
+import json
+import tempfile
+import time
+from pathlib import Path
+from unittest import TestCase, skipIf
+
+import numpy as np
+import torch
+
+try:
+    import pytorch_lightning  # noqa
+
+    from src.models.export import (
+        InferenceModel,
+        benchmark,
+        benchmark_export,
+        benchmark_path,
+        export_onnx,
+        optimize_for_inference,
+        quantize_dynamic,
+        save_benchmark,
+    )
+    from src.models.lstm import NativeLSTM, UnrolledLSTM, native_lstms
+
+    TORCH_LIGHTNING_INSTALLED = True
+except ImportError:
+    TORCH_LIGHTNING_INSTALLED = False
+
+try:
+    import onnxruntime
+
+    ONNXRUNTIME_INSTALLED = True
+except ImportError:
+    ONNXRUNTIME_INSTALLED = False
+
+
+class Scaled(torch.nn.Module):
+    def __init__(self) -> None:
+        super().__init__()
+        self.linear = torch.nn.Linear(3, 1)
+        self.dropout = torch.nn.Dropout(0.5)
+        self.scales = {"scale": [2.0]}
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.dropout(self.linear(x[:, -1])) * self.scales["scale"][0]
+
+
+class Recurrent(torch.nn.Module):
+    def __init__(self) -> None:
+        super().__init__()
+        self.lstm = UnrolledLSTM(input_size=3, hidden_size=16, dropout=0.2, batch_first=True)
+        self.linear = torch.nn.Linear(16, 1)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        _, (hidden, _) = self.lstm(x)
+        return self.linear(hidden[-1])
+
+
+@skipIf(not TORCH_LIGHTNING_INSTALLED, reason="No pytorch-lightning installed")
+class TestExport(TestCase):
+    def test_optimize_for_inference(self):
+        sm = torch.jit.script(Scaled()).eval()
+        x = torch.randn(4, 5, 3)
+        optimized, is_optimized = optimize_for_inference(sm, x, preserved_attrs=["scales"])
+        self.assertEqual(is_optimized, hasattr(torch.jit, "freeze"))
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(optimized(x), sm(x), atol=1e-6))
+        self.assertEqual(optimized.scales, {"scale": [2.0]})
+
+    def test_benchmark(self):
+        model = Scaled().eval()
+        pixels_per_second = benchmark(
+            model, (5, 3), batch_sizes=[1, 8], repeats=2, min_duration=0.01
+        )
+        self.assertEqual(list(pixels_per_second.keys()), ["1", "8"])
+        self.assertTrue(all(v > 0 for v in pixels_per_second.values()))
+
+    def test_benchmark_runs_for_min_duration(self):
+        model = Scaled().eval()
+        start = time.perf_counter()
+        benchmark(model, (5, 3), batch_sizes=[1], repeats=1, min_duration=0.2)
+        self.assertGreaterEqual(time.perf_counter() - start, 0.2)
+
+    def test_save_benchmark(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            model_path = Path(tmpdir) / "model.pt"
+            self.assertIsNone(benchmark_export(model_path, (5, 3), min_duration=0.01))
+
+            torch.jit.script(Scaled()).eval().save(str(model_path))
+            pixels_per_second = benchmark_export(model_path, (5, 3), min_duration=0.01)
+            save_benchmark(model_path, {"pixels_per_second": pixels_per_second})
+
+            self.assertEqual(benchmark_path(model_path), Path(tmpdir) / "model.benchmark.json")
+            with benchmark_path(model_path).open() as f:
+                saved = json.load(f)
+            self.assertEqual(saved["pixels_per_second"], pixels_per_second)
+            self.assertEqual(saved["torch_version"], torch.__version__)
+
+    def test_quantize_dynamic(self):
+        model = Recurrent().eval()
+        x = torch.randn(8, 5, 3)
+        with torch.no_grad():
+            output = model(x)
+            quantized = quantize_dynamic(model)
+            self.assertIsInstance(quantized.lstm, NativeLSTM)
+            self.assertNotIsInstance(quantized.linear, torch.nn.Linear)
+            self.assertTrue(torch.allclose(quantized(x), output, atol=0.05))
+        # The quantized model can be exported
+        torch.jit.script(quantized)
+
+    def test_inference_model(self):
+        model = Recurrent().eval()
+        normalizing_dict = {"mean": np.arange(6, dtype=float), "std": np.arange(1, 7, dtype=float)}
+        inference_model = InferenceModel(model, [0, 2, 4], normalizing_dict)
+
+        x = torch.randn(8, 5, 6)
+        x_normalized = (x[:, :, [0, 2, 4]] - torch.tensor([0.0, 2.0, 4.0])) / torch.tensor(
+            [1.0, 3.0, 5.0]
+        )
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(inference_model(x), model(x_normalized), atol=1e-6))
+
+    @skipIf(not ONNXRUNTIME_INSTALLED, reason="No onnxruntime installed")
+    def test_onnx_export_matches_torch(self):
+        normalizing_dict = {"mean": np.arange(6, dtype=float), "std": np.arange(1, 7, dtype=float)}
+        inference_model = InferenceModel(Recurrent(), [0, 2, 4], normalizing_dict).eval()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            onnx_path = Path(tmpdir) / "model.onnx"
+            with native_lstms(inference_model):
+                export_onnx(inference_model, onnx_path, input_shape=(5, 6))
+            session = onnxruntime.InferenceSession(
+                str(onnx_path), providers=["CPUExecutionProvider"]
+            )
+
+            # The batch size and number of timesteps are dynamic
+            for shape in [(8, 5, 6), (3, 9, 6)]:
+                x = torch.randn(*shape)
+                with torch.no_grad():
+                    expected = inference_model(x).numpy()
+                (output,) = session.run(None, {"x": x.numpy()})
+                self.assertTrue(np.allclose(output, expected, atol=1e-5))
@@ -0,0 +1,37 @@
+from unittest import TestCase, skipIf
+
+import numpy as np
+from openmapflow.engineer import BANDS, calculate_ndvi
+
+try:
+    import pytorch_lightning  # noqa
+
+    from src.models.features import (
+        DATASET_FEATURES,
+        normalized_difference,
+        select_bands,
+    )
+
+    TORCH_LIGHTNING_INSTALLED = True
+except ImportError:
+    TORCH_LIGHTNING_INSTALLED = False
+
+
+@skipIf(not TORCH_LIGHTNING_INSTALLED, reason="No pytorch-lightning installed")
+class TestFeatures(TestCase):
+    def test_dataset_features_match_per_row_ndvi(self):
+        x = np.random.default_rng(42).uniform(-0.1, 1, size=(5, 12, len(BANDS))).astype(np.float32)
+        x[0, 0, BANDS.index("B8")] = x[0, 0, BANDS.index("B4")] = 0
+
+        features = DATASET_FEATURES(x)
+        self.assertEqual(features.shape, x.shape)
+        for row, row_features in zip(x, features):
+            self.assertTrue(np.array_equal(calculate_ndvi(row[:, : len(BANDS) - 1]), row_features))
+
+    def test_select_bands_and_normalized_difference(self):
+        x = np.array([[[1.0, 3.0, 5.0]]])
+        self.assertTrue(np.array_equal(select_bands([0, 2])(x), np.array([[[1.0, 5.0]]])))
+
+        difference = normalized_difference("b", "a", bands=["a", "b", "c"])(x)
+        self.assertEqual(difference.shape, (1, 1, 4))
+        self.assertAlmostEqual(difference[0, 0, -1], 0.5)
@@ -0,0 +1,78 @@
+import tempfile
+from pathlib import Path
+from unittest import TestCase, skipIf
+
+import numpy as np
+import torch
+
+try:
+    import pytorch_lightning  # noqa
+    from openmapflow.engineer import BANDS
+
+    from src.models.export import InferenceModel
+    from src.models.in_season import STATE_DTYPE, InSeasonModel, InSeasonState
+
+    from .model_fixtures import SMALL_HPARAMS, build_model
+
+    TORCH_LIGHTNING_INSTALLED = True
+except ImportError:
+    TORCH_LIGHTNING_INSTALLED = False
+
+AVAILABLE_TIMESTEPS = 5
+FORECAST_TIMESTEPS = 3
+
+
+@skipIf(not TORCH_LIGHTNING_INSTALLED, reason="No pytorch-lightning installed")
+class TestInSeason(TestCase):
+    def setUp(self):
+        self.model = build_model(
+            available_timesteps=AVAILABLE_TIMESTEPS,
+            input_months=AVAILABLE_TIMESTEPS + FORECAST_TIMESTEPS,
+            skip_era5=True,
+            **SMALL_HPARAMS,
+        ).eval()
+        self.x = torch.randn(10, AVAILABLE_TIMESTEPS, len(BANDS))
+        self.lat, self.lon = np.arange(10.0), np.arange(10.0)
+
+    def test_incremental_matches_forward(self):
+        in_season = InSeasonModel(self.model)
+        state = None
+        with torch.no_grad():
+            for month in range(AVAILABLE_TIMESTEPS):
+                probabilities, state = in_season.update(
+                    self.x[:, month : month + 1], state, self.lat, self.lon
+                )
+            # Model.forward only uses the first AVAILABLE_TIMESTEPS months
+            x_season = torch.cat((self.x, torch.randn(10, FORECAST_TIMESTEPS, len(BANDS))), dim=1)
+            expected = InferenceModel(
+                self.model, self.model.bands_to_use, self.model.normalizing_dict
+            )(x_season)
+        self.assertEqual(state.months_seen, AVAILABLE_TIMESTEPS)
+        self.assertTrue(torch.allclose(probabilities, expected[:, 0], atol=1e-6))
+
+        # Several months can be passed at once
+        probabilities_at_once, _ = in_season.update(self.x, None, self.lat, self.lon)
+        self.assertTrue(torch.allclose(probabilities, probabilities_at_once, atol=1e-6))
+
+    def test_state_save_load(self):
+        in_season = InSeasonModel(self.model)
+        _, state = in_season.update(self.x[:, :2], None, self.lat, self.lon)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            state_path = Path(tmpdir) / "state.npz"
+            state.save(state_path)
+            loaded = InSeasonState.load(state_path)
+        self.assertEqual(loaded.months_seen, 2)
+        self.assertEqual(loaded.classifier_hidden.dtype, STATE_DTYPE)
+        self.assertTrue(np.allclose(loaded.classifier_cell, state.classifier_cell, atol=1e-2))
+
+        probabilities, _ = in_season.update(self.x[:, 2:], state, self.lat, self.lon)
+        loaded_probabilities, _ = in_season.update(self.x[:, 2:], loaded, self.lat, self.lon)
+        self.assertTrue(torch.allclose(probabilities, loaded_probabilities, atol=1e-2))
+
+    def test_invalid_updates(self):
+        in_season = InSeasonModel(self.model)
+        _, state = in_season.update(self.x, None, self.lat, self.lon)
+        with self.assertRaises(ValueError):
+            in_season.update(self.x[:, :1], state, self.lat[::-1], self.lon)
+        with self.assertRaises(ValueError):
+            in_season.update(self.x, state, self.lat, self.lon)
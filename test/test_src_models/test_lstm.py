@@ -0,0 +1,142 @@
+from unittest import TestCase, skipIf
+
+import torch
+
+try:
+    import pytorch_lightning  # noqa
+
+    from src.models.lstm import NativeLSTM, UnrolledLSTM, native_lstms
+
+    TORCH_LIGHTNING_INSTALLED = True
+except ImportError:
+    TORCH_LIGHTNING_INSTALLED = False
+
+
+def legacy_state_dict(input_size: int, hidden_size: int):
+    # The state dict of an UnrolledLSTM saved before its gates were fused
+    torch.manual_seed(42)
+    state_dict = {}
+    for gate in ["forget_gate", "update_gate", "update_candidates", "output_gate"]:
+        state_dict[f"rnn.{gate}.0.weight"] = torch.randn(hidden_size, input_size + hidden_size)
+        state_dict[f"rnn.{gate}.0.bias"] = torch.randn(hidden_size)
+    return state_dict
+
+
+def legacy_forward(state_dict, x: torch.Tensor, hidden_size: int) -> torch.Tensor:
+    # The (unfused) cell computations, one linear layer per gate
+    def gate(name: str, inputs: torch.Tensor) -> torch.Tensor:
+        weight, bias = state_dict[f"rnn.{name}.0.weight"], state_dict[f"rnn.{name}.0.bias"]
+        return torch.nn.functional.linear(inputs, weight, bias)
+
+    hidden, cell = torch.zeros(x.shape[0], hidden_size), torch.zeros(x.shape[0], hidden_size)
+    outputs = []
+    for i in range(x.shape[1]):
+        inputs = torch.cat((x[:, i], hidden), dim=-1)
+        cell = torch.sigmoid(gate("forget_gate", inputs)) * cell + torch.sigmoid(
+            gate("update_gate", inputs)
+        ) * torch.tanh(gate("update_candidates", inputs))
+        hidden = torch.sigmoid(gate("output_gate", inputs)) * torch.tanh(cell)
+        outputs.append(hidden)
+    return torch.stack(outputs)
+
+
+@skipIf(not TORCH_LIGHTNING_INSTALLED, reason="No pytorch-lightning installed")
+class TestLSTM(TestCase):
+    def test_load_legacy_state_dict(self):
+        lstm = UnrolledLSTM(input_size=3, hidden_size=8, dropout=0.2, batch_first=True)
+        state_dict = legacy_state_dict(input_size=3, hidden_size=8)
+        lstm.load_state_dict(state_dict)
+        self.assertEqual(lstm.rnn.input_to_gates.weight.shape, (32, 3))
+        self.assertEqual(lstm.rnn.hidden_to_gates.weight.shape, (32, 8))
+        lstm.eval()
+
+        x = torch.randn(5, 6, 3)
+        with torch.no_grad():
+            output, (hidden, cell) = lstm(x)
+
+        expected = legacy_forward(state_dict, x, hidden_size=8)
+        # outputs are [timesteps, 1, batch, hidden]
+        self.assertEqual(output.shape, (6, 1, 5, 8))
+        self.assertTrue(torch.allclose(output[:, 0], expected, atol=1e-6))
+        self.assertTrue(torch.allclose(hidden[0], expected[-1], atol=1e-6))
+
+    def test_load_fused_state_dict(self):
+        # The state dict of an UnrolledLSTM whose gates were fused into a single layer
+        legacy = legacy_state_dict(input_size=3, hidden_size=8)
+        gates = ["update_gate", "forget_gate", "update_candidates", "output_gate"]
+        fused = {
+            f"rnn.gates.{param}": torch.cat([legacy[f"rnn.{gate}.0.{param}"] for gate in gates])
+            for param in ["weight", "bias"]
+        }
+        from_legacy = UnrolledLSTM(input_size=3, hidden_size=8, dropout=0.2, batch_first=True)
+        from_legacy.load_state_dict(legacy)
+        from_fused = UnrolledLSTM(input_size=3, hidden_size=8, dropout=0.2, batch_first=True)
+        from_fused.load_state_dict(fused)
+        for key, value in from_legacy.state_dict().items():
+            self.assertTrue(torch.equal(value, from_fused.state_dict()[key]))
+
+    def test_state_dict_round_trip(self):
+        lstm = UnrolledLSTM(input_size=3, hidden_size=8, dropout=0.2, batch_first=True)
+        loaded = UnrolledLSTM(input_size=3, hidden_size=8, dropout=0.2, batch_first=True)
+        loaded.load_state_dict(lstm.state_dict())
+        for key, value in lstm.state_dict().items():
+            self.assertTrue(torch.equal(value, loaded.state_dict()[key]))
+
+    def test_variational_dropout(self):
+        lstm = UnrolledLSTM(input_size=3, hidden_size=8, dropout=0.5, batch_first=True)
+        lstm.train()
+        x = torch.randn(5, 6, 3)
+        output, (hidden, _) = lstm(x)
+        # The outputs are the hidden states before dropout, the returned state is the
+        # hidden state after dropout, using the same mask for every timestep
+        self.assertEqual(lstm.dropout.mask.shape, (5, 8))
+        self.assertTrue(torch.equal(hidden[0], output[-1, 0] * lstm.dropout.mask))
+
+    def test_per_step_dropout_matches_stepping(self):
+        # A single pass with per_step_dropout is equal to passing the timesteps one at a
+        # time, as the Forecaster did before its input timesteps were passed at once
+        lstm = UnrolledLSTM(
+            input_size=3, hidden_size=8, dropout=0.5, batch_first=True, per_step_dropout=True
+        )
+        lstm.train()
+        x = torch.randn(5, 6, 3)
+
+        torch.manual_seed(0)
+        output, (hidden, cell) = lstm(x)
+
+        torch.manual_seed(0)
+        state = None
+        step_outputs = []
+        for i in range(x.shape[1]):
+            step_output, state = lstm(x[:, i : i + 1], state)
+            step_outputs.append(step_output)
+        self.assertTrue(torch.allclose(output, torch.cat(step_outputs), atol=1e-6))
+        self.assertTrue(torch.allclose(hidden, state[0], atol=1e-6))
+        self.assertTrue(torch.allclose(cell, state[1], atol=1e-6))
+
+    def test_native_lstm_matches_unrolled(self):
+        lstm = UnrolledLSTM(input_size=3, hidden_size=8, dropout=0.2, batch_first=True)
+        lstm.eval()
+        native = NativeLSTM.from_unrolled(lstm)
+
+        x = torch.randn(5, 6, 3)
+        with torch.no_grad():
+            output, (hidden, cell) = lstm(x)
+            native_output, (native_hidden, native_cell) = native(x)
+            self.assertEqual(native_output.shape, output.shape)
+            self.assertTrue(torch.allclose(output, native_output, atol=1e-6))
+            self.assertTrue(torch.allclose(hidden, native_hidden, atol=1e-6))
+            self.assertTrue(torch.allclose(cell, native_cell, atol=1e-6))
+
+            # Continuing from a state, as the Forecaster does
+            output, _ = lstm(x[:, :1], (hidden, cell))
+            native_output, _ = native(x[:, :1], (hidden, cell))
+            self.assertTrue(torch.allclose(output, native_output, atol=1e-6))
+
+    def test_native_lstms_restores_unrolled(self):
+        model = torch.nn.ModuleList(
+            [UnrolledLSTM(input_size=3, hidden_size=8, dropout=0.2, batch_first=True)]
+        )
+        with native_lstms(model):
+            self.assertIsInstance(model[0], NativeLSTM)
+        self.assertIsInstance(model[0], UnrolledLSTM)
@@ -0,0 +1,64 @@
+from unittest import TestCase
+
+import numpy as np
+import torch
+from sklearn.metrics import (
+    accuracy_score,
+    f1_score,
+    precision_score,
+    recall_score,
+    roc_auc_score,
+)
+
+from src.models.metrics import StreamingMetrics
+
+THRESHOLD = 0.5
+
+
+def sklearn_metrics(preds: np.ndarray, labels: np.ndarray):
+    binary_preds = (preds > THRESHOLD).astype(int)
+    return {
+        "roc_auc_score": roc_auc_score(labels, preds),
+        "precision_score": precision_score(labels, binary_preds, zero_division=0),
+        "recall_score": recall_score(labels, binary_preds, zero_division=0),
+        "f1_score": f1_score(labels, binary_preds, zero_division=0),
+        "accuracy": accuracy_score(labels, binary_preds),
+    }
+
+
+class TestStreamingMetrics(TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.labels = (torch.rand(1000) > 0.4).float()
+        self.preds = torch.sigmoid(torch.randn(1000) + 2 * (self.labels - 0.5))
+
+    def test_matches_sklearn(self):
+        metrics = StreamingMetrics()
+        for preds, labels in zip(self.preds.split(64), self.labels.split(64)):
+            metrics.update(preds.unsqueeze(-1), labels, threshold=THRESHOLD)
+
+        expected = sklearn_metrics(self.preds.numpy(), self.labels.numpy())
+        output = metrics.compute()
+        self.assertEqual(output.keys(), expected.keys())
+        for key, value in expected.items():
+            self.assertAlmostEqual(output[key], value, places=3 if key == "roc_auc_score" else 6)
+
+    def test_weights_mask_predictions(self):
+        weights = (torch.rand(1000) > 0.5).float()
+        metrics = StreamingMetrics()
+        metrics.update(self.preds, self.labels, threshold=THRESHOLD, weights=weights)
+
+        mask = weights.bool()
+        expected = sklearn_metrics(self.preds[mask].numpy(), self.labels[mask].numpy())
+        for key, value in expected.items():
+            self.assertAlmostEqual(metrics.compute()[key], value, places=3)
+
+    def test_single_class_and_reset(self):
+        metrics = StreamingMetrics()
+        self.assertEqual(metrics.compute(), {})
+        metrics.update(torch.tensor([0.2, 0.7]), torch.tensor([1.0, 1.0]), threshold=THRESHOLD)
+        output = metrics.compute()
+        self.assertNotIn("roc_auc_score", output)
+        self.assertEqual(output["recall_score"], 0.5)
+        metrics.reset()
+        self.assertEqual(metrics.compute(), {})
@@ -0,0 +1,196 @@
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+
+import torch
+import torch.nn.functional as F
+
+try:
+    import pytorch_lightning  # noqa
+
+    from src.models.model import Model
+
+    from .model_fixtures import build_model
+
+    TORCH_LIGHTNING_INSTALLED = True
+except ImportError:
+    TORCH_LIGHTNING_INSTALLED = False
+
+
+def reference_loss(model, batch, training: bool) -> torch.Tensor:
+    # The loss of a forecasting Model, as computed by _split_preds_and_get_loss before the
+    # losses were computed with fixed-shape masks (the partial time series were dropped)
+    x, label, is_global = batch
+    loss = torch.zeros(())
+
+    input_to_encode = x[:, : model.available_timesteps, :]
+    encoder_output = model.forecaster(input_to_encode)
+    x_has_nans = torch.isnan(x).any().item()
+    if not x_has_nans:
+        loss = model.forecaster_loss(x[:, 1:, :], encoder_output)
+    final_encoded_input = torch.cat(
+        (
+            model.add_noise(input_to_encode, training),
+            encoder_output[:, model.available_timesteps - 1 :],
+        ),
+        dim=1,
+    )
+
+    if training:
+        if x_has_nans:
+            nan_batch_index = torch.isnan(x).any(dim=1).any(dim=1)
+            x_full_time_series_w_noise = model.add_noise(x[~nan_batch_index], training=training)
+            x = torch.cat((x_full_time_series_w_noise, final_encoded_input), dim=0)
+            label = torch.cat((label[~nan_batch_index], label), dim=0)
+            is_global = torch.cat((is_global[~nan_batch_index], is_global), dim=0)
+        else:
+            x = torch.cat((x, final_encoded_input), dim=0)
+            label = torch.cat((label, label), dim=0)
+            is_global = torch.cat((is_global, is_global), dim=0)
+    else:
+        x = final_encoded_input
+
+    global_preds, local_preds = model.classifier(x)
+    global_preds, global_labels = global_preds[is_global != 0], label[is_global != 0]
+    local_preds, local_labels = local_preds[is_global == 0], label[is_global == 0]
+    if local_preds.shape[0] > 0:
+        loss = loss + model.local_loss_function(local_preds.squeeze(-1), local_labels)
+    if global_preds.shape[0] > 0:
+        global_loss = model.global_loss_function(global_preds.squeeze(-1), global_labels)
+        if local_preds.shape[0] == 0:
+            alpha = 1.0
+        else:
+            alpha = global_preds.shape[0] / local_preds.shape[0] / model.hparams.alpha
+        loss = loss + alpha * global_loss
+    return loss
+
+
+@skipIf(not TORCH_LIGHTNING_INSTALLED, reason="No pytorch-lightning installed")
+class TestModelLosses(TestCase):
+    def setUp(self):
+        # The attributes used by Model._compute_forecaster_loss
+        self.model = SimpleNamespace(
+            forecaster_loss=F.smooth_l1_loss, _masked_mean=Model._masked_mean
+        )
+
+    def forecaster_loss(self, y_true: torch.Tensor, y_forecast: torch.Tensor) -> torch.Tensor:
+        return Model._compute_forecaster_loss(self.model, y_true=y_true, y_forecast=y_forecast)
+
+    def test_forecaster_loss_without_nans(self):
+        y_true, y_forecast = torch.randn(8, 6, 4), torch.randn(8, 6, 4)
+        expected = F.smooth_l1_loss(y_forecast, y_true)
+        self.assertTrue(torch.allclose(self.forecaster_loss(y_true, y_forecast), expected))
+
+    def test_forecaster_loss_with_nans(self):
+        y_true = torch.randn(8, 6, 4)
+        y_forecast = torch.randn(8, 6, 4, requires_grad=True)
+        # Partial time series, the last 2 timesteps are missing
+        y_true[:3, 4:] = float("nan")
+
+        loss_full = F.smooth_l1_loss(y_forecast[3:], y_true[3:])
+        loss_partial = F.smooth_l1_loss(y_forecast[:3, :4], y_true[:3, :4])
+        total_full_timesteps, total_partial_timesteps = 5 * 6, 3 * 4
+        w_full = total_full_timesteps / (total_full_timesteps + total_partial_timesteps)
+        w_partial = total_partial_timesteps / (total_full_timesteps + total_partial_timesteps)
+        expected = w_full * loss_full + w_partial * loss_partial
+
+        loss = self.forecaster_loss(y_true, y_forecast)
+        self.assertTrue(torch.allclose(loss, expected))
+
+        loss.backward()
+        self.assertTrue(torch.isfinite(y_forecast.grad).all())
+        # Only the non nan timesteps have gradients
+        self.assertTrue((y_forecast.grad[:3, 4:] == 0).all())
+
+    def test_forecaster_loss_only_partial(self):
+        y_true, y_forecast = torch.randn(8, 6, 4), torch.randn(8, 6, 4)
+        y_true[:, 4:] = float("nan")
+        expected = F.smooth_l1_loss(y_forecast[:, :4], y_true[:, :4])
+        self.assertTrue(torch.allclose(self.forecaster_loss(y_true, y_forecast), expected))
+
+
+@skipIf(not TORCH_LIGHTNING_INSTALLED, reason="No pytorch-lightning installed")
+class TestModelExport(TestCase):
+    def test_save_onnx_keeps_the_mode(self):
+        model = build_model(available_timesteps=9)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for training in [True, False]:
+                model.train(training)
+                onnx_path = model.save_onnx(Path(tmp_dir) / f"model_{training}.onnx")
+                self.assertTrue(onnx_path.exists())
+                self.assertTrue(all(m.training == training for m in model.modules()))
+
+
+@skipIf(not TORCH_LIGHTNING_INSTALLED, reason="No pytorch-lightning installed")
+class TestModelLossEquivalence(TestCase):
+    # The losses of a forecasting Model match the losses computed before they were computed
+    # with fixed-shape masks, and so do the gradients and the BatchNorm running statistics
+
+    def batch(self, partial: bool):
+        x = torch.randn(16, 12, 18)
+        if partial:
+            # The time series of some datasets are shorter than input_months
+            x[:4, 10:] = float("nan")
+        label = torch.randint(0, 2, (16,)).float()
+        is_global = (torch.arange(16) % 3 == 0).float()
+        return x, label, is_global
+
+    def check_equivalence(self, partial: bool, training: bool, **hparams):
+        model = build_model(available_timesteps=9, **hparams).train(training)
+        reference = build_model(available_timesteps=9, **hparams).train(training)
+        for parameter, expected_parameter in zip(
+            model.state_dict().values(), reference.state_dict().values()
+        ):
+            self.assertTrue(torch.equal(parameter, expected_parameter))
+        batch = self.batch(partial)
+
+        torch.manual_seed(1)
+        loss = model._split_preds_and_get_loss(
+            batch, loss_label="loss", log_loss=False, training=training
+        )["loss"]
+        random_state = torch.get_rng_state()
+        torch.manual_seed(1)
+        expected = reference_loss(reference, batch, training)
+        if not (partial and training):
+            # The same random numbers are drawn (e.g. for the noise and dropout)
+            self.assertTrue(torch.equal(random_state, torch.get_rng_state()))
+        self.assertTrue(torch.allclose(loss, expected, atol=1e-6))
+
+        loss.backward()
+        expected.backward()
+        for (name, parameter), expected_parameter in zip(
+            model.named_parameters(), reference.parameters()
+        ):
+            with self.subTest(parameter=name):
+                self.assertTrue(torch.allclose(parameter.grad, expected_parameter.grad, atol=1e-6))
+        for (name, buffer), expected_buffer in zip(model.named_buffers(), reference.buffers()):
+            with self.subTest(buffer=name):
+                self.assertTrue(torch.allclose(buffer, expected_buffer, atol=1e-6))
+
+    def test_eval_full_time_series(self):
+        self.check_equivalence(partial=False, training=False)
+
+    def test_eval_partial_time_series(self):
+        self.check_equivalence(partial=True, training=False)
+
+    def test_train_full_time_series(self):
+        self.check_equivalence(partial=False, training=True)
+
+    def test_train_partial_time_series(self):
+        # The batch used to be shortened by the partial time series, so the dropout masks
+        # (drawn even if the dropout is 0) and the noise of the original time series are not
+        # drawn the same way anymore. The noise is a function of the time series instead, so
+        # the same time series are noised the same way
+        def add_noise(model, x: torch.Tensor, training: bool) -> torch.Tensor:
+            return x + model.hparams.noise_factor * torch.sin(x) if training else x
+
+        with patch.object(Model, "add_noise", add_noise):
+            self.check_equivalence(
+                partial=True,
+                training=True,
+                noise_factor=0.1,
+                classifier_dropout=0,
+                forecasting_dropout=0,
+            )
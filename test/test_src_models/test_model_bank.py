@@ -0,0 +1,63 @@
+from unittest import TestCase, skipIf
+
+import torch
+
+try:
+    import pytorch_lightning  # noqa
+    from openmapflow.bands import S1_BANDS
+    from openmapflow.engineer import BANDS
+
+    from src.models.export import InferenceModel
+    from src.models.model_bank import ModelBank
+
+    from .model_fixtures import SMALL_HPARAMS, build_model
+
+    TORCH_LIGHTNING_INSTALLED = True
+except ImportError:
+    TORCH_LIGHTNING_INSTALLED = False
+
+
+def bank_model(seed: int, **kwargs):
+    hparams = {**SMALL_HPARAMS, **kwargs}
+    return build_model(model_name=f"model_{seed}", seed=seed, **hparams).eval()
+
+
+def expected_output(models, x: torch.Tensor) -> torch.Tensor:
+    # The outputs of Model.forward, on the raw data
+    return torch.stack(
+        [InferenceModel(m, m.bands_to_use, m.normalizing_dict)(x)[:, 0] for m in models]
+    )
+
+
+@skipIf(not TORCH_LIGHTNING_INSTALLED, reason="No pytorch-lightning installed")
+class TestModelBank(TestCase):
+    def test_model_bank_matches_models(self):
+        models = [bank_model(seed, skip_era5=True) for seed in range(3)]
+        # Models trained on different bands can be stacked if they use as many bands, e.g. a
+        # model trained without the S1 bands instead of the ERA5 bands
+        models[2].bands_to_use = [i for i, band in enumerate(BANDS) if band not in S1_BANDS]
+        bank = ModelBank(models).eval()
+
+        # Large enough to be split into chunks
+        x = torch.randn(700, 12, len(BANDS))
+        with torch.no_grad():
+            output = bank(x)
+            self.assertEqual(output.shape, (3, 700))
+            self.assertTrue(torch.allclose(output, expected_output(models, x), atol=1e-5))
+
+    def test_model_bank_matches_forecasting_models(self):
+        models = [bank_model(i, available_timesteps=9) for i in range(3)]
+        self.assertTrue(all(m.forecast_eval_data for m in models))
+        bank = ModelBank(models).eval()
+
+        x = torch.randn(10, 12, len(BANDS))
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(bank(x), expected_output(models, x), atol=1e-5))
+
+    def test_incompatible_models(self):
+        with self.assertRaises(ValueError):
+            ModelBank([bank_model(0), bank_model(1, skip_era5=True)])
+        with self.assertRaises(ValueError):
+            ModelBank([bank_model(0), bank_model(1, classifier_vector_size=8)])
+        with self.assertRaises(ValueError):
+            ModelBank([bank_model(0), bank_model(1, available_timesteps=9)])
@@ -0,0 +1,47 @@
+from unittest import TestCase, skipIf
+
+import numpy as np
+
+try:
+    import pytorch_lightning  # noqa
+
+    from src.models.data import CropDataset
+    from src.models.normalizing_stats import NormalizingStats
+
+    TORCH_LIGHTNING_INSTALLED = True
+except ImportError:
+    TORCH_LIGHTNING_INSTALLED = False
+
+
+@skipIf(not TORCH_LIGHTNING_INSTALLED, reason="No pytorch-lightning installed")
+class TestNormalizingStats(TestCase):
+    def test_from_array(self):
+        stats = NormalizingStats.from_array(np.array([[1, 2, 3], [2, 3, 4]]))
+        self.assertEqual(stats.n, 2)
+        self.assertTrue(np.allclose(stats.mean, np.array([1.5, 2.5, 3.5])))
+        self.assertTrue(np.allclose(stats.M2, np.array([0.5, 0.5, 0.5])))
+
+    def test_merge_matches_sequential_calculation(self):
+        rng = np.random.default_rng(42)
+        arrays = [rng.normal(i, i + 1, size=(12, 4)) for i in range(5)]
+
+        merged = NormalizingStats.merge_all([NormalizingStats.from_array(a) for a in arrays])
+        normalizing_dict = CropDataset._calculate_normalizing_dict(arrays)
+
+        self.assertEqual(merged.n, 60)
+        self.assertTrue(np.allclose(merged.to_normalizing_dict()["mean"], normalizing_dict["mean"]))
+        self.assertTrue(np.allclose(merged.to_normalizing_dict()["std"], normalizing_dict["std"]))
+
+    def test_merge_with_empty(self):
+        stats = NormalizingStats.from_array(np.array([[1.0, 2.0], [3.0, 4.0]]))
+        merged = NormalizingStats.empty(2).merge(stats)
+        self.assertEqual(merged.n, 2)
+        self.assertTrue(np.allclose(merged.mean, stats.mean))
+        self.assertTrue(np.allclose(merged.M2, stats.M2))
+
+    def test_json_round_trip(self):
+        stats = NormalizingStats.from_array(np.array([[1.0, 2.0], [3.0, 5.0]]))
+        loaded = NormalizingStats.from_json(stats.to_json())
+        self.assertEqual(loaded.n, stats.n)
+        self.assertTrue(np.allclose(loaded.mean, stats.mean))
+        self.assertTrue(np.allclose(loaded.M2, stats.M2))
@@ -0,0 +1,121 @@
+import tempfile
+from pathlib import Path
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+from openmapflow.bbox import BBox
+from openmapflow.constants import CLASS_PROB, END, EO_DATA, LAT, LON, START, SUBSET
+
+try:
+    import pytorch_lightning  # noqa
+
+    from src.models import eo_store, spatial_index
+    from src.models.spatial_index import SpatialIndex
+
+    TORCH_LIGHTNING_INSTALLED = True
+except ImportError:
+    TORCH_LIGHTNING_INSTALLED = False
+
+
+class TempDataset:
+    def __init__(self, name: str, df_path: Path, df: pd.DataFrame):
+        self.name = name
+        self.df_path = df_path
+        self.df = df
+
+    def load_df(self, to_np: bool = False, disable_tqdm: bool = False) -> pd.DataFrame:
+        return self.df.copy()
+
+
+@skipIf(not TORCH_LIGHTNING_INSTALLED, reason="No pytorch-lightning installed")
+class TestSpatialIndex(TestCase):
+    def test_query_matches_brute_force(self):
+        rng = np.random.default_rng(42)
+        lat, lon = rng.uniform(-90, 90, 5000), rng.uniform(-180, 180, 5000)
+        lat[:3], lon[:3] = [1.0, -90.0, 90.0], [2.0, -180.0, 180.0]
+        index = SpatialIndex.from_points(
+            dataset_names=["temp"],
+            points={
+                "dataset": np.zeros(5000, dtype=np.int32),
+                "position": np.arange(5000),
+                LAT: lat,
+                LON: lon,
+                SUBSET: np.array(["training"] * 5000),
+                CLASS_PROB: np.ones(5000),
+            },
+        )
+        for bbox in [
+            BBox(min_lat=-11.829, max_lat=6.003, min_lon=28.430, max_lon=42.284),
+            BBox(min_lat=1.0, max_lat=1.0, min_lon=2.0, max_lon=2.0),
+            BBox(min_lat=-90, max_lat=90, min_lon=-180, max_lon=180),
+        ]:
+            expected = (
+                (lat >= bbox.min_lat)
+                & (lat <= bbox.max_lat)
+                & (lon >= bbox.min_lon)
+                & (lon <= bbox.max_lon)
+            )
+            actual = index.points["position"][index.query(bbox)]
+            self.assertListEqual(sorted(actual), list(np.flatnonzero(expected)))
+
+    def test_load_and_validate(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            csv_path = Path(tmp_dir) / "temp.csv"
+            csv_path.write_text("v1")
+            df = pd.DataFrame(
+                {
+                    LAT: [0.5, 2.0, 0.5],
+                    LON: [0.5, 0.5, 0.5],
+                    START: ["2019-01-01"] * 3,
+                    END: ["2020-12-31"] * 3,
+                    CLASS_PROB: [1.0, 0.0, 0.5],
+                    SUBSET: ["validation"] * 3,
+                    EO_DATA: [np.ones((4, 2))] * 3,
+                }
+            )
+            dataset = TempDataset("temp", csv_path, df)
+            with patch.object(eo_store, "COMPILED_DIR", Path(tmp_dir) / "compiled"):
+                built = spatial_index.load_spatial_index([dataset])
+                loaded = spatial_index.load_spatial_index([dataset])
+                self.assertListEqual(loaded.dataset_names, ["temp"])
+                for col in spatial_index.POINT_COLUMNS:
+                    self.assertTrue(np.array_equal(built.points[col], loaded.points[col]))
+
+                bbox = BBox(min_lat=0, max_lat=1, min_lon=0, max_lon=1)
+                eval_points, non_local = spatial_index.non_local_eval_points(
+                    loaded, "temp", bbox, "validation"
+                )
+                self.assertEqual(len(eval_points), 2)
+                self.assertListEqual(loaded.points["position"][non_local].tolist(), [1])
+                with self.assertRaises(ValueError):
+                    spatial_index.non_local_eval_points(loaded, "other", bbox, "validation")
+
+    def test_stale_indexes_are_removed(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            csv_path = Path(tmp_dir) / "temp.csv"
+            csv_path.write_text("v1")
+            df = pd.DataFrame(
+                {
+                    LAT: [0.5],
+                    LON: [0.5],
+                    START: ["2019-01-01"],
+                    END: ["2020-12-31"],
+                    CLASS_PROB: [1.0],
+                    SUBSET: ["validation"],
+                    EO_DATA: [np.ones((4, 2))],
+                }
+            )
+            dataset = TempDataset("temp", csv_path, df)
+            with patch.object(eo_store, "COMPILED_DIR", Path(tmp_dir) / "compiled"):
+                spatial_index.load_spatial_index([dataset])
+                stale_path = spatial_index._index_path([dataset])
+                # A build of the same index in another process, which is still writing
+                concurrent_tmp_path = eo_store._tmp_path(stale_path)
+
+                csv_path.write_text("v2 changed")
+                spatial_index.load_spatial_index([dataset])
+                self.assertFalse(stale_path.exists())
+                self.assertTrue(concurrent_tmp_path.exists())
+                self.assertTrue(spatial_index._index_path([dataset]).exists())
@@ -0,0 +1,101 @@
+from types import SimpleNamespace
+from typing import List
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+from openmapflow.bbox import BBox
+from openmapflow.constants import CLASS_PROB, END, LAT, LON, START, SUBSET
+
+try:
+    import pytorch_lightning  # noqa
+
+    from src.models import data
+    from src.models.data import CropDataset, StreamingCropDataset
+    from src.models.eo_store import TIMESTEPS, CompiledDataset
+
+    TORCH_LIGHTNING_INSTALLED = True
+except ImportError:
+    TORCH_LIGHTNING_INSTALLED = False
+
+
+@skipIf(not TORCH_LIGHTNING_INSTALLED, reason="No pytorch-lightning installed")
+class TestStreamingCropDataset(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(42)
+        num_examples = 23
+        timesteps = np.where(np.arange(num_examples) % 5 == 0, 6, 24)
+        eo_data = np.full((num_examples, 24, 3), np.nan, dtype=np.float32)
+        for i, t in enumerate(timesteps):
+            eo_data[i, :t] = rng.normal(size=(t, 3))
+        metadata = pd.DataFrame(
+            {
+                LAT: rng.uniform(0, 2, num_examples),
+                LON: rng.uniform(0, 2, num_examples),
+                START: ["2019-01-01"] * num_examples,
+                END: ["2020-12-31"] * num_examples,
+                CLASS_PROB: rng.choice([0.0, 1.0], num_examples),
+                SUBSET: ["training"] * num_examples,
+                TIMESTEPS: timesteps,
+            }
+        )
+        self.compiled = CompiledDataset(name="temp", eo_data=eo_data, metadata=metadata)
+        self.kwargs = dict(
+            target_bbox=BBox(min_lat=0, max_lat=1, min_lon=0, max_lon=1),
+            normalizing_dict={"mean": np.array([0.1, 0.2, 0.3]), "std": np.array([1.0, 2.0, 3.0])},
+            start_month="March",
+            input_months=12,
+            bands_to_use=[0, 2],
+        )
+
+    def _streaming_dataset(self) -> "StreamingCropDataset":
+        return StreamingCropDataset(
+            sources=[(self.compiled, np.arange(23))],
+            features=None,
+            chunk_size=4,
+            shuffle_buffer_chunks=2,
+            **self.kwargs,
+        )
+
+    @staticmethod
+    def _example_keys(examples) -> List[bytes]:
+        return sorted(
+            np.concatenate([np.nan_to_num(x.numpy().ravel(), nan=-1), [y, w]]).tobytes()
+            for x, y, w in examples
+        )
+
+    def test_same_examples_as_crop_dataset(self):
+        crop_dataset = CropDataset(
+            df=self.compiled.to_df(),
+            subset="training",
+            cache=False,
+            upsample=False,
+            wandb_logger=None,
+            **self.kwargs,
+        )
+        streaming_dataset = self._streaming_dataset()
+        self.assertEqual(len(streaming_dataset), len(crop_dataset))
+        self.assertListEqual(
+            self._example_keys(streaming_dataset),
+            self._example_keys(crop_dataset[i] for i in range(len(crop_dataset))),
+        )
+
+    def test_worker_shards_are_disjoint(self):
+        streaming_dataset = self._streaming_dataset()
+        shard_keys: List[bytes] = []
+        for worker_id in range(3):
+            worker_info = SimpleNamespace(id=worker_id, num_workers=3)
+            with patch.object(data, "get_worker_info", return_value=worker_info):
+                shard_keys += self._example_keys(streaming_dataset)
+
+        self.assertListEqual(sorted(shard_keys), self._example_keys(streaming_dataset))
+
+    def test_epochs_are_reshuffled(self):
+        streaming_dataset = self._streaming_dataset()
+        first_epoch = [x[0, 0].item() for x, _, _ in streaming_dataset]
+        streaming_dataset.set_epoch(1)
+        second_epoch = [x[0, 0].item() for x, _, _ in streaming_dataset]
+        streaming_dataset.set_epoch(0)
+        self.assertListEqual(first_epoch, [x[0, 0].item() for x, _, _ in streaming_dataset])
+        self.assertNotEqual(first_epoch, second_epoch)
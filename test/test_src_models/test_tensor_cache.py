@@ -0,0 +1,86 @@
+import tempfile
+import time
+from pathlib import Path
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+
+import torch
+
+try:
+    import pytorch_lightning  # noqa
+
+    from src.models import tensor_cache
+
+    TORCH_LIGHTNING_INSTALLED = True
+except ImportError:
+    TORCH_LIGHTNING_INSTALLED = False
+
+
+@skipIf(not TORCH_LIGHTNING_INSTALLED, reason="No pytorch-lightning installed")
+class TestTensorCache(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.patcher = patch.object(tensor_cache, "TENSOR_CACHE_DIR", Path(self.tmp_dir.name))
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.tmp_dir.cleanup()
+
+    def test_key_depends_on_every_param(self):
+        key = tensor_cache.tensor_cache_key(input_months=12, start_month="February")
+        self.assertEqual(
+            key, tensor_cache.tensor_cache_key(start_month="February", input_months=12)
+        )
+        self.assertNotEqual(
+            key, tensor_cache.tensor_cache_key(input_months=12, start_month="April")
+        )
+
+    def test_round_trip(self):
+        tensors = {
+            "x": torch.rand(4, 3, 2),
+            "compact_x": torch.rand(4, 3, 2).to(torch.bfloat16),
+            "labels": torch.tensor([1, 0, 3, 2], dtype=torch.uint8),
+        }
+        self.assertIsNone(tensor_cache.load_tensors("key"))
+
+        tensor_cache.save_tensors("key", tensors)
+        loaded = tensor_cache.load_tensors("key")
+        self.assertIsNotNone(loaded)
+        self.assertEqual(loaded.keys(), tensors.keys())
+        for name, expected in tensors.items():
+            self.assertEqual(loaded[name].dtype, expected.dtype)
+            self.assertTrue(torch.equal(expected, loaded[name]))
+
+        tensor_cache.clear_tensor_cache()
+        self.assertIsNone(tensor_cache.load_tensors("key"))
+
+    def test_least_recently_used_tensors_are_evicted(self):
+        for key in ["first", "second", "third"]:
+            tensor_cache.save_tensors(key, {"x": torch.zeros(100)})
+            time.sleep(0.01)
+        # Loading marks the tensors as used
+        tensor_cache.load_tensors("first")
+        num_bytes = sum(path.stat().st_size for path in Path(self.tmp_dir.name).glob("third.*"))
+
+        tensor_cache.evict_tensors(2 * num_bytes)
+        self.assertIsNotNone(tensor_cache.load_tensors("first"))
+        self.assertIsNone(tensor_cache.load_tensors("second"))
+        self.assertIsNotNone(tensor_cache.load_tensors("third"))
+
+    def test_save_evicts_to_stay_below_the_limit(self):
+        tensor_cache.save_tensors("old", {"x": torch.zeros(100)})
+        with patch.object(tensor_cache, "MAX_CACHE_FRACTION", 0.0):
+            tensor_cache.save_tensors("new", {"x": torch.zeros(100)})
+        self.assertIsNone(tensor_cache.load_tensors("old"))
+        self.assertIsNotNone(tensor_cache.load_tensors("new"))
+
+    def test_unfinished_writes_are_not_evicted(self):
+        tensor_cache.save_tensors("old", {"x": torch.zeros(100)})
+        # The temporary file of a concurrent trial which is still writing its tensors
+        tmp_path = tensor_cache._tmp_path(tensor_cache._tensor_path("new", "x", False))
+        tmp_path.write_bytes(b"partial")
+
+        tensor_cache.clear_tensor_cache()
+        self.assertIsNone(tensor_cache.load_tensors("old"))
+        self.assertTrue(tmp_path.exists())